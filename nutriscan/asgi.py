@@ -3,6 +3,10 @@ ASGI config for nutriscan project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve the app through this entry point (e.g. ``uvicorn nutriscan.asgi:application``)
+to get the streaming scan progress endpoint (``scan_events``) without tying up a
+thread per open connection.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -1,6 +1,6 @@
 from pathlib import Path
 import os
-from decouple import config
+from decouple import config, Csv
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -28,6 +28,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'scan.middleware.server_timing_middleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -90,5 +91,157 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / "media"
 
+# Product lookup cache (seconds)
+PRODUCT_CACHE_TTL = config("PRODUCT_CACHE_TTL", default=7 * 24 * 3600, cast=int)
+PRODUCT_CACHE_NEGATIVE_TTL = config("PRODUCT_CACHE_NEGATIVE_TTL", default=15 * 60, cast=int)
+PRODUCT_LOOKUP_WAIT_TIMEOUT = config("PRODUCT_LOOKUP_WAIT_TIMEOUT", default=15, cast=int)
+# Pooled connections to Open Food Facts, per process (sync) and per event loop (async pipeline)
+PRODUCT_LOOKUP_MAX_CONNECTIONS = config("PRODUCT_LOOKUP_MAX_CONNECTIONS", default=20, cast=int)
+
+# Background scan jobs (see the run_scan_worker management command)
+SCAN_BACKGROUND_JOBS = config("SCAN_BACKGROUND_JOBS", default=True, cast=bool)
+# Run scans inside the request on the async pipeline instead (serve through nutriscan.asgi)
+SCAN_ASYNC_PIPELINE = config("SCAN_ASYNC_PIPELINE", default=False, cast=bool)
+# Speculative decode and product lookup as soon as an upload is stored (see services/prefetch.py)
+SCAN_PREFETCH_ENABLED = config("SCAN_PREFETCH_ENABLED", default=True, cast=bool)
+SCAN_PREFETCH_WORKERS = config("SCAN_PREFETCH_WORKERS", default=2, cast=int)
+SCAN_PREFETCH_TIMEOUT = config("SCAN_PREFETCH_TIMEOUT", default=60, cast=int)  # unclaimed work is cancelled after this
+SCAN_PREFETCH_WAIT = config("SCAN_PREFETCH_WAIT", default=10, cast=float)  # how long a scan waits for work in flight
+SCAN_WORKER_CONCURRENCY = config("SCAN_WORKER_CONCURRENCY", default=4, cast=int)
+SCAN_JOB_MAX_ATTEMPTS = config("SCAN_JOB_MAX_ATTEMPTS", default=3, cast=int)
+SCAN_JOB_RETRY_BACKOFF = config("SCAN_JOB_RETRY_BACKOFF", default=5, cast=int)  # seconds, doubled per attempt
+SCAN_JOB_LOCK_TIMEOUT = config("SCAN_JOB_LOCK_TIMEOUT", default=300, cast=int)
+# Stream LLM replies so the loading page can show the verdict early (Server-Sent Events)
+LLM_STREAMING = config("LLM_STREAMING", default=True, cast=bool)
+SCAN_PARTIAL_FLUSH_INTERVAL = config("SCAN_PARTIAL_FLUSH_INTERVAL", default=0.2, cast=float)
+SCAN_EVENTS_POLL_INTERVAL = config("SCAN_EVENTS_POLL_INTERVAL", default=0.2, cast=float)
+SCAN_EVENTS_TIMEOUT = config("SCAN_EVENTS_TIMEOUT", default=120, cast=int)
+# Per-worker-process cap on jobs inside each stage at once
+SCAN_STAGE_CONCURRENCY = {
+    "decoding": config("SCAN_DECODE_CONCURRENCY", default=4, cast=int),
+    "lookup": config("SCAN_LOOKUP_CONCURRENCY", default=8, cast=int),
+    "analyzing": config("SCAN_ANALYZE_CONCURRENCY", default=2, cast=int),
+}
+
+# Barcode decode passes, cheapest first (see scan/services/barcode_scanner.py)
+BARCODE_DECODE_PASSES = config("BARCODE_DECODE_PASSES", default="downscaled,full,rotated,binarized", cast=Csv())
+
+# Worker processes that decode photos (0 = one per core; lower it when several server processes share the host).
+# Past workers + DECODE_POOL_QUEUE_SIZE decodes in flight, scans are answered 429 and the page retries
+DECODE_POOL_ENABLED = config("DECODE_POOL_ENABLED", default=True, cast=bool)
+DECODE_POOL_WORKERS = config("DECODE_POOL_WORKERS", default=0, cast=int)
+DECODE_POOL_QUEUE_SIZE = config("DECODE_POOL_QUEUE_SIZE", default=16, cast=int)
+# Seconds a scan waits for its decode, queueing included, before it is answered 503
+DECODE_POOL_TIMEOUT = config("DECODE_POOL_TIMEOUT", default=10, cast=float)
+# Workers are replaced after this many decodes each, or once one's peak RSS passes DECODE_POOL_MAX_RSS_MB
+DECODE_POOL_MAX_TASKS = config("DECODE_POOL_MAX_TASKS", default=500, cast=int)
+DECODE_POOL_MAX_RSS_MB = config("DECODE_POOL_MAX_RSS_MB", default=512, cast=int)
+DECODE_POOL_START_METHOD = config("DECODE_POOL_START_METHOD", default="spawn")
+# Retry-After (seconds) sent with 429/503 answers when the decode pool is busy
+DECODE_POOL_RETRY_AFTER = config("DECODE_POOL_RETRY_AFTER", default=2, cast=int)
+
+# Batch scanning (several images / several barcodes per request)
+SCAN_BATCH_MAX_IMAGES = config("SCAN_BATCH_MAX_IMAGES", default=10, cast=int)
+SCAN_BATCH_LOOKUP_CONCURRENCY = config("SCAN_BATCH_LOOKUP_CONCURRENCY", default=8, cast=int)
+
+# Cache of parsed LLM verdicts per product and profile bucket
+ANALYSIS_CACHE_ENABLED = config("ANALYSIS_CACHE_ENABLED", default=True, cast=bool)
+ANALYSIS_CACHE_TTL = config("ANALYSIS_CACHE_TTL", default=30 * 24 * 3600, cast=int)
+ANALYSIS_CACHE_MAX_ENTRIES = config("ANALYSIS_CACHE_MAX_ENTRIES", default=50000, cast=int)
+# Eviction runs once per this many puts per process (0: only from clear_analysis_cache --evict)
+ANALYSIS_CACHE_EVICT_EVERY = config("ANALYSIS_CACHE_EVICT_EVERY", default=100, cast=int)
+ANALYSIS_CACHE_AGE_BAND = config("ANALYSIS_CACHE_AGE_BAND", default=10, cast=int)  # years
+ANALYSIS_CACHE_BMI_BAND = config("ANALYSIS_CACHE_BMI_BAND", default=2.5, cast=float)
+
+# Dietary guidance documents (PDF or text) retrieved into LLM prompts
+GUIDANCE_DOCUMENTS = config(
+    "GUIDANCE_DOCUMENTS",
+    default=str(BASE_DIR / "healthy-diet-fact-sheet-394.pdf"),
+    cast=Csv(),
+)
+GUIDANCE_CHUNK_WORDS = config("GUIDANCE_CHUNK_WORDS", default=120, cast=int)
+GUIDANCE_TOP_K = config("GUIDANCE_TOP_K", default=4, cast=int)
+GUIDANCE_TOKEN_BUDGET = config("GUIDANCE_TOKEN_BUDGET", default=500, cast=int)
+# tokenizer.json of the served model for exact prompt token counts (needs the
+# tokenizers package); empty uses a BPE-style estimate
+PROMPT_TOKENIZER = config("PROMPT_TOKENIZER", default="")
+# Prebuilt index written by `manage.py build_guidance`; workers mmap it when up to date
+GUIDANCE_ARTIFACT = config("GUIDANCE_ARTIFACT", default=str(BASE_DIR / "guidance.idx"))
+
+# Load decoders, the guidance index, rules, clients and templates when the app starts.
+# For pre-forking servers (gunicorn --preload) so workers share them copy-on-write
+SCAN_WARMUP = config("SCAN_WARMUP", default=False, cast=bool)
+
+# Prometheus endpoint (/metrics/) and a Server-Timing header listing each request's scan stages
+METRICS_ENABLED = config("METRICS_ENABLED", default=True, cast=bool)
+METRICS_TIMING_HEADER = config("METRICS_TIMING_HEADER", default=DEBUG, cast=bool)
+
+# Saved scans never change, so the result page's nutrition label is cached per scan id
+RESULT_LABEL_CACHE_TTL = config("RESULT_LABEL_CACHE_TTL", default=24 * 3600, cast=int)
+
+# Uploaded photos are content-addressed; the sweep_uploads command removes them
+# SCAN_UPLOAD_TTL seconds after last use and forgets their decoded barcode later
+SCAN_UPLOAD_TTL = config("SCAN_UPLOAD_TTL", default=3600, cast=int)
+UPLOAD_DECODE_CACHE_TTL = config("UPLOAD_DECODE_CACHE_TTL", default=30 * 24 * 3600, cast=int)
+SCAN_SWEEP_BATCH_SIZE = config("SCAN_SWEEP_BATCH_SIZE", default=500, cast=int)
+
+# Scans per page on the history page and API
+SCAN_HISTORY_PAGE_SIZE = config("SCAN_HISTORY_PAGE_SIZE", default=20, cast=int)
+
+# Rule-based verdicts for clear-cut products; the LLM only sees the rest
+ANALYSIS_RULES_ENABLED = config("ANALYSIS_RULES_ENABLED", default=True, cast=bool)
+ANALYSIS_RULES_FILE = config("ANALYSIS_RULES_FILE", default=str(BASE_DIR / "scan" / "rules" / "analysis_rules.json"))
+
+# LLM inference backends. TIMEOUT is in seconds; MAX_CONCURRENCY caps the
+# requests each process may have in flight against that backend.
+INFERENCE_BACKENDS = {
+    "huggingface": {
+        "CLASS": "scan.services.inference.HuggingFaceBackend",
+        "MODEL": config("HF_MODEL", default="meta-llama/Meta-Llama-3-8B-Instruct"),
+        "PROVIDER": config("HF_PROVIDER", default="novita"),
+        "API_KEY": config("HF_TOKEN", default=""),
+        "BASE_URL": config("HF_BASE_URL", default=""),
+        "TIMEOUT": config("HF_TIMEOUT", default=30, cast=float),
+        "MAX_CONCURRENCY": config("HF_MAX_CONCURRENCY", default=8, cast=int),
+        # response_format=json_schema; turn off for providers that reject it
+        "STRUCTURED_OUTPUT": config("HF_STRUCTURED_OUTPUT", default=True, cast=bool),
+    },
+    "ollama": {
+        "CLASS": "scan.services.inference.OllamaBackend",
+        "MODEL": config("OLLAMA_MODEL", default="llama3"),
+        "HOST": config("OLLAMA_HOST", default="http://localhost:11434"),
+        "TIMEOUT": config("OLLAMA_TIMEOUT", default=60, cast=float),
+        "MAX_CONCURRENCY": config("OLLAMA_MAX_CONCURRENCY", default=2, cast=int),
+        "STRUCTURED_OUTPUT": config("OLLAMA_STRUCTURED_OUTPUT", default=True, cast=bool),
+    },
+    "stub": {
+        "CLASS": "scan.services.inference.StubBackend",
+        "MODEL": "stub",
+        "MAX_CONCURRENCY": 64,
+    },
+}
+INFERENCE_BACKEND = config("INFERENCE_BACKEND", default="huggingface")
+# Used while the primary's circuit is open or it errors; empty disables fallback
+INFERENCE_FALLBACK_BACKEND = config("INFERENCE_FALLBACK_BACKEND", default="")
+INFERENCE_QUEUE_TIMEOUT = config("INFERENCE_QUEUE_TIMEOUT", default=5, cast=float)  # wait for a free slot
+INFERENCE_BREAKER_THRESHOLD = config("INFERENCE_BREAKER_THRESHOLD", default=5, cast=int)  # failures in a row
+INFERENCE_BREAKER_RESET = config("INFERENCE_BREAKER_RESET", default=30, cast=int)  # seconds open before a trial
+# Short "rewrite this as JSON" requests after a reply with no usable verdict
+ANALYSIS_PARSE_RETRIES = config("ANALYSIS_PARSE_RETRIES", default=1, cast=int)
+
+# Admission control in front of the LLM (see services/admission.py). Amounts are LLM
+# tokens, prompt plus reply. An analysis is charged ADMISSION_CALL_TOKENS up front and
+# settled at what it used. Buckets are per process: burst size and refill per minute.
+ADMISSION_ENABLED = config("ADMISSION_ENABLED", default=True, cast=bool)
+ADMISSION_CALL_TOKENS = config("ADMISSION_CALL_TOKENS", default=1200, cast=int)
+ADMISSION_GLOBAL_BURST = config("ADMISSION_GLOBAL_BURST", default=30000, cast=int)
+ADMISSION_GLOBAL_PER_MINUTE = config("ADMISSION_GLOBAL_PER_MINUTE", default=60000, cast=int)
+ADMISSION_USER_BURST = config("ADMISSION_USER_BURST", default=6000, cast=int)
+ADMISSION_USER_PER_MINUTE = config("ADMISSION_USER_PER_MINUTE", default=2400, cast=int)
+# Repeat scans (products the user scanned before) may not draw a bucket below this share of its burst
+ADMISSION_REPEAT_RESERVE = config("ADMISSION_REPEAT_RESERVE", default=0.5, cast=float)
+# Per user per day, kept in the InferenceUsage table; 0 means no daily limit
+ADMISSION_USER_DAILY_TOKENS = config("ADMISSION_USER_DAILY_TOKENS", default=40000, cast=int)
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
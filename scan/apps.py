@@ -1,6 +1,21 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 
 
 class ScanConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'scan'
+
+    def ready(self):
+        from .services.barcode_scanner import DECODE_PASSES
+        # A misspelt pass would otherwise yield no images and be skipped without a word
+        unknown = [name for name in settings.BARCODE_DECODE_PASSES if name not in DECODE_PASSES]
+        if unknown:
+            raise ImproperlyConfigured(
+                f"Unknown BARCODE_DECODE_PASSES {', '.join(unknown)}; expected some of {', '.join(DECODE_PASSES)}")
+
+        # Opt-in: only worth it in a server's master process before it forks workers
+        if settings.SCAN_WARMUP:
+            from .services import warmup
+            warmup.preload()
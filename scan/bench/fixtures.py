@@ -0,0 +1,242 @@
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EAN_L = ["0001101", "0011001", "0010011", "0111101", "0100011",
+         "0110001", "0101111", "0111011", "0110111", "0001011"]
+EAN_G = ["0100111", "0110011", "0011011", "0100001", "0011101",
+         "0111001", "0000101", "0010001", "0001001", "0010111"]
+EAN_R = ["1110010", "1100110", "1101100", "1000010", "1011100",
+         "1001110", "1010000", "1000100", "1001000", "1110100"]
+EAN_PARITY = ["LLLLLL", "LLGLGG", "LLGGLG", "LLGGGL", "LGLLGG",
+              "LGGLLG", "LGGGLL", "LGLGLG", "LGLGGL", "LGGLGL"]
+
+
+def ean13_check_digit(digits):
+    checksum = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits[:12]))
+    return str((10 - checksum % 10) % 10)
+
+
+def render_ean13(digits, module=2, height=150, canvas=None):
+    """Draw an EAN-13 barcode (12 or 13 digits) as a grayscale array, optionally centred on a larger canvas."""
+    # numpy and cv2 are imported on use: the fake servers here do not need the imaging stack
+    import numpy as np
+    digits = digits[:12]
+    digits += ean13_check_digit(digits)
+    parity = EAN_PARITY[int(digits[0])]
+    bits = "101"
+    bits += "".join((EAN_L if p == "L" else EAN_G)[int(d)] for p, d in zip(parity, digits[1:7]))
+    bits += "01010"
+    bits += "".join(EAN_R[int(d)] for d in digits[7:13])
+    bits += "101"
+    bits = "0" * 11 + bits + "0" * 11
+
+    row = np.array([0 if b == "1" else 255 for b in bits], dtype=np.uint8).repeat(module)
+    image = np.tile(row, (height, 1))
+    if canvas:
+        width, canvas_height = canvas
+        page = np.full((canvas_height, width), 255, dtype=np.uint8)
+        top, left = (canvas_height - image.shape[0]) // 2, (width - image.shape[1]) // 2
+        page[top:top + image.shape[0], left:left + image.shape[1]] = image
+        image = page
+    return image
+
+
+def render_upca(digits, **kwargs):
+    """A UPC-A barcode (11 or 12 digits): the same bars as EAN-13 with a leading 0."""
+    return render_ean13("0" + digits[:11], **kwargs)
+
+
+def photo(digits, size, symbology="ean13"):
+    """A barcode about half as wide as a white size=(width, height) canvas, like a phone photo."""
+    width, height = size
+    module = max(2, width // 2 // 113)
+    render = render_upca if symbology == "upca" else render_ean13
+    return render(digits, module=module, height=height // 3, canvas=size)
+
+
+def encode_png(image):
+    import cv2
+    ok, buffer = cv2.imencode('.png', image)
+    return buffer.tobytes()
+
+
+def off_product(barcode):
+    """The Open Food Facts record FakeOpenFoodFacts serves for any barcode."""
+    return {
+        "code": barcode,
+        "product_name": f"Bench product {barcode}",
+        "nutriscore_grade": "c",
+        "nutriscore_score": 5,
+        "nutriments": {"energy-kcal": 250, "fat": 9, "saturated-fat": 3.1, "carbohydrates": 32,
+                       "sugars": 12, "fiber": 3, "proteins": 8, "salt": 0.9, "sodium": 0.36},
+        "nutrient_levels": {"fat": "moderate", "saturated-fat": "moderate", "sugars": "moderate", "salt": "moderate"},
+        "image_url": "",
+    }
+
+
+# The nutriments of a typical Open Food Facts API record, as it arrives: every value
+# repeated as _100g/_serving/_value with _unit strings, plus scores that are not nutrients
+OFF_NUTRIMENTS = {
+    "energy": 1966, "energy_100g": 1966, "energy_serving": 590, "energy_unit": "kJ", "energy_value": 1966,
+    "energy-kj": 1966, "energy-kj_100g": 1966, "energy-kj_serving": 590, "energy-kj_unit": "kJ", "energy-kj_value": 1966,
+    "energy-kcal": 470, "energy-kcal_100g": 470, "energy-kcal_serving": 141, "energy-kcal_unit": "kcal",
+    "energy-kcal_value": 470,
+    "fat": 19, "fat_100g": 19, "fat_serving": 5.7, "fat_unit": "g", "fat_value": 19,
+    "saturated-fat": 2.3, "saturated-fat_100g": 2.3, "saturated-fat_serving": 0.69, "saturated-fat_unit": "g",
+    "saturated-fat_value": 2.3,
+    "trans-fat": 0, "trans-fat_100g": 0, "trans-fat_serving": 0, "trans-fat_unit": "g", "trans-fat_value": 0,
+    "carbohydrates": 63, "carbohydrates_100g": 63, "carbohydrates_serving": 18.9, "carbohydrates_unit": "g",
+    "carbohydrates_value": 63,
+    "sugars": 33, "sugars_100g": 33, "sugars_serving": 9.9, "sugars_unit": "g", "sugars_value": 33,
+    "fiber": 5.5, "fiber_100g": 5.5, "fiber_serving": 1.65, "fiber_unit": "g", "fiber_value": 5.5,
+    "proteins": 7.4, "proteins_100g": 7.4, "proteins_serving": 2.22, "proteins_unit": "g", "proteins_value": 7.4,
+    "salt": 0.58, "salt_100g": 0.58, "salt_serving": 0.174, "salt_unit": "g", "salt_value": 0.58,
+    "sodium": 0.232, "sodium_100g": 0.232, "sodium_serving": 0.0696, "sodium_unit": "g", "sodium_value": 0.232,
+    "calcium": 0.08, "calcium_100g": 0.08, "calcium_serving": 0.024, "calcium_unit": "mg", "calcium_value": 80,
+    "iron": 0.0024, "iron_100g": 0.0024, "iron_serving": 0.00072, "iron_unit": "mg", "iron_value": 2.4,
+    "cholesterol": 0, "cholesterol_100g": 0, "cholesterol_serving": 0, "cholesterol_unit": "mg", "cholesterol_value": 0,
+    "nova-group": 4, "nova-group_100g": 4, "nova-group_serving": 4,
+    "nutrition-score-fr": 18, "nutrition-score-fr_100g": 18,
+    "fruits-vegetables-nuts-estimate-from-ingredients_100g": 12.5,
+    "carbon-footprint-from-known-ingredients_100g": 37.8, "carbon-footprint-from-known-ingredients_product": 113,
+}
+
+
+class FakeOpenFoodFacts:
+    """
+    Local stand-in for the Open Food Facts product API. Every barcode is
+    known unless listed in missing; products maps barcodes to the records
+    to replay (off_product() otherwise), and latency() gives the seconds to
+    wait before each answer. Use as a context manager; api_url is a drop-in
+    for product_lookup.OPEN_FOOD_FACTS_API.
+    """
+    PATH = re.compile(r"^/api/v0/product/(\w+)\.json$")
+
+    def __init__(self, missing=(), products=None, latency=None):
+        fake = self
+        self.missing = set(missing)
+        self.products = products or {}
+        self.latency = latency
+        self.requests = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+            # Headers and body go out as separate writes; with Nagle on, a kept-alive
+            # connection waits for the client's delayed ACK (~40 ms) before the body
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                match = fake.PATH.match(self.path)
+                fake.requests += 1
+                if fake.latency:
+                    time.sleep(fake.latency())
+                if match is None:
+                    payload = {"status": 0}
+                    code = 404
+                elif match.group(1) in fake.missing:
+                    payload, code = {"status": 0, "status_verbose": "product not found"}, 200
+                else:
+                    barcode = match.group(1)
+                    product = fake.products.get(barcode) or off_product(barcode)
+                    payload, code = {"status": 1, "product": product}, 200
+                body = json.dumps(payload).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.api_url = f"http://127.0.0.1:{self.server.server_port}/api/v0/product/{{}}.json"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeInference:
+    """
+    Local OpenAI-compatible chat completion server (what HuggingFaceBackend
+    talks to through BASE_URL). Each request waits latency() seconds, then
+    fails with a 503 with probability error_rate, else answers a verdict
+    JSON, streamed when asked. Use as a context manager; url is the base URL.
+    """
+    REPLY = json.dumps({"advisability": "Yes", "summary": "Fine in normal portions as part of a balanced diet."})
+
+    def __init__(self, latency=None, error_rate=0.0, seed=None):
+        fake = self
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])) or b"{}")
+                with fake._lock:
+                    fake.requests += 1
+                    failed = fake.random.random() < fake.error_rate
+                    fake.errors += failed
+                if fake.latency:
+                    time.sleep(fake.latency())
+                if failed:
+                    self._send(503, "application/json", b'{"error": "overloaded"}')
+                elif request.get("stream"):
+                    self._stream()
+                else:
+                    completion = {"id": "fake", "object": "chat.completion", "created": 0, "model": "fake-llm",
+                                  "choices": [{"index": 0, "finish_reason": "stop",
+                                               "message": {"role": "assistant", "content": fake.REPLY}}]}
+                    self._send(200, "application/json", json.dumps(completion).encode())
+
+            def _send(self, code, content_type, body):
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                for start in range(0, len(fake.REPLY), 16):
+                    chunk = {"id": "fake", "object": "chat.completion.chunk", "created": 0, "model": "fake-llm",
+                             "choices": [{"index": 0, "finish_reason": None,
+                                          "delta": {"role": "assistant", "content": fake.REPLY[start:start + 16]}}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,303 @@
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from importlib import import_module
+from unittest.mock import patch
+import httpx
+from django.conf import settings
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler, get_internal_wsgi_application
+from django.db import connections
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from nutri.models import NutriUser
+from scan.models import AnalysisCacheEntry, CachedProduct, UploadedImage
+from scan.services import product_lookup
+from .fixtures import FakeInference, FakeOpenFoodFacts, ean13_check_digit, encode_png, photo
+
+# Client-side timings per scan; "total" runs from the scheduled arrival, so it includes queueing
+STAGES = ("upload", "process", "result", "total")
+SERVER_TIMING = re.compile(r"([\w-]+);dur=([\d.]+)")
+
+
+class LoadError(Exception):
+    """The load test could not be set up."""
+
+
+def percentiles(values):
+    ordered = sorted(values)
+    if not ordered:
+        return {"count": 0}
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, math.ceil(len(ordered) * fraction) - 1)], 3)
+    return {"count": len(ordered), "p50_ms": at(0.50), "p95_ms": at(0.95), "p99_ms": at(0.99),
+            "max_ms": round(ordered[-1], 3)}
+
+
+def lognormal(median_ms, sigma, rng):
+    """Seconds drawn from a log-normal latency distribution with the given median (ms) and spread."""
+    if median_ms <= 0:
+        return None
+    return lambda: rng.lognormvariate(math.log(median_ms / 1000), sigma)
+
+
+def load_off_records(path):
+    """Product records from an Open Food Facts JSONL export (one product per line); bad lines are skipped."""
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and record.get("product_name"):
+                records.append(record)
+    if not records:
+        raise LoadError(f"No product records in {path}")
+    return records
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadedWSGIServer):
+    # Room for every in-flight scan to connect at once
+    request_queue_size = 256
+
+
+class LoadEnvironment:
+    def __init__(self, base_url, off, llm, user, barcodes):
+        self.base_url = base_url
+        self.off = off
+        self.llm = llm
+        self.user = user
+        self.barcodes = barcodes
+        self.session_keys = []
+        self.filenames = set()
+
+    def new_session(self):
+        """A logged-in session of its own, so concurrent scans don't share latest_scan_id."""
+        store = import_module(settings.SESSION_ENGINE).SessionStore()
+        store["user_id"] = self.user.id
+        store.create()
+        self.session_keys.append(store.session_key)
+        return store.session_key
+
+
+@contextmanager
+def load_environment(products=50, off_records=None, off_latency_ms=50, llm_latency_ms=800,
+                     llm_latency_sigma=0.5, llm_error_rate=0.0, fallback="", analysis_cache=False, admission=False,
+                     seed=0):
+    """
+    The app on a local threaded WSGI server, in this process, with the
+    configured database, a temporary MEDIA_ROOT and the Hugging Face backend
+    pointed at a FakeInference. Open Food Facts is a FakeOpenFoodFacts that
+    serves `products` synthetic in-store barcodes (29...), replaying
+    off_records in turn when given. Everything the run wrote is deleted
+    afterwards, and the synthetic barcodes cannot collide with real ones.
+    """
+    rng = random.Random(seed)
+    run = f"{rng.randrange(10000):04d}"
+    barcodes = []
+    for index in range(products):
+        digits = f"29{run}{index:06d}"
+        barcodes.append(digits + ean13_check_digit(digits))
+    records = {}
+    for index, barcode in enumerate(barcodes if off_records else ()):
+        records[barcode] = dict(off_records[index % len(off_records)], code=barcode)
+    if CachedProduct.objects.filter(barcode__in=barcodes).exists():
+        raise LoadError("Synthetic barcodes already cached; pick another --seed")
+
+    backends = dict(settings.INFERENCE_BACKENDS)
+    directory = tempfile.mkdtemp(prefix="nutriscan-load-")
+    user = env = None
+    try:
+        with ExitStack() as stack:
+            off = stack.enter_context(FakeOpenFoodFacts(
+                products=records, latency=lognormal(off_latency_ms, 0.3, random.Random(seed + 1))))
+            llm = stack.enter_context(FakeInference(
+                latency=lognormal(llm_latency_ms, llm_latency_sigma, random.Random(seed + 2)),
+                error_rate=llm_error_rate, seed=seed + 3))
+            # Concurrency caps, timeouts and breakers stay as configured: they are part of what is measured
+            backends["huggingface"] = dict(backends["huggingface"], BASE_URL=llm.url, MODEL="fake-llm", API_KEY="")
+            stack.enter_context(patch.object(product_lookup, "OPEN_FOOD_FACTS_API", off.api_url))
+            stack.enter_context(override_settings(
+                MEDIA_ROOT=directory, ALLOWED_HOSTS=["127.0.0.1", "localhost"],
+                INFERENCE_BACKENDS=backends, INFERENCE_BACKEND="huggingface", INFERENCE_FALLBACK_BACKEND=fallback,
+                SCAN_BACKGROUND_JOBS=False, SCAN_ASYNC_PIPELINE=False, ANALYSIS_CACHE_ENABLED=analysis_cache,
+                ADMISSION_ENABLED=admission, METRICS_TIMING_HEADER=True,
+            ))
+            user = NutriUser.objects.create(
+                name="Load Test", email=f"load-{run}-{get_random_string(8)}@example.invalid", password="-",
+                age=35, gender="Female", health_conditions="None", weight=68, height=170,
+                dietary_preferences="None", goal="General health")
+
+            server = _Server(("127.0.0.1", 0), _QuietHandler, allow_reuse_address=False)
+            server.daemon_threads = True
+            server.set_app(get_internal_wsgi_application())
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            stack.callback(server.server_close)
+            stack.callback(server.shutdown)
+            env = LoadEnvironment(f"http://127.0.0.1:{server.server_port}", off, llm, user, barcodes)
+            yield env
+    finally:
+        if env is not None:
+            store = import_module(settings.SESSION_ENGINE).SessionStore
+            for session_key in env.session_keys:
+                store().delete(session_key)
+            UploadedImage.objects.filter(filename__in=env.filenames).delete()
+        if user is not None:
+            user.delete()
+        CachedProduct.objects.filter(barcode__in=barcodes).delete()
+        AnalysisCacheEntry.objects.filter(barcode__in=barcodes).delete()
+        connections.close_all()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def make_uploads(barcodes, scans, rng):
+    """One PNG per scan, each a different file (uploads are content-addressed) of a random pool barcode."""
+    images = []
+    for _ in range(scans):
+        image = photo(rng.choice(barcodes)[:12], (640, 480))
+        image[0, :8] = [rng.randrange(200, 256) for _ in range(8)]
+        images.append(encode_png(image))
+    return images
+
+
+def _no_cookies():
+    # Each request carries its own session cookie; never let responses set shared ones
+    return CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+
+
+async def _scan(client, env, image, session_key, arrived, record):
+    token = get_random_string(32)
+    headers = {"Cookie": f"{settings.SESSION_COOKIE_NAME}={session_key}; {settings.CSRF_COOKIE_NAME}={token}",
+               "X-CSRFToken": token}
+    timings = record["timings"]
+
+    started = time.perf_counter()
+    response = await client.post(reverse("scan"), headers=headers,
+                                 files={"image": ("photo.png", image, "image/png")})
+    timings["upload"] = (time.perf_counter() - started) * 1000
+    uploaded = response.json() if response.status_code == 200 else {"message": f"HTTP {response.status_code}"}
+    if uploaded.get("status") != "success":
+        record["error"] = f"upload: {uploaded.get('message')}"
+        return
+    env.filenames.add(uploaded["filename"])
+
+    started = time.perf_counter()
+    response = await client.get(reverse("process_scan", args=[uploaded["filename"]]), headers=headers)
+    timings["process"] = (time.perf_counter() - started) * 1000
+    record["server"] = {name: float(ms) for name, ms in SERVER_TIMING.findall(response.headers.get("Server-Timing", ""))}
+    processed = response.json() if response.status_code == 200 else {"message": f"HTTP {response.status_code}"}
+    if processed.get("status") != "success":
+        record["error"] = f"process: {processed.get('message')}"
+        return
+
+    started = time.perf_counter()
+    response = await client.get(reverse("result"), headers=headers)
+    timings["result"] = (time.perf_counter() - started) * 1000
+    if response.status_code != 200:
+        record["error"] = f"result: HTTP {response.status_code}"
+        return
+    timings["total"] = (time.perf_counter() - arrived) * 1000
+
+
+async def _drive(env, images, sessions, concurrency, rate, seed):
+    """
+    Closed loop (rate 0): `concurrency` users scanning back to back. Open
+    loop: Poisson arrivals at `rate` scans/s, at most `concurrency` in flight.
+    """
+    rng = random.Random(seed)
+    slots = asyncio.Semaphore(concurrency)
+    records = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=env.base_url, timeout=120, limits=limits, cookies=_no_cookies()) as client:
+        async def one(image, session_key):
+            arrived = time.perf_counter()
+            record = {"timings": {}, "server": {}, "error": None}
+            records.append(record)
+            async with slots:
+                if not rate:
+                    # Closed loop: a user starts when the previous scan ends, so there is no queue to count
+                    arrived = time.perf_counter()
+                try:
+                    await _scan(client, env, image, session_key, arrived, record)
+                except httpx.HTTPError as e:
+                    record["error"] = f"{type(e).__name__}: {e}"
+
+        tasks = []
+        for image, session_key in zip(images, sessions):
+            if rate:
+                await asyncio.sleep(rng.expovariate(rate))
+            tasks.append(asyncio.create_task(one(image, session_key)))
+        await asyncio.gather(*tasks)
+    return records
+
+
+def run_load(scans=200, concurrency=8, rate=0.0, seed=0, **environment):
+    """Run the load test and return a results dict (see summarize_records) with the run's settings in meta."""
+    rng = random.Random(seed)
+    with load_environment(seed=seed, **environment) as env:
+        images = make_uploads(env.barcodes, scans, rng)
+        sessions = [env.new_session() for _ in range(scans)]
+        started = time.perf_counter()
+        records = asyncio.run(_drive(env, images, sessions, concurrency, rate, seed))
+        elapsed = time.perf_counter() - started
+        upstream = {"off_requests": env.off.requests, "llm_requests": env.llm.requests, "llm_errors": env.llm.errors}
+    results = summarize_records(records, elapsed)
+    results["upstream"] = upstream
+    results["meta"] = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "database": settings.DATABASES["default"]["ENGINE"].rsplit(".", 1)[-1],
+        "created": timezone.now().isoformat(timespec="seconds"),
+        "scans": scans, "concurrency": concurrency, "rate": rate, "seed": seed, **environment,
+    }
+    results["meta"].pop("off_records", None)
+    return results
+
+
+def summarize_records(records, elapsed):
+    ok = [record for record in records if record["error"] is None]
+    errors = {}
+    for record in records:
+        if record["error"] is not None:
+            # Upstream errors can run to several lines; group them by the first
+            message = record["error"].splitlines()[0][:160]
+            errors[message] = errors.get(message, 0) + 1
+    server_stages = sorted({name for record in ok for name in record["server"]})
+    return {
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput": round(len(ok) / elapsed, 3) if elapsed else 0.0,
+        "scans": {"ok": len(ok), "failed": len(records) - len(ok), "errors": errors},
+        "stages": {stage: percentiles([record["timings"][stage] for record in ok]) for stage in STAGES},
+        "server_stages": {name: percentiles([record["server"][name] for record in ok if name in record["server"]])
+                          for name in server_stages},
+    }
+
+
+def compare(current, baseline):
+    """(name, baseline, current) p95 for every client and server stage, after the throughput."""
+    rows = [("throughput/s", baseline.get("throughput"), current["throughput"])]
+    for section, prefix in (("stages", ""), ("server_stages", "server ")):
+        for name, stats in current[section].items():
+            before = baseline.get(section, {}).get(name, {}).get("p95_ms")
+            rows.append((prefix + name, before, stats.get("p95_ms")))
+    return rows
@@ -0,0 +1,256 @@
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager, ExitStack
+from unittest.mock import patch
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils.crypto import get_random_string
+from django.utils import timezone
+
+from nutri.models import NutriUser
+from scan.models import ProductScan
+from scan.services import barcode_scanner, guidance, nutrition, product_lookup
+from .fixtures import FakeOpenFoodFacts, ean13_check_digit, encode_png, off_product, photo
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+SAMPLE_GUIDANCE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "fixtures", "guidance_sample.txt")
+
+# Differences below this many milliseconds are timer noise, whatever the ratio
+MIN_REGRESSION_MS = 0.5
+
+# name -> factory(env, runs) returning the callable timed once per run, or None to skip the stage
+STAGES = {}
+
+
+class BenchError(Exception):
+    """A stage produced a wrong answer, so its timing means nothing."""
+
+
+def stage(name):
+    def register(factory):
+        STAGES[name] = factory
+        return factory
+    return register
+
+
+class BenchEnvironment:
+    def __init__(self, directory, off, pdf_documents):
+        self.directory = directory
+        self.off = off
+        self.pdf_documents = pdf_documents
+        self.user = NutriUser.objects.create(
+            name="Bench User", email=f"bench-{get_random_string(8)}@example.invalid", password="-", age=35, gender="Female",
+            health_conditions="None", weight=68, height=170, dietary_preferences="None", goal="General health")
+        self.client = Client()
+        session = self.client.session
+        session["user_id"] = self.user.id
+        session.save()
+        self._barcodes = 0
+
+    def next_barcode(self):
+        """A fresh valid EAN-13, so caches keyed on the barcode or the image never hit."""
+        self._barcodes += 1
+        digits = f"2{self._barcodes:011d}"
+        return digits + ean13_check_digit(digits)
+
+    def write_image(self, name, image):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(encode_png(image))
+        return path
+
+
+@contextmanager
+def bench_environment():
+    """
+    A temporary media folder, a local fake Open Food Facts, the stub LLM and a
+    throwaway user. Everything written to the database is rolled back.
+    """
+    pdf_documents = [path for path in settings.GUIDANCE_DOCUMENTS if path.lower().endswith(".pdf") and os.path.exists(path)]
+    directory = tempfile.mkdtemp(prefix="nutriscan-bench-")
+    try:
+        with ExitStack() as stack:
+            off = stack.enter_context(FakeOpenFoodFacts())
+            stack.enter_context(patch.object(product_lookup, "OPEN_FOOD_FACTS_API", off.api_url))
+            stack.enter_context(override_settings(
+                MEDIA_ROOT=directory, ALLOWED_HOSTS=["testserver"],
+                INFERENCE_BACKEND="stub", INFERENCE_FALLBACK_BACKEND="",
+                SCAN_BACKGROUND_JOBS=False, SCAN_ASYNC_PIPELINE=False, SCAN_PREFETCH_ENABLED=False,
+                ANALYSIS_CACHE_ENABLED=False, RESULT_LABEL_CACHE_TTL=0,
+                GUIDANCE_DOCUMENTS=[SAMPLE_GUIDANCE], GUIDANCE_ARTIFACT="",
+            ))
+            with transaction.atomic():
+                try:
+                    yield BenchEnvironment(directory, off, pdf_documents)
+                finally:
+                    transaction.set_rollback(True)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _expect(value, expected, what):
+    if value != expected:
+        raise BenchError(f"{what}: expected {expected!r}, got {value!r}")
+    return value
+
+
+SAMPLE_CODES = {"ean13": "590123412345", "upca": "03600029145"}
+
+
+def _decode_stage(symbology, size):
+    def factory(env, runs):
+        digits = SAMPLE_CODES[symbology]
+        ean = "0" + digits if symbology == "upca" else digits
+        ean += ean13_check_digit(ean)
+        # Decoders report UPC-A with or without the leading 0
+        accepted = {ean, ean[1:]} if symbology == "upca" else {ean}
+        path = env.write_image(f"{symbology}-{size[0]}x{size[1]}.png", photo(digits, size, symbology))
+
+        def run():
+            barcode = barcode_scanner.scan_barcode(path)
+            if barcode not in accepted:
+                raise BenchError(f"decode {symbology} {size[0]}x{size[1]}: got {barcode!r}")
+        return run
+    return factory
+
+
+for _symbology, _size in [("ean13", (640, 480)), ("ean13", (1920, 1080)), ("ean13", (4032, 3024)), ("upca", (1280, 720))]:
+    stage(f"decode_{_symbology}_{_size[0]}x{_size[1]}")(_decode_stage(_symbology, _size))
+
+
+@stage("lookup_remote")
+def _lookup_remote(env, runs):
+    def run():
+        product = product_lookup.fetch_product_data(env.next_barcode())
+        _expect(product is not None, True, "remote lookup")
+    return run
+
+
+@stage("lookup_cached")
+def _lookup_cached(env, runs):
+    barcode = env.next_barcode()
+    product_lookup.fetch_product_data(barcode)
+    return lambda: _expect(product_lookup.fetch_product_data(barcode)["product_name"],
+                           f"Bench product {barcode}", "cached lookup")
+
+
+@stage("generate_prompt")
+def _generate_prompt(env, runs):
+    product = off_product(env.next_barcode())
+    user = env.user
+    knowledge = guidance.relevant_guidance(product, user.health_conditions, user.goal)
+    return lambda: nutrition.generate_prompt(user.age, user.weight, user.height, user.bmi, user.health_conditions,
+                                             user.dietary_preferences, user.goal, product, knowledge)
+
+
+@stage("extract_pdf_text")
+def _extract_pdf_text(env, runs):
+    if not env.pdf_documents:
+        return None
+    path = env.pdf_documents[0]
+    def run():
+        guidance._pdf_cache.clear()
+        guidance.extract_pdf_text(path)
+    return run
+
+
+@stage("result_render")
+def _result_render(env, runs):
+    product = off_product(env.next_barcode())
+    scan = ProductScan.objects.create(
+        user=env.user, barcode=product["code"], product_name=product["product_name"], scan_date=timezone.now(),
+        nutriscore_grade="C", nutriments=product["nutriments"], advisability="Yes",
+        analysis_result="Fine in moderation. Watch the salt. Pair it with vegetables.")
+    url = reverse("scan_result", args=[scan.id])
+    return lambda: _expect(env.client.get(url).status_code, 200, "result page")
+
+
+@stage("full_flow")
+def _full_flow(env, runs):
+    """Upload, process inline with the stub LLM, then the result page: one scan per run."""
+    uploads = []
+    for _ in range(runs):
+        barcode = env.next_barcode()
+        uploads.append((barcode, encode_png(photo(barcode[:12], (640, 480)))))
+    uploads.reverse()
+
+    def run():
+        barcode, data = uploads.pop()
+        uploaded = env.client.post(reverse("scan"), {"image": SimpleUploadedFile("photo.png", data, "image/png")}).json()
+        _expect(uploaded["status"], "success", f"upload: {uploaded.get('message')}")
+        filename = uploaded["filename"]
+        processed = env.client.get(reverse("process_scan", args=[filename])).json()
+        _expect(processed["status"], "success", f"process {barcode}: {processed.get('message')}")
+        _expect(env.client.get(reverse("result")).status_code, 200, "result page")
+    return run
+
+
+def measure(fn, iterations, warmup=1):
+    """Milliseconds per call for each of iterations calls, after warmup untimed calls."""
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def summarize(timings):
+    ordered = sorted(timings)
+    return {
+        "median_ms": round(statistics.median(ordered), 3),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        "min_ms": round(ordered[0], 3),
+        "iterations": len(ordered),
+    }
+
+
+def run_suite(names=None, iterations=20, warmup=1):
+    """Run the named stages (all by default) and return a baseline-shaped dict."""
+    unknown = set(names or ()) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+    results = {}
+    with bench_environment() as env:
+        for name, factory in STAGES.items():
+            if names and name not in names:
+                continue
+            fn = factory(env, iterations + warmup)
+            if fn is None:
+                continue
+            results[name] = summarize(measure(fn, iterations, warmup))
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "created": timezone.now().isoformat(timespec="seconds"),
+        },
+        "stages": results,
+    }
+
+
+def compare(current, baseline, threshold):
+    """
+    (stage, baseline_ms, current_ms, status) per stage, comparing medians.
+    status is "regressed" when current is more than threshold (a fraction)
+    slower and by at least MIN_REGRESSION_MS, "new" without a baseline.
+    """
+    rows = []
+    for name, stats in current["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if base is None:
+            rows.append((name, None, stats["median_ms"], "new"))
+            continue
+        before, now = base["median_ms"], stats["median_ms"]
+        regressed = now > before * (1 + threshold) and now - before >= MIN_REGRESSION_MS
+        rows.append((name, before, now, "regressed" if regressed else "ok"))
+    return rows
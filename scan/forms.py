@@ -1,4 +1,43 @@
 from django import forms
 
+from .services import history
+
 class ScanForm(forms.Form):
-    image = forms.ImageField()
\ No newline at end of file
+    image = forms.ImageField()
+
+class MultipleImageInput(forms.ClearableFileInput):
+    allow_multiple_selected = True
+
+
+class MultipleImageField(forms.ImageField):
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("widget", MultipleImageInput())
+        super().__init__(*args, **kwargs)
+
+    def clean(self, data, initial=None):
+        single_file_clean = super().clean
+        if isinstance(data, (list, tuple)):
+            return [single_file_clean(d, initial) for d in data]
+        return [single_file_clean(data, initial)]
+
+
+class BatchScanForm(forms.Form):
+    images = MultipleImageField()
+
+
+class HistoryFilterForm(forms.Form):
+    q = forms.CharField(required=False, max_length=100, label="Product name")
+    barcode = forms.CharField(required=False, max_length=50)
+    date_from = forms.DateField(required=False, widget=forms.DateInput(attrs={"type": "date"}))
+    date_to = forms.DateField(required=False, widget=forms.DateInput(attrs={"type": "date"}))
+    cursor = forms.CharField(required=False, widget=forms.HiddenInput)
+    limit = forms.IntegerField(required=False, min_value=1, max_value=100, widget=forms.HiddenInput)
+
+    def clean_cursor(self):
+        cursor = self.cleaned_data["cursor"]
+        if cursor:
+            try:
+                history.decode_cursor(cursor)
+            except ValueError:
+                raise forms.ValidationError("Invalid page cursor.")
+        return cursor
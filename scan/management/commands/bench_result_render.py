@@ -0,0 +1,85 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.template import Context, Template
+
+from scan.services import nutrients
+
+# The nutrition label as result.html rendered it before the nutrient registry:
+# a pipe/colon string split in the template and looked up with get_item
+LEGACY_NUTRIENT_MAP = "|".join(f"{nutrient.keys[-1]}:{nutrient.label}" for nutrient in nutrients.NUTRIENTS)
+LEGACY_LABEL = """{% load custom_filters %}
+<div class="nutrition-row">
+    <span class="label">Calories</span>
+    <span class="value">{{ product.nutriments|get_item:'energy-kcal'|default:'N/A' }} kcal</span>
+</div>
+{% with nutrients=nutrient_map|split:'|' %}
+{% for nutrient in nutrients %}
+    {% with parts=nutrient|split:':' %}
+        {% with key=parts.0 name=parts.1 %}
+            {% if product.nutriments|get_item:key %}
+                <div class="nutrition-row">
+                    <span class="label">{{ name }}</span>
+                    <span class="value">
+                        {{ product.nutriments|get_item:key }}
+                        {% if key == 'energy' or key == 'energy-kcal' %}kcal{% else %}g{% endif %}
+                    </span>
+                </div>
+            {% endif %}
+        {% endwith %}
+    {% endwith %}
+{% endfor %}
+{% endwith %}"""
+
+REGISTRY_LABEL = """{% with label=nutrition_label %}{% include 'scan/nutrition_label.html' %}{% endwith %}"""
+CACHED_LABEL = """{% load cache %}{% cache 300 bench_label scan_id %}""" + REGISTRY_LABEL + """{% endcache %}"""
+
+# A typical Open Food Facts product after nutrients.compact()
+SAMPLE_NUTRIMENTS = {
+    "energy": 1966, "energy-kcal": 470, "fat": 19, "saturated-fat": 2.3, "monounsaturated-fat": 11,
+    "polyunsaturated-fat": 5.2, "carbohydrates": 63, "sugars": 33, "fiber": 5.5, "proteins": 7.4,
+    "salt": 0.58, "sodium": 0.232, "calcium": 0.08, "iron": 0.0024, "vitamin-e": 0.0045,
+    "magnesium": 0.06, "potassium": 0.25, "phosphorus": 0.12, "energy-kcal_serving": 141,
+    "sugars_serving": 9.9, "fat_serving": 5.7, "nova-group": 4, "fruits-vegetables-nuts-estimate": 12,
+}
+
+
+class Command(BaseCommand):
+    help = ("Time the result page's nutrition label: the old split/get_item template, "
+            "the nutrient registry, and the registry behind the per-scan fragment cache.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=2000)
+
+    def _time(self, template, context_factory, iterations):
+        template.render(context_factory())  # warm up (and fill the cache)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            template.render(context_factory())
+        return (time.perf_counter() - started) / iterations * 1e6
+
+    def handle(self, *args, **options):
+        iterations = options["iterations"]
+        product = {"nutriments": SAMPLE_NUTRIMENTS}
+
+        results = {
+            "legacy split/get_item": self._time(
+                Template(LEGACY_LABEL),
+                lambda: Context({"product": product, "nutrient_map": LEGACY_NUTRIENT_MAP}),
+                iterations),
+            "nutrient registry": self._time(
+                Template(REGISTRY_LABEL),
+                lambda: Context({"nutrition_label": lambda: nutrients.nutrition_label(SAMPLE_NUTRIMENTS)}),
+                iterations),
+            "registry + fragment cache": self._time(
+                Template(CACHED_LABEL),
+                lambda: Context({"scan_id": 0, "nutrition_label": lambda: nutrients.nutrition_label(SAMPLE_NUTRIMENTS)}),
+                iterations),
+        }
+
+        baseline = results["legacy split/get_item"]
+        self.stdout.write(f"{len(nutrients.NUTRIENTS)} registry nutrients, "
+                          f"{len(SAMPLE_NUTRIMENTS)} nutriments, {iterations} renders each\n")
+        self.stdout.write(f"{'variant':<28}{'us/render':>12}{'speedup':>10}")
+        for name, micros in results.items():
+            self.stdout.write(f"{name:<28}{micros:>12.1f}{baseline / micros:>9.1f}x")
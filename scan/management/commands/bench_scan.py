@@ -0,0 +1,66 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from scan.bench import suite
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the scan hot path (decode, product lookup, prompt, PDF text, result page "
+            "and the whole upload-to-result flow) against a fake Open Food Facts and the stub LLM. "
+            "--save writes a JSON baseline (only the --stage ones when given); --compare fails when a stage's median regresses past --threshold.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=20)
+        parser.add_argument("--stage", action="append", dest="stages", choices=sorted(suite.STAGES),
+                            help="Only run this stage (repeatable)")
+        parser.add_argument("--baseline", default=suite.BASELINE_PATH, help="Baseline JSON file")
+        parser.add_argument("--save", action="store_true", help="Write the results to --baseline")
+        parser.add_argument("--compare", action="store_true", help="Compare the results with --baseline")
+        parser.add_argument("--threshold", type=float, default=0.25,
+                            help="Allowed slowdown of a stage's median, as a fraction (0.25 = 25%%)")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["compare"]:
+            try:
+                with open(options["baseline"]) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Cannot read baseline {options['baseline']}: {e}")
+
+        try:
+            results = suite.run_suite(options["stages"], iterations=options["iterations"])
+        except suite.BenchError as e:
+            raise CommandError(str(e))
+
+        if baseline is None:
+            self.stdout.write(f"{'stage':<26}{'median ms':>12}{'p95 ms':>10}{'min ms':>10}")
+            for name, stats in results["stages"].items():
+                self.stdout.write(f"{name:<26}{stats['median_ms']:>12.2f}{stats['p95_ms']:>10.2f}{stats['min_ms']:>10.2f}")
+        else:
+            rows = suite.compare(results, baseline, options["threshold"])
+            self.stdout.write(f"{'stage':<26}{'baseline ms':>12}{'now ms':>10}{'change':>9}  status")
+            for name, before, now, status in rows:
+                change = f"{(now - before) / before:+.0%}" if before else "-"
+                before = f"{before:.2f}" if before is not None else "-"
+                self.stdout.write(f"{name:<26}{before:>12}{now:>10.2f}{change:>9}  {status}")
+
+        if options["save"]:
+            if options["stages"]:
+                # Re-record only the chosen stages and keep the rest of the baseline
+                try:
+                    with open(options["baseline"]) as f:
+                        saved = json.load(f)
+                except (OSError, ValueError):
+                    saved = {}
+                results = dict(results, stages=dict(saved.get("stages", {}), **results["stages"]))
+            with open(options["baseline"], "w") as f:
+                json.dump(results, f, indent=2)
+                f.write("\n")
+            self.stdout.write(f"\nBaseline written to {options['baseline']}")
+
+        if baseline is not None:
+            regressed = [row[0] for row in rows if row[3] == "regressed"]
+            if regressed:
+                raise CommandError(f"Regressed past {options['threshold']:.0%}: {', '.join(regressed)}")
@@ -0,0 +1,29 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from scan.services import guidance
+
+
+class Command(BaseCommand):
+    help = ("Extract, chunk and index the dietary guidance documents into the "
+            "memory-mapped artifact web workers load (settings.GUIDANCE_ARTIFACT).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default=None, help="Artifact path (defaults to GUIDANCE_ARTIFACT)")
+
+    def handle(self, *args, **options):
+        output = options["output"] or settings.GUIDANCE_ARTIFACT
+        paths = list(settings.GUIDANCE_DOCUMENTS)
+        missing = [path for path in paths if not os.path.exists(path)]
+        if missing:
+            raise CommandError(f"Guidance documents not found: {', '.join(missing)}")
+
+        index = guidance.build_index(paths)
+        guidance.write_artifact(index, paths, output)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {output}: {len(paths)} documents, {len(index.chunks)} chunks, "
+            f"{len(index.postings)} terms, {os.path.getsize(output)} bytes"
+        ))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from scan.services import analysis_cache
+
+
+class Command(BaseCommand):
+    help = ("Invalidate cached LLM verdicts, optionally only those from one model or prompt version. "
+            "--evict instead trims the cache to ANALYSIS_CACHE_MAX_ENTRIES, least recently used first.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--model", help="Only entries produced by this model name")
+        parser.add_argument("--prompt-version", help="Only entries produced by this prompt version")
+        parser.add_argument("--evict", action="store_true", help="Only drop entries beyond the size limit")
+
+    def handle(self, *args, **options):
+        if options["evict"]:
+            evicted = analysis_cache.evict()
+            self.stdout.write(self.style.SUCCESS(f"Evicted {evicted} cached analyses"))
+            return
+        deleted = analysis_cache.invalidate(
+            model_name=options["model"],
+            prompt_version=options["prompt_version"],
+        )
+        self.stdout.write(self.style.SUCCESS(f"Removed {deleted} cached analyses"))
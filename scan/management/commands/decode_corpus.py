@@ -0,0 +1,75 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from scan.services import barcode_scanner
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+class Command(BaseCommand):
+    help = ("Run every barcode decode pass over a folder of real photos and report "
+            "hit rate and cost per pass, to tune BARCODE_DECODE_PASSES.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", help="Folder of barcode photos")
+
+    def handle(self, *args, **options):
+        directory = options["directory"]
+        if not os.path.isdir(directory):
+            raise CommandError(f"{directory} is not a directory")
+
+        files = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        if not files:
+            raise CommandError(f"No images found in {directory}")
+
+        passes = barcode_scanner.DECODE_PASSES
+        hits = {name: 0 for name in passes}
+        seconds = {name: 0.0 for name in passes}
+        first_hit = {name: 0 for name in settings.BARCODE_DECODE_PASSES}
+        unreadable = missed = 0
+        pipeline_seconds = 0.0
+
+        for path in files:
+            with open(path, "rb") as f:
+                gray = barcode_scanner.load_grayscale(f.read())
+            if gray is None:
+                unreadable += 1
+                continue
+
+            # Each pass on its own, so passes can be compared
+            for name in passes:
+                started = time.perf_counter()
+                found = barcode_scanner.run_pass(name, gray)
+                seconds[name] += time.perf_counter() - started
+                if found:
+                    hits[name] += 1
+
+            # The configured order, as the scan flow runs it
+            started = time.perf_counter()
+            _, winner = barcode_scanner.decode_image(gray)
+            pipeline_seconds += time.perf_counter() - started
+            if winner:
+                first_hit[winner] += 1
+            else:
+                missed += 1
+
+        decoded = len(files) - unreadable
+        self.stdout.write(f"{len(files)} images, {unreadable} unreadable\n")
+        self.stdout.write(f"{'pass':<12}{'hits':>8}{'hit rate':>10}{'avg ms':>10}")
+        for name in passes:
+            rate = hits[name] / decoded if decoded else 0
+            avg_ms = seconds[name] / decoded * 1000 if decoded else 0
+            self.stdout.write(f"{name:<12}{hits[name]:>8}{rate:>10.0%}{avg_ms:>10.1f}")
+
+        self.stdout.write(f"\nConfigured order {','.join(settings.BARCODE_DECODE_PASSES)}:")
+        for name, count in first_hit.items():
+            self.stdout.write(f"  won by {name:<12}{count:>6}")
+        self.stdout.write(f"  not decoded{missed:>13}")
+        if decoded:
+            self.stdout.write(f"  avg {pipeline_seconds / decoded * 1000:.1f} ms per image")
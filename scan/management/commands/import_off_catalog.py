@@ -0,0 +1,164 @@
+import csv
+import gzip
+import json
+import sys
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from scan.models import CatalogProduct
+from scan.services.product_lookup import product_from_off
+
+UPDATE_FIELDS = [
+    "product_name", "nutriscore_grade", "nutriscore_score",
+    "nutriments", "nutrient_levels", "image_url", "last_modified_t",
+]
+
+
+def _open(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, "r", encoding="utf-8", newline="")
+
+
+def _to_number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return int(number) if number.is_integer() else number
+
+
+def read_jsonl(handle):
+    """
+    Yield OFF product records from a JSON Lines export, one line at a time.
+    Unparseable lines come through as empty records so they are counted as skipped.
+    """
+    for line in handle:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = {}
+        yield record if isinstance(record, dict) else {}
+
+
+def read_csv(handle):
+    """
+    Yield OFF product records from the tab-separated CSV export. Nutrient
+    columns ("sugars_100g", ...) are folded back into a nutriments dict.
+    """
+    csv.field_size_limit(sys.maxsize)
+    for row in csv.DictReader(handle, delimiter="\t"):
+        nutriments = {}
+        for column, value in row.items():
+            if column and column.endswith("_100g") and value not in (None, ""):
+                number = _to_number(value)
+                if number is not None:
+                    nutriments[column] = number
+                    nutriments[column[:-len("_100g")]] = number
+        yield {
+            "code": row.get("code"),
+            "product_name": row.get("product_name"),
+            "nutriscore_grade": row.get("nutriscore_grade"),
+            "nutriscore_score": row.get("nutriscore_score"),
+            "image_url": row.get("image_url"),
+            "last_modified_t": row.get("last_modified_t"),
+            "nutriments": nutriments,
+        }
+
+
+def to_catalog_product(record):
+    barcode = (record.get("code") or "").strip()
+    if not barcode or len(barcode) > 50:
+        return None
+    product = product_from_off(record)
+    return CatalogProduct(
+        barcode=barcode,
+        product_name=product["product_name"][:255],
+        nutriscore_grade=product["nutriscore_grade"][:5],
+        nutriscore_score=_to_number(product["nutriscore_score"]) or 0,
+        nutriments=product["nutriments"],
+        nutrient_levels=product["nutrient_levels"],
+        image_url=product["image_url"][:500],
+        last_modified_t=_to_number(record.get("last_modified_t")) or 0,
+    )
+
+
+class Command(BaseCommand):
+    help = "Stream an Open Food Facts JSONL or CSV export (optionally .gz) into the local product catalog."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Path to the OFF export")
+        parser.add_argument("--format", choices=["jsonl", "csv"],
+                            help="Export format (guessed from the file name by default)")
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Rows read and written per transaction")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"] or ("csv" if ".csv" in path else "jsonl")
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("--batch-size must be positive")
+
+        totals = {"created": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+        try:
+            with _open(path) as handle:
+                records = read_csv(handle) if fmt == "csv" else read_jsonl(handle)
+                while True:
+                    batch = list(islice(records, batch_size))
+                    if not batch:
+                        break
+                    for key, count in self._import_batch(batch).items():
+                        totals[key] += count
+        except OSError as e:
+            raise CommandError(f"Could not read {path}: {e}")
+
+        self.stdout.write(self.style.SUCCESS(
+            "Catalog import done: {created} created, {updated} updated, "
+            "{unchanged} unchanged, {skipped} skipped".format(**totals)
+        ))
+
+    def _import_batch(self, records):
+        counts = {"created": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+
+        # Last record wins when a barcode repeats inside one batch
+        incoming = {}
+        for record in records:
+            item = to_catalog_product(record)
+            if item is None:
+                counts["skipped"] += 1
+                continue
+            incoming[item.barcode] = item
+
+        existing = {
+            barcode: (pk, modified)
+            for barcode, pk, modified in CatalogProduct.objects
+            .filter(barcode__in=list(incoming))
+            .values_list("barcode", "pk", "last_modified_t")
+        }
+
+        to_create, to_update = [], []
+        for barcode, item in incoming.items():
+            if barcode not in existing:
+                to_create.append(item)
+                continue
+            pk, modified = existing[barcode]
+            # Incremental re-import: only rows OFF changed since the last run
+            if item.last_modified_t and item.last_modified_t <= modified:
+                counts["unchanged"] += 1
+                continue
+            item.pk = pk
+            to_update.append(item)
+
+        with transaction.atomic():
+            CatalogProduct.objects.bulk_create(to_create)
+            CatalogProduct.objects.bulk_update(to_update, UPDATE_FIELDS)
+
+        counts["created"] = len(to_create)
+        counts["updated"] = len(to_update)
+        return counts
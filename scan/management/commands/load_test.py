@@ -0,0 +1,84 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from scan.bench import load
+
+
+class Command(BaseCommand):
+    help = ("Load-test the upload -> process -> result flow on a local server in this process, with a fake "
+            "Open Food Facts and a fake LLM of configurable latency and error rate. Runs offline. Reports "
+            "throughput and p50/p95/p99 per stage; --save/--compare keep results between runs. Uses the "
+            "configured database (and deletes what it wrote), so point it at a development database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scans", type=int, default=200, help="Scans to run in total")
+        parser.add_argument("--concurrency", type=int, default=8, help="Scans in flight at most")
+        parser.add_argument("--rate", type=float, default=0.0,
+                            help="Poisson arrivals per second (open loop); 0 runs --concurrency users back to back")
+        parser.add_argument("--products", type=int, default=50, help="Distinct barcodes scanned")
+        parser.add_argument("--off-records", help="Open Food Facts JSONL whose records the fake replays")
+        parser.add_argument("--off-latency-ms", type=float, default=50, help="Median fake Open Food Facts latency")
+        parser.add_argument("--llm-latency-ms", type=float, default=800, help="Median fake LLM latency")
+        parser.add_argument("--llm-latency-sigma", type=float, default=0.5,
+                            help="Spread of the log-normal LLM latency (0.5 puts p95 at about 2.3x the median)")
+        parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Fraction of LLM calls answering 503")
+        parser.add_argument("--fallback", default="", help="INFERENCE_FALLBACK_BACKEND for the run, e.g. stub")
+        parser.add_argument("--analysis-cache", action="store_true", help="Keep the analysis cache on")
+        parser.add_argument("--admission", action="store_true",
+                            help="Keep LLM admission control on (every scan is by one synthetic user)")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--save", help="Write the results as JSON to this file")
+        parser.add_argument("--compare", help="Show p95 changes against results saved earlier")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["compare"]:
+            try:
+                with open(options["compare"]) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Cannot read {options['compare']}: {e}")
+        if options["scans"] < 1 or options["concurrency"] < 1:
+            raise CommandError("--scans and --concurrency must be at least 1")
+
+        try:
+            off_records = load.load_off_records(options["off_records"]) if options["off_records"] else None
+            results = load.run_load(
+                scans=options["scans"], concurrency=options["concurrency"], rate=options["rate"],
+                seed=options["seed"], products=options["products"], off_records=off_records,
+                off_latency_ms=options["off_latency_ms"], llm_latency_ms=options["llm_latency_ms"],
+                llm_latency_sigma=options["llm_latency_sigma"], llm_error_rate=options["llm_error_rate"],
+                fallback=options["fallback"], analysis_cache=options["analysis_cache"],
+                admission=options["admission"])
+        except (OSError, load.LoadError) as e:
+            raise CommandError(str(e))
+
+        scans = results["scans"]
+        self.stdout.write(f"{scans['ok']} ok, {scans['failed']} failed in {results['elapsed_seconds']:.1f}s: "
+                          f"{results['throughput']:.2f} scans/s")
+        for message, count in sorted(scans["errors"].items(), key=lambda item: -item[1]):
+            self.stdout.write(f"  {count:>5} x {message}")
+
+        self.stdout.write(f"\n{'stage':<22}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for section in ("stages", "server_stages"):
+            for name, stats in results[section].items():
+                if not stats["count"]:
+                    continue
+                label = name if section == "stages" else f"  server {name}"
+                self.stdout.write(f"{label:<22}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}"
+                                  f"{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+
+        if baseline is not None:
+            self.stdout.write(f"\n{'p95 compared':<22}{'before':>10}{'now':>10}{'change':>9}")
+            for name, before, now in load.compare(results, baseline):
+                if before is None or now is None:
+                    continue
+                change = f"{(now - before) / before:+.0%}" if before else "-"
+                self.stdout.write(f"{name:<22}{before:>10.1f}{now:>10.1f}{change:>9}")
+
+        if options["save"]:
+            with open(options["save"], "w") as f:
+                json.dump(results, f, indent=2)
+                f.write("\n")
+            self.stdout.write(f"\nResults written to {options['save']}")
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+
+from scan.bench.fixtures import OFF_NUTRIMENTS
+from scan.models import CachedProduct, CatalogProduct
+from scan.services import nutrients, nutrition
+from scan.services.tokens import count_tokens
+
+PROFILE = dict(age=35, weight=68, height=170, bmi=23.5, health_conditions="Hypertension",
+               dietary_preferences="Vegetarian", goal="Maintain weight")
+
+
+def legacy_table(nutriments):
+    """The nutrient section as generate_prompt built it before the normalizer: every OFF key, verbatim."""
+    return "\n".join(f"{k}: {v}" for k, v in (nutriments or {}).items())
+
+
+class Command(BaseCommand):
+    help = ("Compare the prompt's nutrient section in tokens, raw Open Food Facts nutriments vs. "
+            "the normalized table, over catalog and cached products (or a sample record).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=200, help="Products to sample from each table")
+
+    def _products(self, limit):
+        products = [entry.as_product() for entry in CatalogProduct.objects.all()[:limit]]
+        products += [entry.data for entry in CachedProduct.objects.exclude(data=None)[:limit]]
+        products = [product for product in products if product.get("nutriments")]
+        if products:
+            return products
+        self.stdout.write("No stored products; using the sample Open Food Facts record\n")
+        return [{"product_name": "Sample product", "nutriscore_grade": "D", "nutriments": OFF_NUTRIMENTS}]
+
+    def handle(self, *args, **options):
+        products = self._products(options["limit"])
+        raw_section = compact_section = prompt = 0
+        for product in products:
+            raw = count_tokens(legacy_table(product["nutriments"]))
+            compact = count_tokens(nutrients.prompt_table(product["nutriments"]))
+            raw_section += raw
+            compact_section += compact
+            # Guidance left out: it is the same text either way
+            prompt += count_tokens(nutrition.generate_prompt(product_info=product, diet_knowledge="", **PROFILE))
+
+        count = len(products)
+        # The old prompt differed only in its nutrient section
+        legacy_prompt = prompt - compact_section + raw_section
+        self.stdout.write(f"{count} products, tokens per prompt on average\n")
+        self.stdout.write(f"{'':<20}{'raw':>10}{'compact':>10}{'saved':>10}")
+        for name, before, after in (("nutrient section", raw_section, compact_section),
+                                    ("whole prompt", legacy_prompt, prompt)):
+            saved = 1 - after / before if before else 0.0
+            self.stdout.write(f"{name:<20}{before / count:>10.1f}{after / count:>10.1f}{saved:>10.0%}")
@@ -0,0 +1,87 @@
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from scan.services import jobs, metrics
+
+
+class Command(BaseCommand):
+    help = "Pull queued scan jobs from the database and process them concurrently."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=settings.SCAN_WORKER_CONCURRENCY,
+                            help="Jobs processed at the same time")
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Seconds to sleep when the queue is empty")
+        parser.add_argument("--once", action="store_true",
+                            help="Process the jobs that are due now, then exit")
+        parser.add_argument("--metrics-port", type=int,
+                            help="Serve this worker's Prometheus metrics over HTTP on this port")
+
+    def handle(self, *args, **options):
+        concurrency = max(options["concurrency"], 1)
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        slots = threading.BoundedSemaphore(concurrency)
+        processed = 0
+
+        self.stdout.write(f"Scan worker {worker_id} started with {concurrency} slots")
+        if options["metrics_port"]:
+            self._serve_metrics(options["metrics_port"])
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="scan-worker") as pool:
+            try:
+                last_sweep = 0
+                while True:
+                    if time.monotonic() - last_sweep > 60:
+                        jobs.requeue_stale_jobs()
+                        last_sweep = time.monotonic()
+
+                    slots.acquire()
+                    job = jobs.claim_next_job(worker_id)
+                    if job is None:
+                        slots.release()
+                        if options["once"]:
+                            break
+                        time.sleep(options["poll_interval"])
+                        continue
+
+                    processed += 1
+                    future = pool.submit(self._run, job)
+                    future.add_done_callback(lambda f: slots.release())
+            except KeyboardInterrupt:
+                self.stdout.write("Stopping, waiting for running jobs to finish...")
+
+        self.stdout.write(self.style.SUCCESS(f"Scan worker stopped after {processed} jobs"))
+
+    def _serve_metrics(self, port):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.stdout.write(f"Metrics on :{port}")
+
+    def _run(self, job):
+        close_old_connections()
+        try:
+            jobs.run_job(job)
+            self.stdout.write(f"Job {job.pk}: {job.status}")
+        except Exception as e:
+            self.stderr.write(f"Job {job.pk} crashed: {e}")
+        finally:
+            close_old_connections()
@@ -0,0 +1,84 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Run in a fresh interpreter per mode: import the app the way a server does, then
+# fork a "worker" that serves a first scan's CPU work and reports its memory
+CHILD = r"""
+import json, os, resource, time
+started = time.perf_counter()
+import django
+django.setup()
+from django.urls import get_resolver
+get_resolver().url_patterns  # imports every view, as the first request would
+result = {"import_ms": (time.perf_counter() - started) * 1000,
+          "master_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+read_end, write_end = os.pipe()
+pid = os.fork()
+if pid == 0:
+    os.close(read_end)
+    from scan.bench.fixtures import encode_png, photo
+    from scan.services import barcode_scanner, guidance
+    image = encode_png(photo("590123412345", (1280, 720)))
+    started = time.perf_counter()
+    barcode_scanner.decode_image_bytes(image)
+    try:
+        guidance.retrieve("salt sugar fat")
+    except (OSError, ValueError):
+        pass
+    worker = {"first_scan_ms": (time.perf_counter() - started) * 1000}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            kb = {name[:-1]: int(value) for name, value, *_ in map(str.split, f) if name.endswith(":")}
+        worker["worker_pss_mb"] = kb["Pss"] / 1024
+        worker["worker_private_mb"] = (kb["Private_Clean"] + kb["Private_Dirty"]) / 1024
+    except OSError:
+        pass
+    os.write(write_end, json.dumps(worker).encode())
+    os._exit(0)
+os.close(write_end)
+with os.fdopen(read_end) as pipe:
+    payload = pipe.read()
+os.waitpid(pid, 0)
+result.update(json.loads(payload or "{}"))
+print(json.dumps(result))
+"""
+
+COLUMNS = (("import_ms", "import ms"), ("master_rss_mb", "master RSS MB"), ("first_scan_ms", "1st scan ms"),
+           ("worker_pss_mb", "worker PSS MB"), ("worker_private_mb", "worker private MB"))
+
+
+class Command(BaseCommand):
+    help = ("Measure what starting a worker costs: app import time and RSS, then, in a forked worker, the "
+            "first scan's decode and guidance time and the worker's own (private) memory. Compares "
+            "SCAN_WARMUP off and on. Linux only for the memory columns.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=3, help="Fresh interpreters per mode; medians are shown")
+
+    def _run(self, warmup):
+        # Decodes in-process: the cost measured is loading the decoders in this worker
+        env = dict(os.environ, SCAN_WARMUP=str(warmup), DECODE_POOL_ENABLED="False",
+                   DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+        completed = subprocess.run([sys.executable, "-c", CHILD], env=env, cwd=settings.BASE_DIR,
+                                   capture_output=True, text=True, timeout=300)
+        if completed.returncode != 0:
+            raise CommandError(f"Measurement process failed:\n{completed.stderr[-2000:]}")
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+    def handle(self, *args, **options):
+        if not hasattr(os, "fork"):
+            raise CommandError("Needs os.fork (Linux or macOS)")
+        self.stdout.write(f"{'SCAN_WARMUP':<14}" + "".join(f"{label:>19}" for _, label in COLUMNS))
+        for warmup in (False, True):
+            runs = [self._run(warmup) for _ in range(options["runs"])]
+            cells = []
+            for key, _ in COLUMNS:
+                values = sorted(run[key] for run in runs if key in run)
+                cells.append(f"{values[len(values) // 2]:>19.1f}" if values else f"{'-':>19}")
+            self.stdout.write(f"{'on' if warmup else 'off':<14}" + "".join(cells))
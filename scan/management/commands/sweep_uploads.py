@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from scan.services import uploads
+
+
+class Command(BaseCommand):
+    help = ("Delete uploaded scan photos that expired or that nothing references, "
+            "in bounded batches, and report the space reclaimed. Run it from cron.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="Files or rows handled per batch (default SCAN_SWEEP_BATCH_SIZE)")
+        parser.add_argument("--max-batches", type=int, help="Stop after this many batches; the next run continues")
+        parser.add_argument("--dry-run", action="store_true", help="Report what would be removed without deleting")
+
+    def handle(self, *args, **options):
+        metrics = uploads.sweep(
+            batch_size=options["batch_size"],
+            max_batches=options["max_batches"],
+            dry_run=options["dry_run"],
+        )
+        prefix = "Would remove" if options["dry_run"] else "Removed"
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix} {metrics['expired_files']} expired and {metrics['orphan_files']} orphaned files "
+            f"({metrics['bytes_reclaimed'] / 1024 / 1024:.1f} MiB), purged {metrics['rows_purged']} "
+            f"decode cache rows in {metrics['batches']} batches, {metrics['seconds']}s"
+        ))
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scan', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedProduct',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('barcode', models.CharField(max_length=50, unique=True)),
+                ('data', models.JSONField(blank=True, null=True)),
+                ('fetched_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scan', '0002_cachedproduct'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogProduct',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('barcode', models.CharField(max_length=50, unique=True)),
+                ('product_name', models.CharField(max_length=255)),
+                ('nutriscore_grade', models.CharField(default='N/A', max_length=5)),
+                ('nutriscore_score', models.IntegerField(default=0)),
+                ('nutriments', models.JSONField(default=dict)),
+                ('nutrient_levels', models.JSONField(default=dict)),
+                ('image_url', models.URLField(blank=True, max_length=500)),
+                ('last_modified_t', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
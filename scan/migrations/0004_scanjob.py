@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:06
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nutri', '0002_remove_nutriuser_bmi'),
+        ('scan', '0003_catalogproduct'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScanJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('decoding', 'Decoding barcode'), ('lookup', 'Looking up product'), ('analyzing', 'Analyzing nutrition'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_by', models.CharField(blank=True, max_length=100)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='nutri.nutriuser')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='scan_scanjo_status_0d0747_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:10
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scan', '0004_scanjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('barcode', models.CharField(max_length=50)),
+                ('model_name', models.CharField(db_index=True, max_length=255)),
+                ('prompt_version', models.CharField(db_index=True, max_length=50)),
+                ('advisability', models.CharField(max_length=50)),
+                ('summary', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scan', '0005_analysiscacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scanjob',
+            name='advisability',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='scanjob',
+            name='partial_output',
+            field=models.TextField(blank=True),
+        ),
+    ]
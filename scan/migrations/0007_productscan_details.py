@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:19
+
+import django.db.models.deletion
+import scan.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scan', '0006_scanjob_streaming'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='scanjob',
+            name='result',
+        ),
+        migrations.AddField(
+            model_name='productscan',
+            name='advisability',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='productscan',
+            name='image_url',
+            field=models.URLField(blank=True, max_length=500),
+        ),
+        migrations.AddField(
+            model_name='productscan',
+            name='nutriments',
+            field=models.JSONField(default=dict, encoder=scan.models.CompactJSONEncoder),
+        ),
+        migrations.AddField(
+            model_name='productscan',
+            name='nutriscore_grade',
+            field=models.CharField(default='N/A', max_length=5),
+        ),
+        migrations.AddField(
+            model_name='scanjob',
+            name='scan',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='scan.productscan'),
+        ),
+    ]
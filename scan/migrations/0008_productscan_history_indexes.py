@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nutri', '0002_remove_nutriuser_bmi'),
+        ('scan', '0007_productscan_details'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='productscan',
+            index=models.Index(fields=['user', '-scan_date', '-id'], name='scan_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productscan',
+            index=models.Index(fields=['user', 'barcode'], name='scan_user_barcode_idx'),
+        ),
+    ]
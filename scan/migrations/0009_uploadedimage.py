@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:23
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scan', '0008_productscan_history_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadedImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('filename', models.CharField(max_length=100)),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('stored', models.BooleanField(default=True)),
+                ('decoded', models.BooleanField(default=False)),
+                ('barcode', models.CharField(blank=True, max_length=50)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['stored', 'last_used_at'], name='scan_upload_stored_22b09b_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nutri', '0002_remove_nutriuser_bmi'),
+        ('scan', '0009_uploadedimage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InferenceUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('tokens', models.PositiveIntegerField(default=0)),
+                ('calls', models.PositiveIntegerField(default=0)),
+                ('rejected', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='nutri.nutriuser')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'day'), name='inference_usage_user_day')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scan', '0010_inferenceusage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedimage',
+            name='references',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -1,12 +1,175 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils import timezone
 from nutri.models import NutriUser
 
+
+class CompactJSONEncoder(DjangoJSONEncoder):
+    """JSON without the spaces after separators, for columns stored as text."""
+    item_separator = ","
+    key_separator = ":"
+
+
 class ProductScan(models.Model):
     user = models.ForeignKey(NutriUser, on_delete=models.CASCADE)
     barcode = models.CharField(max_length=50)
     product_name = models.CharField(max_length=255)
     scan_date = models.DateTimeField(auto_now_add=True)
-    analysis_result = models.TextField()
+    analysis_result = models.TextField()  # the summary shown to the user
+    advisability = models.CharField(max_length=20, blank=True)
+    nutriscore_grade = models.CharField(max_length=5, default="N/A")
+    image_url = models.URLField(max_length=500, blank=True)
+    # Numeric nutriments only, see nutrients.compact()
+    nutriments = models.JSONField(default=dict, encoder=CompactJSONEncoder)
+
+    class Meta:
+        indexes = [
+            # History pages walk this index newest first; id breaks ties in the keyset
+            models.Index(fields=['user', '-scan_date', '-id'], name='scan_user_date_idx'),
+            models.Index(fields=['user', 'barcode'], name='scan_user_barcode_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_name} ({self.barcode})"
+
+    def as_product(self):
+        """The parts of the product dict the result page shows."""
+        return {
+            "product_name": self.product_name,
+            "nutriscore_grade": self.nutriscore_grade,
+            "nutriments": self.nutriments,
+            "image_url": self.image_url,
+        }
+
+    def as_analysis(self):
+        return {"advisability": self.advisability, "summary": self.analysis_result}
+
+
+class CachedProduct(models.Model):
+    """Persistent Open Food Facts lookup cache. data is NULL for "not found" answers."""
+    barcode = models.CharField(max_length=50, unique=True)
+    data = models.JSONField(null=True, blank=True)
+    fetched_at = models.DateTimeField()
+
+    def __str__(self):
+        return self.barcode
+
+
+class CatalogProduct(models.Model):
+    """Local copy of an Open Food Facts export, filled by the import_off_catalog command."""
+    barcode = models.CharField(max_length=50, unique=True)
+    product_name = models.CharField(max_length=255)
+    nutriscore_grade = models.CharField(max_length=5, default="N/A")
+    nutriscore_score = models.IntegerField(default=0)
+    nutriments = models.JSONField(default=dict)
+    nutrient_levels = models.JSONField(default=dict)
+    image_url = models.URLField(max_length=500, blank=True)
+    last_modified_t = models.BigIntegerField(default=0)
+
+    def as_product(self):
+        """Same shape as product_lookup.fetch_product_data() returns."""
+        return {
+            "product_name": self.product_name,
+            "nutriscore_grade": self.nutriscore_grade,
+            "nutriscore_score": self.nutriscore_score,
+            "nutriments": self.nutriments,
+            "nutrient_levels": self.nutrient_levels,
+            "image_url": self.image_url,
+        }
+
+    def __str__(self):
+        return f"{self.product_name} ({self.barcode})"
+
+
+class ScanJob(models.Model):
+    """A scan waiting for, or being worked on by, the run_scan_worker command."""
+    QUEUED = 'queued'
+    DECODING = 'decoding'
+    LOOKUP = 'lookup'
+    ANALYZING = 'analyzing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (DECODING, 'Decoding barcode'),
+        (LOOKUP, 'Looking up product'),
+        (ANALYZING, 'Analyzing nutrition'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+    ACTIVE_STATUSES = [DECODING, LOOKUP, ANALYZING]
+
+    user = models.ForeignKey(NutriUser, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    scan = models.ForeignKey(ProductScan, null=True, blank=True, on_delete=models.SET_NULL)
+    # Streamed LLM reply so far, and the verdict as soon as it shows up in it
+    partial_output = models.TextField(blank=True)
+    advisability = models.CharField(max_length=20, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f"Scan job {self.pk} ({self.status})"
+
+
+class AnalysisCacheEntry(models.Model):
+    """Parsed LLM verdict for one product and one profile bucket (see services/analysis_cache.py)."""
+    key = models.CharField(max_length=64, unique=True)
+    barcode = models.CharField(max_length=50)
+    model_name = models.CharField(max_length=255, db_index=True)
+    prompt_version = models.CharField(max_length=50, db_index=True)
+    advisability = models.CharField(max_length=50)
+    summary = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.barcode}: {self.advisability}"
+
+
+class InferenceUsage(models.Model):
+    """LLM tokens one user spent on one day, and the analyses refused (see services/admission.py)."""
+    user = models.ForeignKey(NutriUser, on_delete=models.CASCADE)
+    day = models.DateField()
+    tokens = models.PositiveIntegerField(default=0)
+    calls = models.PositiveIntegerField(default=0)
+    rejected = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['user', 'day'], name='inference_usage_user_day')]
+
+    def __str__(self):
+        return f"{self.user_id} on {self.day}: {self.tokens} tokens"
+
+
+class UploadedImage(models.Model):
+    """
+    A scan photo stored under its SHA-256 (see services/uploads.py). The
+    decoded barcode is kept after the file itself is swept, so re-uploading
+    the same photo skips decoding. references counts uploads of the file whose
+    result has not been seen yet; it is removed early only once that is 0.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    filename = models.CharField(max_length=100)
+    size = models.PositiveIntegerField(default=0)
+    stored = models.BooleanField(default=True)  # False once the file has been removed
+    references = models.PositiveIntegerField(default=0)
+    decoded = models.BooleanField(default=False)
+    barcode = models.CharField(max_length=50, blank=True)  # empty with decoded=True: no barcode found
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['stored', 'last_used_at'])]
 
     def __str__(self):
-        return f"{self.product_name} ({self.barcode})"
\ No newline at end of file
+        return self.filename
@@ -0,0 +1,241 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from scan.models import InferenceUsage, ProductScan
+from . import inference, metrics, rules, verdict
+
+logger = logging.getLogger(__name__)
+
+# Shown ahead of an answer given instead of an LLM call, by why the call was refused
+NOTICES = {
+    "daily_budget": "You have used today's detailed analyses, so this is a quick answer.",
+    "user_rate": "You are scanning faster than detailed analyses can keep up, so this is a quick answer.",
+    "global_rate": "Detailed analysis is busy right now, so this is a quick answer.",
+}
+
+# Users whose buckets are kept; beyond this the full (idle) ones are dropped
+MAX_USER_BUCKETS = 10000
+
+# Tokens used by the admitted call running in this context: [count]
+_usage = contextvars.ContextVar("nutriscan_inference_usage", default=None)
+
+
+class TokenBucket:
+    """
+    Holds up to `burst` tokens and refills at per_minute / 60 per second.
+    settle() may push the level below zero: a call that used more than it
+    was charged delays the next ones.
+    """
+
+    def __init__(self, burst, per_minute, clock=time.monotonic):
+        self.burst = burst
+        self.rate = per_minute / 60
+        self.clock = clock
+        self.level = float(burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.level = min(self.burst, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, amount, reserve=0.0) -> bool:
+        """Take amount tokens unless that leaves fewer than reserve * burst."""
+        with self._lock:
+            self._refill()
+            if self.level - min(amount, self.burst) < reserve * self.burst:
+                return False
+            self.level -= amount
+            return True
+
+    def settle(self, charged, used):
+        with self._lock:
+            self.level = min(self.burst, self.level + charged - used)
+
+    def idle(self) -> bool:
+        with self._lock:
+            self._refill()
+            return self.level >= self.burst
+
+
+_global_bucket = None
+_user_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def _buckets(user_id):
+    """(user bucket, global bucket); None for a bucket whose burst is set to 0."""
+    global _global_bucket
+    with _buckets_lock:
+        if _global_bucket is None and settings.ADMISSION_GLOBAL_BURST:
+            _global_bucket = TokenBucket(settings.ADMISSION_GLOBAL_BURST, settings.ADMISSION_GLOBAL_PER_MINUTE)
+        if not settings.ADMISSION_USER_BURST:
+            return None, _global_bucket
+        bucket = _user_buckets.get(user_id)
+        if bucket is None:
+            if len(_user_buckets) >= MAX_USER_BUCKETS:
+                for key in [key for key, other in _user_buckets.items() if other.idle()]:
+                    del _user_buckets[key]
+            bucket = _user_buckets[user_id] = TokenBucket(settings.ADMISSION_USER_BURST,
+                                                          settings.ADMISSION_USER_PER_MINUTE)
+        return bucket, _global_bucket
+
+
+def reset_buckets(**kwargs):
+    """Forget every bucket; the next calls build them from the current settings."""
+    global _global_bucket
+    if kwargs.get("setting", "ADMISSION_").startswith("ADMISSION_"):
+        with _buckets_lock:
+            _global_bucket = None
+            _user_buckets.clear()
+
+
+setting_changed.connect(reset_buckets)
+
+
+def _add_usage(user, **amounts):
+    """Add to the user's InferenceUsage row for today, creating it on first use."""
+    day = timezone.localdate()
+    updates = {name: F(name) + amount for name, amount in amounts.items()}
+    if InferenceUsage.objects.filter(user=user, day=day).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            InferenceUsage.objects.create(user=user, day=day, **amounts)
+    except IntegrityError:
+        # Another scan by the same user created today's row first
+        InferenceUsage.objects.filter(user=user, day=day).update(**updates)
+
+
+def used_today(user) -> int:
+    return InferenceUsage.objects.filter(user=user, day=timezone.localdate()).values_list(
+        "tokens", flat=True).first() or 0
+
+
+def note_tokens(count):
+    """Count tokens sent to or read from the LLM against the admitted call in progress, if any."""
+    usage = _usage.get()
+    if usage is not None:
+        usage[0] += count
+
+
+class Ticket:
+    """
+    The outcome of admit(). When admitted, run the LLM call inside
+    counting() and call settle() afterwards, even if it failed: the buckets
+    are corrected to the tokens it really used and these are added to the
+    user's daily account.
+    """
+
+    def __init__(self, user, charged=0, buckets=(), reason=None, repeat=False):
+        self.user = user
+        self.charged = charged
+        self.buckets = buckets
+        self.reason = reason
+        self.repeat = repeat
+        self.tokens = 0
+
+    @property
+    def admitted(self):
+        return self.reason is None
+
+    @contextmanager
+    def counting(self):
+        usage = [0]
+        token = _usage.set(usage)
+        try:
+            yield
+        finally:
+            _usage.reset(token)
+            self.tokens += usage[0]
+
+    def settle(self):
+        for bucket in self.buckets:
+            bucket.settle(self.charged, self.tokens)
+        metrics.INFERENCE_TOKENS.inc("repeat" if self.repeat else "first", self.tokens)
+        _add_usage(self.user, tokens=self.tokens, calls=1)
+
+
+def admit(user, barcode) -> Ticket:
+    """
+    Decide whether this analysis may call the LLM. Checked in turn: the
+    user's daily token budget, the user's bucket, the global bucket. A
+    repeat scan of a product the user has scanned before must leave
+    ADMISSION_REPEAT_RESERVE of each bucket for first-time scans.
+    """
+    if not settings.ADMISSION_ENABLED:
+        return Ticket(user)
+    repeat = ProductScan.objects.filter(user=user, barcode=barcode).exists()
+    reserve = settings.ADMISSION_REPEAT_RESERVE if repeat else 0.0
+    cost = settings.ADMISSION_CALL_TOKENS
+    user_bucket, global_bucket = _buckets(user.id)
+
+    reason = None
+    daily = settings.ADMISSION_USER_DAILY_TOKENS
+    if daily and used_today(user) + cost > daily:
+        reason = "daily_budget"
+    elif user_bucket and not user_bucket.take(cost, reserve):
+        reason = "user_rate"
+    elif global_bucket and not global_bucket.take(cost, reserve):
+        reason = "global_rate"
+        if user_bucket:
+            user_bucket.settle(cost, 0)
+
+    if reason is None:
+        return Ticket(user, cost, [bucket for bucket in (user_bucket, global_bucket) if bucket], repeat=repeat)
+    metrics.INFERENCE_REJECTIONS.inc(reason)
+    _add_usage(user, rejected=1)
+    logger.info("LLM call refused for user %s (%s, %s scan)", user.id, reason, "repeat" if repeat else "first")
+    return Ticket(user, reason=reason, repeat=repeat)
+
+
+def _previous_verdict(user, barcode) -> Optional[Dict]:
+    scan = (ProductScan.objects.filter(user=user, barcode=barcode, advisability__in=verdict.ADVISABILITY)
+            .order_by("-scan_date", "-id").first())
+    if scan is None:
+        return None
+    summary = scan.analysis_result
+    for notice in NOTICES.values():
+        summary = summary.removeprefix(notice + " ")
+    return {"advisability": scan.advisability, "summary": summary, "model": "previous scan"}
+
+
+def _rules_verdict(product, user) -> Optional[Dict]:
+    # Any lead counts here: a leaning answer beats none
+    try:
+        return rules.evaluate(product, user, threshold=1)
+    except (OSError, ValueError) as e:
+        logger.warning("Analysis rules unavailable: %s", e)
+        return None
+
+
+def _nutriscore_verdict(product) -> Dict:
+    grade = product.get("nutriscore_grade") or ""
+    reply = inference.StubBackend("stub").chat([{"role": "user", "content": f"Nutri-Score: {grade}"}], 0, 0)
+    return dict(verdict.parse(reply), model="stub")
+
+
+def fallback(user, barcode, product, reason) -> Dict:
+    """
+    An answer without the LLM for a refused call: the user's last verdict on
+    this product, else the rules' leaning, else one from the Nutri-Score.
+    Its summary starts with a note saying why it is short.
+    """
+    for source, answer in (("previous_scan", lambda: _previous_verdict(user, barcode)),
+                           ("rules", lambda: _rules_verdict(product, user)),
+                           ("nutriscore", lambda: _nutriscore_verdict(product))):
+        analysis = answer()
+        if analysis is not None:
+            metrics.INFERENCE_FALLBACKS.inc(source)
+            analysis["summary"] = f"{NOTICES[reason]} {analysis['summary']}"
+            return analysis
@@ -0,0 +1,49 @@
+import asyncio
+import contextvars
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+
+
+class LoopLocal:
+    """
+    One factory() result per running event loop. Async HTTP clients and
+    futures belong to the loop that created them, so they are shared by every
+    request on a loop but never across loops.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._objects = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def get(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            obj = self._objects.get(loop)
+            if obj is None:
+                obj = self._objects[loop] = self.factory()
+            return obj
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def decode_executor():
+    """Threads for CPU-bound decode work (OpenCV and zbar release the GIL)."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.SCAN_STAGE_CONCURRENCY.get("decoding", 4),
+                thread_name_prefix="scan-decode",
+            )
+        return _executor
+
+
+async def run_cpu(fn, *args):
+    """Run fn(*args) on the decode executor without blocking the event loop (context variables included)."""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(decode_executor(), context.run, fn, *args)
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import re
+import threading
+from datetime import timedelta
+from typing import Dict, Optional
+from django.conf import settings
+from django.utils import timezone
+
+from scan.models import AnalysisCacheEntry
+from . import inference, nutrition
+
+# Verdicts worth reusing; parse failures are never cached
+CACHEABLE_ADVISABILITY = {"Yes", "No"}
+
+_stats = {"hits": 0, "misses": 0, "expired": 0, "puts": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+        return _stats[name]
+
+
+def cache_stats() -> Dict:
+    """Snapshot of the analysis cache counters plus the hit rate."""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats["hits"] + stats["misses"] + stats["expired"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+
+def reset_cache_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+def _normalize_list(text):
+    """'Diabetes, hypertension' and 'hypertension and diabetes' land in the same bucket."""
+    items = re.split(r",|;|/|\band\b|\n", (text or "").lower())
+    items = {" ".join(item.split()) for item in items}
+    return sorted(item for item in items if item and item not in ("none", "no", "nil", "n/a"))
+
+
+def _band(value, width):
+    try:
+        return int(float(value) // width) if width else float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def profile_bucket(user) -> Dict:
+    """
+    The parts of a profile the verdict depends on, coarsened so that similar
+    users share cache entries. Band widths come from settings.
+    """
+    try:
+        bmi = user.bmi
+    except (TypeError, ZeroDivisionError):
+        bmi = None
+    return {
+        "age": _band(user.age, settings.ANALYSIS_CACHE_AGE_BAND),
+        "bmi": _band(bmi, settings.ANALYSIS_CACHE_BMI_BAND),
+        "conditions": _normalize_list(user.health_conditions),
+        "diet": _normalize_list(user.dietary_preferences),
+        "goal": " ".join((user.goal or "").lower().split()),
+    }
+
+
+def nutriment_fingerprint(product) -> str:
+    payload = json.dumps(
+        [product.get("nutriscore_grade"), product.get("nutriments", {})],
+        sort_keys=True, default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def cache_key(barcode, product, user, model_name=None, prompt_version=None) -> str:
+    payload = json.dumps({
+        "barcode": barcode,
+        "nutriments": nutriment_fingerprint(product),
+        "profile": profile_bucket(user),
+        "model": model_name or inference.primary_model(),
+        "prompt": prompt_version or nutrition.PROMPT_VERSION,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def get(barcode, product, user) -> Optional[Dict]:
+    """Cached {"advisability", "summary", "model"} for this product and profile bucket, or None."""
+    if not settings.ANALYSIS_CACHE_ENABLED:
+        return None
+
+    key = cache_key(barcode, product, user)
+    entry = AnalysisCacheEntry.objects.filter(key=key).first()
+    if entry is None:
+        _count("misses")
+        return None
+
+    now = timezone.now()
+    if now - entry.created_at > timedelta(seconds=settings.ANALYSIS_CACHE_TTL):
+        entry.delete()
+        _count("expired")
+        return None
+
+    AnalysisCacheEntry.objects.filter(pk=entry.pk).update(last_used_at=now)
+    _count("hits")
+    return {"advisability": entry.advisability, "summary": entry.summary, "model": entry.model_name}
+
+
+def put(barcode, product, user, analysis):
+    if not settings.ANALYSIS_CACHE_ENABLED:
+        return
+    if analysis.get("advisability") not in CACHEABLE_ADVISABILITY:
+        return
+    # Answers from a fallback backend are stopgaps, not worth keeping for a month
+    model_name = inference.primary_model()
+    if analysis.get("model", model_name) != model_name:
+        return
+
+    AnalysisCacheEntry.objects.update_or_create(
+        key=cache_key(barcode, product, user),
+        defaults={
+            "barcode": barcode,
+            "model_name": model_name,
+            "prompt_version": nutrition.PROMPT_VERSION,
+            "advisability": analysis["advisability"],
+            "summary": analysis["summary"],
+            "created_at": timezone.now(),
+            "last_used_at": timezone.now(),
+        },
+    )
+    # evict() counts the whole table, so it runs every so many puts rather than on each
+    every = settings.ANALYSIS_CACHE_EVICT_EVERY
+    if every and _count("puts") % every == 0:
+        evict()
+
+
+def evict(max_entries=None):
+    """Drop least recently used entries beyond ANALYSIS_CACHE_MAX_ENTRIES. Returns how many were removed."""
+    max_entries = settings.ANALYSIS_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+    excess = AnalysisCacheEntry.objects.count() - max_entries
+    if excess <= 0:
+        return 0
+    oldest = list(AnalysisCacheEntry.objects.order_by("last_used_at").values_list("pk", flat=True)[:excess])
+    AnalysisCacheEntry.objects.filter(pk__in=oldest).delete()
+    return len(oldest)
+
+
+def invalidate(model_name=None, prompt_version=None) -> int:
+    """Delete entries produced by a model and/or prompt version (everything when both are None)."""
+    entries = AnalysisCacheEntry.objects.all()
+    if model_name:
+        entries = entries.filter(model_name=model_name)
+    if prompt_version:
+        entries = entries.filter(prompt_version=prompt_version)
+    deleted, _ = entries.delete()
+    return deleted
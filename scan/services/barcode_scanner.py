@@ -1,11 +1,216 @@
-import cv2
-from pyzbar import pyzbar
+import threading
+from typing import Optional, Tuple
+from django.conf import settings
+
+# OpenCV, numpy and zbar are imported where they are used: together they add
+# ~300 ms and ~40 MB to every process that merely imports the scan app
+
+# Longest side of the image used by the cheap first pass
+DOWNSCALE_MAX_SIDE = 1024
+
+# Every pass decode_image() knows about, in the default order
+DECODE_PASSES = ("downscaled", "full", "rotated", "binarized")
+
+# How often each pass was the one that found the barcode
+_stats = {name: 0 for name in DECODE_PASSES + ("failed",)}
+_stats_lock = threading.Lock()
+
+
+def decode_stats():
+    """Snapshot of which decode pass succeeded, for tuning BARCODE_DECODE_PASSES."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def load_grayscale(data: bytes):
+    """Decode image file bytes straight to a single-channel array, or None if unreadable."""
+    import cv2
+    import numpy as np
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if buffer.size == 0:
+        return None
+    return cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE)
+
+
+def downscale(gray, max_side=DOWNSCALE_MAX_SIDE):
+    import cv2
+    height, width = gray.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1:
+        return gray
+    return cv2.resize(gray, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+
+
+def _rotation_matrix(shape, angle):
+    """Rotation around the centre that grows the canvas so no corner is cut off."""
+    import cv2
+    height, width = shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    new_width, new_height = int(height * sin + width * cos), int(height * cos + width * sin)
+    matrix[0, 2] += new_width / 2 - width / 2
+    matrix[1, 2] += new_height / 2 - height / 2
+    return matrix, (new_width, new_height)
+
+
+def binarize(gray):
+    import cv2
+    _, otsu = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return otsu
+
+
+def _scale_matrix(scale):
+    import numpy as np
+    return np.array([[scale, 0, 0], [0, scale, 0]], dtype=np.float64)
+
+
+def _pass_images(name, gray):
+    """
+    (image, matrix) pairs to try for one pass, built lazily so unused passes
+    cost nothing. matrix maps pass image coordinates back onto gray.
+    """
+    import cv2
+    import numpy as np
+    identity = _scale_matrix(1.0)
+    if name == "downscaled":
+        small = downscale(gray)
+        if small is not gray:
+            yield small, _scale_matrix(gray.shape[1] / small.shape[1])
+    elif name == "full":
+        yield gray, identity
+    elif name == "rotated":
+        # zbar scans rows and columns, so tilted codes need an explicit turn
+        small = downscale(gray)
+        scale = small.shape[1] / gray.shape[1]
+        for angle in (45, -45, 90):
+            matrix, size = _rotation_matrix(small.shape, angle)
+            forward = np.hstack([matrix[:, :2] * scale, matrix[:, 2:]])
+            yield cv2.warpAffine(small, matrix, size, borderValue=255), cv2.invertAffineTransform(forward)
+    elif name == "binarized":
+        yield binarize(gray), identity
+        yield cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10), identity
+
+
+def _located(found, matrix):
+    """pyzbar result -> dict with the bounding box in original image coordinates."""
+    import cv2
+    import numpy as np
+    points = [(p.x, p.y) for p in found.polygon] or [
+        (found.rect.left, found.rect.top),
+        (found.rect.left + found.rect.width, found.rect.top + found.rect.height),
+    ]
+    mapped = cv2.transform(np.array([points], dtype=np.float64), matrix)[0]
+    left, top = mapped.min(axis=0)
+    right, bottom = mapped.max(axis=0)
+    return {
+        "barcode": found.data.decode('utf-8'),
+        "symbology": found.type,
+        "rect": {
+            "left": int(round(left)), "top": int(round(top)),
+            "width": int(round(right - left)), "height": int(round(bottom - top)),
+        },
+    }
+
+
+def run_pass(name, gray):
+    """Run one decode pass and return pyzbar's results (empty list when nothing is found)."""
+    from pyzbar import pyzbar
+    for image, _ in _pass_images(name, gray):
+        barcodes = pyzbar.decode(image)
+        if barcodes:
+            return barcodes
+    return []
+
+
+def locate_barcodes(gray, passes=None):
+    """
+    Every distinct barcode in the image with its symbology and bounding box,
+    from the first pass that finds anything. Each dict also names that pass.
+    """
+    from pyzbar import pyzbar
+    for name in passes or settings.BARCODE_DECODE_PASSES:
+        for image, matrix in _pass_images(name, gray):
+            barcodes = pyzbar.decode(image)
+            if not barcodes:
+                continue
+            results = {}
+            for found in barcodes:
+                item = _located(found, matrix)
+                item["pass"] = name
+                results.setdefault(item["barcode"], item)
+            return list(results.values())
+    return []
+
+
+def _first_hit(gray, passes) -> Tuple[Optional[str], Optional[str]]:
+    for name in passes:
+        barcodes = run_pass(name, gray)
+        if barcodes:
+            return barcodes[0].data.decode('utf-8'), name
+    return None, None
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name or "failed"] += 1
+
+
+def decode_image(gray, passes=None) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Try each pass in order, cheapest first, and stop at the first hit.
+    Returns (barcode, pass name) or (None, None).
+    """
+    barcode, name = _first_hit(gray, passes or settings.BARCODE_DECODE_PASSES)
+    _count(name)
+    return barcode, name
+
+
+def decode_image_bytes(data: bytes, passes=None) -> Tuple[Optional[str], Optional[str]]:
+    """Decode a barcode from uploaded image bytes without touching the disk."""
+    gray = load_grayscale(data)
+    if gray is None:
+        return None, None
+    return decode_image(gray, passes)
+
+
+# Run in decode pool workers: they get the passes from the caller and leave
+# counting to it, as they have no settings and their counters are not scraped
+
+def decode_file(image_path, passes) -> Tuple[Optional[str], Optional[str]]:
+    with open(image_path, 'rb') as f:
+        gray = load_grayscale(f.read())
+    if gray is None:
+        return None, None
+    return _first_hit(gray, passes)
+
+
+def locate_image_bytes(data: bytes, passes):
+    gray = load_grayscale(data)
+    return [] if gray is None else locate_barcodes(gray, passes)
+
 
 def scan_barcode(image_path):
-    """Scan barcode from image file"""
-    image = cv2.imread(image_path)
-    barcodes = pyzbar.decode(image)
-    
-    if barcodes:
-        return barcodes[0].data.decode('utf-8')
-    return None
\ No newline at end of file
+    """Scan barcode from image file, on the decode pool when it is on. Raises DecodeUnavailable when it is full."""
+    if not settings.DECODE_POOL_ENABLED:
+        with open(image_path, 'rb') as f:
+            barcode, _ = decode_image_bytes(f.read())
+        return barcode
+    from . import decode_pool
+    barcode, name = decode_pool.run(decode_file, image_path, list(settings.BARCODE_DECODE_PASSES))
+    _count(name)
+    return barcode
+
+
+def locate_uploaded(data: bytes):
+    """locate_barcodes() for image file bytes, on the decode pool when it is on."""
+    passes = list(settings.BARCODE_DECODE_PASSES)
+    if not settings.DECODE_POOL_ENABLED:
+        return locate_image_bytes(data, passes)
+    from . import decode_pool
+    return decode_pool.run(locate_image_bytes, data, passes)
+
+
+def preload():
+    """Import the decoders and run one decode on a blank image, so their setup is done ahead of the first scan."""
+    import numpy as np
+    run_pass("full", np.full((64, 64), 255, dtype=np.uint8))
@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.conf import settings
+from django.db import connections
+
+from . import barcode_scanner, product_lookup
+
+
+def decode_uploads(images):
+    """
+    Decode every barcode in every uploaded image. Barcodes seen more than
+    once (same code in two photos, or twice in one) are reported once,
+    tagged with the first image they appeared in.
+    """
+    found = {}
+    for image in images:
+        for item in barcode_scanner.locate_uploaded(image.read()):
+            if item["barcode"] not in found:
+                item["image"] = image.name
+                found[item["barcode"]] = item
+    return list(found.values())
+
+
+def _lookup(barcode):
+    try:
+        return product_lookup.fetch_product_data(barcode)
+    finally:
+        # Pool threads open their own DB connections; don't leak them
+        connections.close_all()
+
+
+def iter_lookups(barcodes, max_workers=None):
+    """
+    Look products up concurrently and yield (barcode, product, error) as each
+    lookup finishes, so a slow barcode never holds back the fast ones.
+    """
+    if not barcodes:
+        return
+    max_workers = max_workers or settings.SCAN_BATCH_LOOKUP_CONCURRENCY
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(barcodes))) as pool:
+        futures = {pool.submit(_lookup, barcode): barcode for barcode in barcodes}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, str(e)
@@ -0,0 +1,195 @@
+import logging
+import multiprocessing
+import os
+import resource
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DecodeUnavailable(Exception):
+    """The decode pool cannot decode this photo right now; the same request may work later. status is the HTTP answer."""
+    status = 503
+
+
+class DecodeQueueFull(DecodeUnavailable):
+    status = 429
+
+
+class DecodeTimedOut(DecodeUnavailable):
+    status = 503
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _started():
+    """Submitted once per worker by DecodePool.start(); returns once the worker is up."""
+
+
+def _call(fn, args, submitted, deadline):
+    """In a worker: fn(*args), unless the caller's deadline passed while the task was queued."""
+    started = time.time()
+    result = fn(*args) if started <= deadline else None
+    return result, started - submitted, _peak_rss_mb()
+
+
+class DecodePool:
+    """
+    Worker processes for CPU-bound decoding, so a burst of large photos
+    cannot tie up the request threads. At most workers + queue_size decodes
+    are admitted at once; past that run() fails fast with DecodeQueueFull.
+    A caller waits at most `timeout` seconds, and a decode still queued at
+    its deadline is skipped. OpenCV and zbar can leak in native code, so the
+    workers are replaced after max_tasks decodes each, when one's peak RSS
+    passes max_rss_mb, or when one crashes. initializer, when given, runs in
+    every new worker before its first task.
+    """
+
+    def __init__(self, workers, queue_size, timeout, max_tasks, max_rss_mb, start_method="spawn",
+                 initializer=None):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.timeout = timeout
+        self.max_tasks = max_tasks
+        self.max_rss_mb = max_rss_mb
+        self.start_method = start_method
+        self.initializer = initializer
+        # Executors don't survive fork; a forked server worker builds its own pool
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._executor = None
+        self._executor_tasks = 0
+
+    def _depth(self):
+        return max(self._pending - self.workers, 0)
+
+    def _finished(self, future):
+        with self._lock:
+            self._pending -= 1
+            metrics.DECODE_QUEUE_DEPTH.set(self._depth())
+
+    def _recycle(self, executor, reason):
+        """Swap in fresh workers; the old ones finish the tasks they hold and exit."""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        metrics.DECODE_POOL_EVENTS.inc(reason)
+        logger.info("Replacing the decode pool workers (%s)", reason)
+        executor.shutdown(wait=False)
+
+    def _current_executor(self):
+        # With self._lock held
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context(self.start_method),
+                initializer=self.initializer)
+            self._executor_tasks = 0
+        return self._executor
+
+    def start(self):
+        """Start every worker now instead of on the first decodes; does not wait for them."""
+        with self._lock:
+            executor = self._current_executor()
+        for _ in range(self.workers):
+            executor.submit(_started)
+
+    def _submit(self, fn, args, submitted, deadline):
+        with self._lock:
+            if self._pending >= self.capacity:
+                metrics.DECODE_POOL_EVENTS.inc("queue_full")
+                raise DecodeQueueFull("Too many photos are being decoded right now. Please try again in a moment.")
+            executor = self._current_executor()
+            future = executor.submit(_call, fn, args, submitted, deadline)
+            self._executor_tasks += 1
+            self._pending += 1
+            metrics.DECODE_QUEUE_DEPTH.set(self._depth())
+            worn_out = self._executor_tasks >= self.workers * self.max_tasks
+        future.add_done_callback(self._finished)
+        return executor, future, worn_out
+
+    def run(self, fn, *args, timeout=None):
+        """fn(*args) in a worker process; fn must be a module-level function. Raises DecodeUnavailable."""
+        timeout = self.timeout if timeout is None else timeout
+        submitted = time.time()
+        try:
+            executor, future, worn_out = self._submit(fn, args, submitted, submitted + timeout)
+        except BrokenProcessPool:
+            self._recycle(self._executor, "crashed")
+            raise DecodeUnavailable("The barcode decoder is restarting. Please try again.")
+
+        try:
+            result, waited, rss_mb = future.result(timeout=timeout)
+        except FuturesTimeout:
+            future.cancel()
+            metrics.DECODE_POOL_EVENTS.inc("timed_out")
+            raise DecodeTimedOut("Decoding the photo took too long. Please try again.")
+        except BrokenProcessPool:
+            self._recycle(executor, "crashed")
+            raise DecodeUnavailable("The barcode decoder stopped unexpectedly. Please try again.")
+
+        metrics.DECODE_WAIT_SECONDS.observe(waited)
+        if rss_mb > self.max_rss_mb:
+            self._recycle(executor, "memory")
+        elif worn_out:
+            self._recycle(executor, "tasks")
+        return result
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_start_after_fork = False
+
+
+def get_pool() -> DecodePool:
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            from .barcode_scanner import preload
+            _pool = DecodePool(
+                workers=settings.DECODE_POOL_WORKERS or os.cpu_count() or 1,
+                queue_size=settings.DECODE_POOL_QUEUE_SIZE,
+                timeout=settings.DECODE_POOL_TIMEOUT,
+                max_tasks=settings.DECODE_POOL_MAX_TASKS,
+                max_rss_mb=settings.DECODE_POOL_MAX_RSS_MB,
+                start_method=settings.DECODE_POOL_START_METHOD,
+                # Spawned workers see none of the parent's warm-up; they do their own
+                initializer=preload if settings.SCAN_WARMUP else None,
+            )
+        return _pool
+
+
+def start_after_fork():
+    """
+    Start the pool of every process forked from this one as soon as it is
+    forked, e.g. a pre-forking server's workers, so their first scans don't
+    wait for decode workers to spawn and load OpenCV and zbar.
+    """
+    global _start_after_fork
+    if _start_after_fork or not hasattr(os, "register_at_fork"):
+        return
+    _start_after_fork = True
+    # Off the forking thread: spawning processes there would hold up the new worker
+    os.register_at_fork(after_in_child=lambda: threading.Thread(
+        target=lambda: get_pool().start(), daemon=True).start())
+
+
+def run(fn, *args):
+    """fn(*args) on this process's decode pool."""
+    return get_pool().run(fn, *args)
@@ -0,0 +1,343 @@
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+from collections import Counter, defaultdict, namedtuple
+from django.conf import settings
+
+from .tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+Chunk = namedtuple("Chunk", "source text")
+
+STOPWORDS = frozenset("""
+a an and are as at be been but by can could did do does for from had has have how
+in into is it its may more most much not of on or such than that the their them
+then there these they this those to up was were what when which while who will
+with would should also other per than all any each
+""".split())
+
+# Words a nutrient level or health condition should pull into the query
+QUERY_TERMS = {
+    "sugars": ["sugar", "sugars", "free sugars", "sweetened"],
+    "salt": ["salt", "sodium"],
+    "fat": ["fat", "fats", "unsaturated"],
+    "saturated-fat": ["saturated fat", "trans fat"],
+    "fiber": ["fibre", "fiber", "whole grains"],
+    "energy": ["energy", "calories", "intake"],
+    "diabetes": ["diabetes", "sugar", "free sugars"],
+    "hypertension": ["hypertension", "blood pressure", "salt", "sodium"],
+    "blood pressure": ["hypertension", "blood pressure", "salt", "sodium"],
+    "heart": ["heart disease", "cardiovascular", "saturated fat", "trans fat"],
+    "cholesterol": ["saturated fat", "trans fat", "heart disease"],
+    "obesity": ["weight gain", "overweight", "obese", "energy"],
+    "weight": ["weight gain", "overweight", "energy", "calories"],
+    "kidney": ["salt", "sodium", "potassium"],
+}
+
+
+def tokenize(text):
+    words = re.findall(r"[a-z0-9]+", text.lower())
+    # Crude plural folding so "sugars" matches "sugar"
+    return [w[:-1] if len(w) > 3 and w.endswith("s") else w for w in words if w not in STOPWORDS]
+
+
+# Cache dictionary for already processed PDFs
+_pdf_cache = {}
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_mtime, stat.st_size]
+
+
+# Utility: Cache PDF parsing to avoid re-processing
+def extract_pdf_text(file_path):
+    # Keyed on mtime/size: a stat call instead of hashing the whole file
+    key = tuple(_file_signature(file_path))
+    if key in _pdf_cache:
+        return _pdf_cache[key]
+    import fitz  # PyMuPDF, only needed when there is no prebuilt artifact
+    with fitz.open(file_path) as doc:
+        full_text = "\n".join([page.get_text() for page in doc])
+    _pdf_cache[key] = full_text
+    return full_text
+
+
+def load_document_text(path):
+    if path.lower().endswith(".pdf"):
+        return extract_pdf_text(path)
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def normalize_text(text):
+    # PyMuPDF renders list bullets as a stray "n" before a tab
+    text = re.sub(r"(^|\n)n\t", r"\1", text)
+    # Page headers carry the source URL
+    text = re.sub(r"https?://\S+", " ", text)
+    return " ".join(text.split())
+
+
+def chunk_text(text, source, chunk_words=None):
+    """Split text into chunks of whole sentences of about chunk_words words."""
+    chunk_words = chunk_words or settings.GUIDANCE_CHUNK_WORDS
+    sentences = re.split(r"(?<=[.!?])\s+", normalize_text(text))
+    chunks, current, size = [], [], 0
+    for sentence in sentences:
+        words = len(sentence.split())
+        if current and size + words > chunk_words:
+            chunks.append(Chunk(source, " ".join(current)))
+            current, size = [], 0
+        current.append(sentence)
+        size += words
+    if current:
+        chunks.append(Chunk(source, " ".join(current)))
+    return chunks
+
+
+class BM25Index:
+    """
+    Okapi BM25 over a fixed list of chunks, fully in memory. documents, when
+    given, holds the path of the file each chunk came from.
+    """
+    k1 = 1.5
+    b = 0.75
+
+    def __init__(self, chunks, documents=None):
+        self.chunks = chunks
+        self.documents = documents
+        self.postings = defaultdict(list)  # term -> [(chunk index, term frequency)]
+        self.lengths = []
+        for index, chunk in enumerate(chunks):
+            terms = Counter(tokenize(chunk.text))
+            self.lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                self.postings[term].append((index, tf))
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+        total = len(chunks)
+        self.idf = {
+            term: math.log(1 + (total - len(posts) + 0.5) / (len(posts) + 0.5))
+            for term, posts in self.postings.items()
+        }
+
+    def term_postings(self, term):
+        return self.postings.get(term, ())
+
+    def chunk(self, index):
+        return self.chunks[index]
+
+    def search(self, query, k=5):
+        """[(score, chunk)] for the k best-matching chunks, best first."""
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for index, tf in self.term_postings(term):
+                index, tf = int(index), int(tf)
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[index] / self.avg_length)
+                scores[index] += idf * tf * (self.k1 + 1) / (tf + norm)
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(score, self.chunk(index)) for index, score in best]
+
+
+# On-disk artifact layout:
+#   MAGIC | uint32 header length | header JSON | uint32 postings (pairs) | UTF-8 chunk text
+ARTIFACT_MAGIC = b"NSGUIDE\0"
+ARTIFACT_VERSION = 1
+
+
+def write_artifact(index, paths, target):
+    """Serialize a BM25Index built from paths to target, atomically."""
+    import numpy as np
+    terms, postings = {}, []
+    for term in sorted(index.postings):
+        posts = index.postings[term]
+        terms[term] = [len(postings) // 2, len(posts), index.idf[term]]
+        for chunk_index, tf in posts:
+            postings.extend((chunk_index, tf))
+
+    # Chunks point at their document by position in paths: two files may share a base name
+    if index.documents is None:
+        raise ValueError("The index does not record which document each chunk came from")
+    positions = {path: position for position, path in enumerate(paths)}
+    sources = [os.path.basename(path) for path in paths]
+    texts, chunks, offset = [], [], 0
+    for chunk, document in zip(index.chunks, index.documents):
+        encoded = chunk.text.encode("utf-8")
+        chunks.append([positions[document], offset, len(encoded)])
+        texts.append(encoded)
+        offset += len(encoded)
+
+    header = json.dumps({
+        "version": ARTIFACT_VERSION,
+        "sources": [_file_signature(path) for path in paths],
+        "source_names": sources,
+        "chunk_words": settings.GUIDANCE_CHUNK_WORDS,
+        "chunks": chunks,
+        "lengths": index.lengths,
+        "avg_length": index.avg_length,
+        "terms": terms,
+    }).encode("utf-8")
+    header += b" " * (-len(header) % 4)  # keep the postings array 4-byte aligned
+
+    tmp_path = f"{target}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(ARTIFACT_MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        f.write(np.asarray(postings, dtype="<u4").tobytes())
+        f.write(b"".join(texts))
+    os.replace(tmp_path, target)
+
+
+class ArtifactIndex(BM25Index):
+    """
+    BM25Index backed by a memory-mapped artifact. Postings and chunk text are
+    read straight from the mapping, so every worker shares the same pages.
+    """
+
+    def __init__(self, path):
+        import numpy as np  # only processes that retrieve guidance need it
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(ARTIFACT_MAGIC)] != ARTIFACT_MAGIC:
+            raise ValueError(f"{path} is not a guidance artifact")
+        start = len(ARTIFACT_MAGIC)
+        (header_length,) = struct.unpack_from("<I", self._mmap, start)
+        start += 4
+        self.header = json.loads(self._mmap[start:start + header_length])
+        start += header_length
+
+        terms = self.header["terms"]
+        postings_count = sum(count for _, count, _ in terms.values())
+        self._postings = np.frombuffer(self._mmap, dtype="<u4", count=postings_count * 2, offset=start)
+        self._text_start = start + postings_count * 8
+
+        self._terms = terms
+        self.idf = {term: idf for term, (_, _, idf) in terms.items()}
+        self.lengths = self.header["lengths"]
+        self.avg_length = self.header["avg_length"]
+
+    def matches(self, paths):
+        """True when the artifact was built from these files as they are now."""
+        try:
+            current = [_file_signature(path) for path in paths]
+        except OSError:
+            return False
+        return (self.header["version"] == ARTIFACT_VERSION
+                and self.header["sources"] == current
+                and self.header["chunk_words"] == settings.GUIDANCE_CHUNK_WORDS)
+
+    def term_postings(self, term):
+        entry = self._terms.get(term)
+        if entry is None:
+            return ()
+        first, count, _ = entry
+        return self._postings[first * 2:(first + count) * 2].reshape(-1, 2)
+
+    def chunk(self, index):
+        source, offset, length = self.header["chunks"][index]
+        start = self._text_start + offset
+        text = self._mmap[start:start + length].decode("utf-8")
+        return Chunk(self.header["source_names"][source], text)
+
+    @property
+    def chunks(self):
+        return [self.chunk(index) for index in range(len(self.header["chunks"]))]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _signature(paths):
+    return tuple((path, os.path.getmtime(path), os.path.getsize(path)) for path in paths)
+
+
+def build_index(paths):
+    chunks, documents = [], []
+    for path in paths:
+        document = chunk_text(load_document_text(path), os.path.basename(path))
+        chunks.extend(document)
+        documents.extend([path] * len(document))
+    return BM25Index(chunks, documents)
+
+
+def _load_artifact(paths):
+    """(index, None) for a prebuilt artifact that matches the documents, else (None, why not)."""
+    artifact_path = settings.GUIDANCE_ARTIFACT
+    if not artifact_path:
+        return None, "GUIDANCE_ARTIFACT is not set"
+    if not os.path.exists(artifact_path):
+        return None, f"{artifact_path} does not exist"
+    try:
+        index = ArtifactIndex(artifact_path)
+    except (OSError, ValueError) as e:
+        return None, f"{artifact_path} is unreadable ({e})"
+    if not index.matches(paths):
+        return None, f"{artifact_path} is out of date"
+    return index, None
+
+
+def get_index(paths=None):
+    """
+    BM25 index over the guidance documents. The build_guidance artifact is
+    memory-mapped when it is up to date; otherwise the documents are parsed
+    in-process. Either way it is rebuilt only when a file's mtime or size changes.
+    """
+    paths = tuple(paths or settings.GUIDANCE_DOCUMENTS)
+    signature = _signature(paths)
+    with _indexes_lock:
+        cached = _indexes.get(paths)
+        if cached and cached[0] == signature:
+            return cached[1]
+    index, reason = _load_artifact(paths)
+    if index is None:
+        if any(path.lower().endswith(".pdf") for path in paths):
+            logger.warning("Parsing the guidance PDFs in-process, which is slow: %s. "
+                           "Run build_guidance to fix this.", reason)
+        index = build_index(paths)
+    with _indexes_lock:
+        _indexes[paths] = (signature, index)
+    return index
+
+
+def build_query(product_info, health_conditions=None, goal=None):
+    """Query terms from the product's notable nutrients and the user's conditions and goal."""
+    terms = []
+    for nutrient, level in (product_info.get("nutrient_levels") or {}).items():
+        if level in ("high", "moderate"):
+            terms.extend(QUERY_TERMS.get(nutrient, [nutrient.replace("-", " ")]))
+    profile = f"{health_conditions or ''} {goal or ''}".lower()
+    for keyword, related in QUERY_TERMS.items():
+        if keyword in profile:
+            terms.extend(related)
+    terms.extend(tokenize(profile))
+    return " ".join(terms) or "healthy diet"
+
+
+def retrieve(query, token_budget=None, k=None, paths=None):
+    """Best chunks for the query, in rank order, that fit in token_budget tokens together."""
+    token_budget = token_budget or settings.GUIDANCE_TOKEN_BUDGET
+    k = k or settings.GUIDANCE_TOP_K
+    selected, used = [], 0
+    for _, chunk in get_index(paths).search(query, k):
+        size = count_tokens(chunk.text)
+        if used + size > token_budget:
+            continue
+        selected.append(chunk)
+        used += size
+    return selected
+
+
+def relevant_guidance(product_info, health_conditions=None, goal=None, paths=None):
+    """Guidance text to put in the prompt for this product and user."""
+    chunks = retrieve(build_query(product_info, health_conditions, goal), paths=paths)
+    return "\n\n".join(chunk.text for chunk in chunks)
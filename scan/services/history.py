@@ -0,0 +1,71 @@
+import base64
+import json
+from datetime import datetime, time, timedelta
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from scan.models import ProductScan
+
+# Columns a history row needs; the nutriments JSON stays on disk
+HISTORY_FIELDS = ('id', 'barcode', 'product_name', 'scan_date', 'advisability', 'nutriscore_grade')
+
+
+def encode_cursor(scan):
+    """Opaque cursor pointing just past scan in newest-first order."""
+    payload = json.dumps([scan.scan_date.isoformat(), scan.id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """(scan_date, id) from encode_cursor(). Raises ValueError on anything else."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        scan_date, scan_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        scan_date = parse_datetime(scan_date)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+    if scan_date is None or not isinstance(scan_id, int):
+        raise ValueError("Invalid cursor")
+    return scan_date, scan_id
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def search_scans(user_id, barcode=None, query=None, date_from=None, date_to=None, cursor=None, limit=20):
+    """
+    One page of a user's scans, newest first, and the cursor for the next page
+    (None on the last page). Pages are found by keyset on (scan_date, id)
+    against the (user, -scan_date, -id) index, so a page costs the same however
+    far back it is. date_from/date_to are inclusive dates.
+    """
+    scans = ProductScan.objects.filter(user_id=user_id)
+    if barcode:
+        scans = scans.filter(barcode=barcode)
+    if query:
+        scans = scans.filter(product_name__icontains=query)
+    if date_from:
+        scans = scans.filter(scan_date__gte=_day_start(date_from))
+    if date_to:
+        scans = scans.filter(scan_date__lt=_day_start(date_to + timedelta(days=1)))
+    if cursor:
+        scan_date, scan_id = decode_cursor(cursor)
+        scans = scans.filter(Q(scan_date__lt=scan_date) | Q(scan_date=scan_date, id__lt=scan_id))
+
+    page = list(scans.only(*HISTORY_FIELDS).order_by('-scan_date', '-id')[:limit + 1])
+    next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+    return page[:limit], next_cursor
+
+
+def scan_summary(scan):
+    """JSON-friendly view of a history row."""
+    return {
+        "id": scan.id,
+        "barcode": scan.barcode,
+        "product_name": scan.product_name,
+        "scan_date": scan.scan_date.isoformat(),
+        "advisability": scan.advisability,
+        "nutriscore_grade": scan.nutriscore_grade,
+    }
@@ -0,0 +1,446 @@
+import asyncio
+import json
+import re
+import threading
+import time
+from collections import namedtuple
+from typing import Dict, Iterator, List
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+from asgiref.sync import sync_to_async
+
+from . import metrics
+from .aio import LoopLocal
+
+# text is the full reply; backend and model say who actually produced it
+Reply = namedtuple("Reply", "text backend model")
+
+
+class BackendUnavailable(Exception):
+    """No backend could take the request: circuits open, slots full or every attempt failed."""
+
+
+class InferenceBackend:
+    """
+    One way of running a chat completion. Subclasses implement chat() and
+    stream_chat(); timeouts are passed to the underlying client so a hung
+    upstream raises instead of holding a worker. achat() runs chat() on a
+    worker thread unless the backend has a native async client.
+    With a JSON schema given, backends that support constrained decoding
+    (and have structured_output on) only let the model produce matching JSON.
+    """
+    name = "base"
+
+    def __init__(self, model, timeout=30, structured_output=True, **options):
+        self.model = model
+        self.timeout = timeout
+        self.structured_output = structured_output
+        self.options = options
+
+    def _schema(self, schema):
+        return schema if self.structured_output else None
+
+    def chat(self, messages: List[Dict], max_tokens: int, temperature: float, schema: Dict = None) -> str:
+        raise NotImplementedError
+
+    def stream_chat(self, messages: List[Dict], max_tokens: int, temperature: float,
+                    schema: Dict = None) -> Iterator[str]:
+        raise NotImplementedError
+
+    async def achat(self, messages: List[Dict], max_tokens: int, temperature: float, schema: Dict = None) -> str:
+        return await sync_to_async(self.chat, thread_sensitive=False)(messages, max_tokens, temperature, schema)
+
+
+class HuggingFaceBackend(InferenceBackend):
+    """Hugging Face Inference Providers, or any OpenAI-compatible server through BASE_URL."""
+    name = "huggingface"
+
+    def __init__(self, model, timeout=30, provider=None, api_key=None, base_url=None, **options):
+        super().__init__(model, timeout, **options)
+        from huggingface_hub import InferenceClient
+        if base_url:
+            client_options = dict(base_url=base_url, api_key=api_key or None, timeout=timeout)
+        else:
+            client_options = dict(provider=provider, api_key=api_key or None, timeout=timeout)
+        self.client = InferenceClient(**client_options)
+        self._async_clients = LoopLocal(lambda: self._async_client(client_options))
+
+    @staticmethod
+    def _async_client(client_options):
+        from huggingface_hub import AsyncInferenceClient
+        return AsyncInferenceClient(**client_options)
+
+    def _request(self, messages, max_tokens, temperature, schema):
+        request = dict(model=self.model, messages=messages, max_tokens=max_tokens, temperature=temperature)
+        if self._schema(schema):
+            request["response_format"] = {"type": "json_schema",
+                                          "json_schema": {"name": "verdict", "schema": schema, "strict": True}}
+        return request
+
+    def chat(self, messages, max_tokens, temperature, schema=None):
+        response = self.client.chat_completion(**self._request(messages, max_tokens, temperature, schema))
+        return response.choices[0].message["content"]
+
+    def stream_chat(self, messages, max_tokens, temperature, schema=None):
+        for chunk in self.client.chat_completion(**self._request(messages, max_tokens, temperature, schema),
+                                                 stream=True):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def achat(self, messages, max_tokens, temperature, schema=None):
+        response = await self._async_clients.get().chat_completion(
+            **self._request(messages, max_tokens, temperature, schema))
+        return response.choices[0].message["content"]
+
+
+class OllamaBackend(InferenceBackend):
+    """A local or self-hosted Ollama server."""
+    name = "ollama"
+
+    def __init__(self, model, timeout=60, host=None, **options):
+        super().__init__(model, timeout, **options)
+        import ollama
+        self.client = ollama.Client(host=host or None, timeout=timeout)
+        self._async_clients = LoopLocal(lambda: ollama.AsyncClient(host=host or None, timeout=timeout))
+
+    def _request(self, messages, max_tokens, temperature, schema):
+        request = dict(model=self.model, messages=messages,
+                       options={"num_predict": max_tokens, "temperature": temperature})
+        if self._schema(schema):
+            # Ollama turns a JSON schema into a decoding grammar
+            request["format"] = schema
+        return request
+
+    def chat(self, messages, max_tokens, temperature, schema=None):
+        response = self.client.chat(**self._request(messages, max_tokens, temperature, schema))
+        return response["message"]["content"]
+
+    def stream_chat(self, messages, max_tokens, temperature, schema=None):
+        for chunk in self.client.chat(**self._request(messages, max_tokens, temperature, schema), stream=True):
+            content = chunk["message"]["content"]
+            if content:
+                yield content
+
+    async def achat(self, messages, max_tokens, temperature, schema=None):
+        response = await self._async_clients.get().chat(**self._request(messages, max_tokens, temperature, schema))
+        return response["message"]["content"]
+
+
+class StubBackend(InferenceBackend):
+    """
+    Deterministic stand-in that answers from the Nutri-Score in the prompt.
+    No network, same reply for the same prompt: for tests, local development
+    and as a last-resort fallback.
+    """
+    name = "stub"
+    GRADE_PATTERN = re.compile(r"Nutri-Score:\s*([a-e])\b", re.IGNORECASE)
+
+    def chat(self, messages, max_tokens, temperature, schema=None):
+        prompt = messages[-1]["content"] if messages else ""
+        match = self.GRADE_PATTERN.search(prompt)
+        grade = match.group(1).upper() if match else None
+        if grade in ("D", "E"):
+            verdict = {"advisability": "No",
+                       "summary": f"This product has a Nutri-Score of {grade}, so it is best kept as an occasional choice."}
+        elif grade:
+            verdict = {"advisability": "Yes",
+                       "summary": f"This product has a Nutri-Score of {grade} and fits a balanced diet in normal portions."}
+        else:
+            verdict = {"advisability": "Yes",
+                       "summary": "There is no Nutri-Score for this product; check the label and eat it in moderation."}
+        return json.dumps(verdict)
+
+    def stream_chat(self, messages, max_tokens, temperature, schema=None):
+        reply = self.chat(messages, max_tokens, temperature)
+        for start in range(0, len(reply), 16):
+            yield reply[start:start + 16]
+
+    async def achat(self, messages, max_tokens, temperature, schema=None):
+        return self.chat(messages, max_tokens, temperature)
+
+
+class CircuitBreaker:
+    """
+    Classic closed/open/half-open breaker. After failure_threshold failures in
+    a row the circuit opens and allow() refuses calls for reset_timeout
+    seconds; then a single trial call is let through, and its outcome closes
+    or re-opens the circuit.
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def cancel_trial(self):
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class GuardedBackend:
+    """A backend plus its in-flight cap, circuit breaker and counters."""
+
+    def __init__(self, name, backend, max_concurrency, breaker):
+        self.name = name
+        self.backend = backend
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.breaker = breaker
+        self.stats = {"calls": 0, "failures": 0, "rejected": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _check_circuit(self):
+        if not self.breaker.allow():
+            self._count("rejected")
+            raise BackendUnavailable(f"{self.name}: circuit open")
+
+    def _busy(self):
+        # Being busy says nothing about health, so give back a half-open trial untouched
+        self.breaker.cancel_trial()
+        self._count("rejected")
+        return BackendUnavailable(f"{self.name}: too many requests in flight")
+
+    def acquire(self):
+        """Take a slot, or raise BackendUnavailable without contacting the backend."""
+        self._check_circuit()
+        if not self.slots.acquire(timeout=settings.INFERENCE_QUEUE_TIMEOUT):
+            raise self._busy()
+        self._count("calls")
+
+    async def aacquire(self):
+        """acquire() that waits for a slot without blocking the event loop."""
+        self._check_circuit()
+        deadline = time.monotonic() + settings.INFERENCE_QUEUE_TIMEOUT
+        try:
+            while not self.slots.acquire(blocking=False):
+                if time.monotonic() >= deadline:
+                    raise self._busy()
+                await asyncio.sleep(0.01)
+        except asyncio.CancelledError:
+            self.breaker.cancel_trial()
+            raise
+        self._count("calls")
+
+    def release(self, ok):
+        self.slots.release()
+        if ok:
+            self.breaker.record_success()
+        else:
+            self._count("failures")
+            self.breaker.record_failure()
+
+
+class InferenceRouter:
+    """Sends each request to the primary backend, or to the fallback while the primary is unhealthy."""
+
+    def __init__(self, primary, fallback=None):
+        self.primary = primary
+        self.fallback = fallback
+        self.fallbacks = 0
+
+    @property
+    def candidates(self):
+        return [guarded for guarded in (self.primary, self.fallback) if guarded is not None]
+
+    def chat(self, messages, max_tokens=400, temperature=0.7, schema=None) -> Reply:
+        errors = []
+        for guarded in self.candidates:
+            try:
+                guarded.acquire()
+            except BackendUnavailable as e:
+                errors.append(str(e))
+                continue
+            ok = False
+            try:
+                text = guarded.backend.chat(messages, max_tokens, temperature, schema)
+                ok = True
+            except Exception as e:
+                metrics.UPSTREAM_ERRORS.inc(guarded.name)
+                errors.append(f"{guarded.name}: {e}")
+                continue
+            finally:
+                guarded.release(ok)
+            if guarded is not self.primary:
+                self.fallbacks += 1
+            return Reply(text, guarded.name, guarded.backend.model)
+        raise BackendUnavailable("; ".join(errors))
+
+    async def achat(self, messages, max_tokens=400, temperature=0.7, schema=None) -> Reply:
+        """chat() for async callers; slots and breakers are shared with the sync path."""
+        errors = []
+        for guarded in self.candidates:
+            try:
+                await guarded.aacquire()
+            except BackendUnavailable as e:
+                errors.append(str(e))
+                continue
+            ok = False
+            try:
+                text = await guarded.backend.achat(messages, max_tokens, temperature, schema)
+                ok = True
+            except asyncio.CancelledError:
+                # The request went away; that is not the backend's fault
+                ok = True
+                raise
+            except Exception as e:
+                metrics.UPSTREAM_ERRORS.inc(guarded.name)
+                errors.append(f"{guarded.name}: {e}")
+                continue
+            finally:
+                guarded.release(ok)
+            if guarded is not self.primary:
+                self.fallbacks += 1
+            return Reply(text, guarded.name, guarded.backend.model)
+        raise BackendUnavailable("; ".join(errors))
+
+    def stream(self, messages, max_tokens=400, temperature=0.7, schema=None) -> "StreamReply":
+        return StreamReply(self, messages, max_tokens, temperature, schema)
+
+
+class StreamReply:
+    """
+    Iterable over the pieces of a streamed reply. A backend that fails before
+    its first piece is skipped in favour of the next one; once text has been
+    yielded, errors propagate. backend and model are set when the first piece
+    arrives. Closing the iterator early closes the backend's stream, which
+    stops generation upstream.
+    """
+
+    def __init__(self, router, messages, max_tokens, temperature, schema=None):
+        self.router = router
+        self.messages = messages
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.schema = schema
+        self.backend = None
+        self.model = None
+
+    def __iter__(self):
+        errors = []
+        for guarded in self.router.candidates:
+            try:
+                guarded.acquire()
+            except BackendUnavailable as e:
+                errors.append(str(e))
+                continue
+            started, ok = False, False
+            pieces = guarded.backend.stream_chat(self.messages, self.max_tokens, self.temperature, self.schema)
+            try:
+                for piece in pieces:
+                    if not started:
+                        started = True
+                        self.backend, self.model = guarded.name, guarded.backend.model
+                        if guarded is not self.router.primary:
+                            self.router.fallbacks += 1
+                    yield piece
+                ok = True
+            except GeneratorExit:
+                # The caller stopped reading; that is not the backend's fault
+                ok = True
+                raise
+            except Exception as e:
+                metrics.UPSTREAM_ERRORS.inc(guarded.name)
+                if started:
+                    raise
+                errors.append(f"{guarded.name}: {e}")
+                continue
+            finally:
+                if hasattr(pieces, "close"):
+                    pieces.close()
+                guarded.release(ok)
+            return
+        raise BackendUnavailable("; ".join(errors))
+
+
+def create_backend(name) -> GuardedBackend:
+    """Build the backend configured under INFERENCE_BACKENDS[name]."""
+    config = dict(settings.INFERENCE_BACKENDS[name])
+    backend_class = import_string(config.pop("CLASS"))
+    max_concurrency = config.pop("MAX_CONCURRENCY", 4)
+    backend = backend_class(**{key.lower(): value for key, value in config.items()})
+    breaker = CircuitBreaker(settings.INFERENCE_BREAKER_THRESHOLD, settings.INFERENCE_BREAKER_RESET)
+    return GuardedBackend(name, backend, max_concurrency, breaker)
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> InferenceRouter:
+    """The process-wide router, built on first use from INFERENCE_BACKEND and INFERENCE_FALLBACK_BACKEND."""
+    global _router
+    with _router_lock:
+        if _router is None:
+            primary = create_backend(settings.INFERENCE_BACKEND)
+            fallback_name = settings.INFERENCE_FALLBACK_BACKEND
+            fallback = None
+            if fallback_name and fallback_name != settings.INFERENCE_BACKEND:
+                fallback = create_backend(fallback_name)
+            _router = InferenceRouter(primary, fallback)
+        return _router
+
+
+def reset_router(**kwargs):
+    global _router
+    if kwargs.get("setting", "INFERENCE_").startswith("INFERENCE_"):
+        with _router_lock:
+            _router = None
+
+
+setting_changed.connect(reset_router)
+
+
+def primary_model() -> str:
+    """Model of the configured primary backend, read from settings so no client is built."""
+    return settings.INFERENCE_BACKENDS[settings.INFERENCE_BACKEND]["MODEL"]
+
+
+def backend_stats() -> Dict:
+    """Per-backend counters and circuit state, plus how many replies came from the fallback."""
+    router = get_router()
+    stats = {guarded.name: dict(guarded.stats, circuit=guarded.breaker.state) for guarded in router.candidates}
+    stats["fallbacks"] = router.fallbacks
+    return stats
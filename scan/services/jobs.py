@@ -0,0 +1,115 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from scan.models import ScanJob
+from .pipeline import run_scan, scan_storage, ScanError
+
+# stage name -> semaphore limiting jobs inside that stage in this process
+_stage_limits = {}
+_stage_limits_lock = threading.Lock()
+
+
+def _stage_semaphore(name):
+    with _stage_limits_lock:
+        if name not in _stage_limits:
+            _stage_limits[name] = threading.BoundedSemaphore(settings.SCAN_STAGE_CONCURRENCY.get(name, 1))
+        return _stage_limits[name]
+
+
+def enqueue_scan(user_id, filename):
+    """
+    Queue a scan for an uploaded file. Calling it again while that scan is
+    still pending returns the existing job; uploads are content-addressed, so
+    a finished scan of the same photo gets a fresh job.
+    """
+    pending = [ScanJob.QUEUED] + ScanJob.ACTIVE_STATUSES
+    job = (ScanJob.objects.filter(user_id=user_id, filename=filename, status__in=pending)
+           .order_by('-id').first())
+    if job is None:
+        job = ScanJob.objects.create(user_id=user_id, filename=filename)
+    return job
+
+
+def claim_next_job(worker_id):
+    """
+    Atomically move the oldest due job from queued to decoding and return it,
+    or None when nothing is due. The conditional UPDATE makes sure two
+    workers never pick up the same job.
+    """
+    now = timezone.now()
+    candidates = list(
+        ScanJob.objects
+        .filter(status=ScanJob.QUEUED, next_attempt_at__lte=now)
+        .order_by('next_attempt_at', 'id')
+        .values_list('pk', flat=True)[:10]
+    )
+    for pk in candidates:
+        claimed = ScanJob.objects.filter(pk=pk, status=ScanJob.QUEUED).update(
+            status=ScanJob.DECODING,
+            locked_by=worker_id,
+            locked_at=now,
+            attempts=F('attempts') + 1,
+            updated_at=now,
+        )
+        if claimed:
+            return ScanJob.objects.select_related('user').get(pk=pk)
+    return None
+
+
+def requeue_stale_jobs():
+    """Put jobs held by a worker that died mid-scan back in the queue."""
+    cutoff = timezone.now() - timedelta(seconds=settings.SCAN_JOB_LOCK_TIMEOUT)
+    stale = ScanJob.objects.filter(status__in=ScanJob.ACTIVE_STATUSES, locked_at__lt=cutoff)
+    stale.filter(attempts__gte=settings.SCAN_JOB_MAX_ATTEMPTS).update(
+        status=ScanJob.FAILED, error="Scan timed out.", locked_by='')
+    return stale.update(status=ScanJob.QUEUED, next_attempt_at=timezone.now(), locked_by='')
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=settings.SCAN_JOB_RETRY_BACKOFF * 2 ** max(attempts - 1, 0))
+
+
+def _save(job, **fields):
+    for name, value in fields.items():
+        setattr(job, name, value)
+    job.save(update_fields=list(fields) + ['updated_at'])
+
+
+def run_job(job):
+    """Run a claimed job through the scan pipeline and record the outcome."""
+    @contextmanager
+    def stage(name):
+        if job.status != name:
+            _save(job, status=name)
+        with _stage_semaphore(name):
+            yield
+
+    last_flush = [0.0]
+
+    def on_partial(text, advisability):
+        # Throttle writes, but publish the verdict the moment it appears
+        now = time.monotonic()
+        new_verdict = advisability and advisability != job.advisability
+        if new_verdict or now - last_flush[0] >= settings.SCAN_PARTIAL_FLUSH_INTERVAL:
+            _save(job, partial_output=text, advisability=advisability or '')
+            last_flush[0] = now
+
+    try:
+        results = run_scan(job.user, scan_storage().path(job.filename), stage=stage, on_partial=on_partial)
+    except ScanError as e:
+        _save(job, status=ScanJob.FAILED, error=str(e), locked_by='')
+    except Exception as e:
+        if job.attempts >= settings.SCAN_JOB_MAX_ATTEMPTS:
+            _save(job, status=ScanJob.FAILED, error=str(e), locked_by='')
+        else:
+            _save(job, status=ScanJob.QUEUED, error=str(e), locked_by='', partial_output='', advisability='',
+                  next_attempt_at=timezone.now() + retry_delay(job.attempts))
+    else:
+        _save(job, status=ScanJob.DONE, scan_id=results['scan_id'], error='', locked_by='',
+              advisability=results['analysis']['advisability'])
+    return job
@@ -0,0 +1,221 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; scan stages range from sub-millisecond cache hits to LLM calls
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (100, 250, 500, 750, 1000, 1500, 2000, 3000, 4000, 8000)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(name, value, **extra):
+    pairs = ([(name, value)] if name else []) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(val)}"' for key, val in pairs) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Fixed-bucket histogram, optionally split by one label. observe() is a bisect and a locked add."""
+
+    def __init__(self, name, help_text, buckets, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._series = {}  # label value -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=""):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, total, count) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels(self.label, label_value, le=bound)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label, label_value)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label, label_value)} {count}")
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Counter:
+    """Monotonic counter, optionally split by one label."""
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value="", amount=1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def value(self, label_value=""):
+        with self._lock:
+            return self._values.get(label_value, 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_labels(self.label, key)} {_number(value)}" for key, value in values)
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Gauge:
+    """Current value (queue depth, pool size), optionally split by one label."""
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, label_value=""):
+        with self._lock:
+            self._values[label_value] = value
+
+    def value(self, label_value=""):
+        with self._lock:
+            return self._values.get(label_value, 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        lines.extend(f"{self.name}{_labels(self.label, key)} {_number(value)}" for key, value in values)
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+STAGE_SECONDS = Histogram("nutriscan_stage_seconds", "Time spent in each scan stage.", STAGE_BUCKETS, label="stage")
+PROMPT_TOKENS = Histogram("nutriscan_prompt_tokens", "Estimated tokens per LLM prompt.", TOKEN_BUCKETS)
+DECODE_FAILURES = Counter("nutriscan_decode_failures_total", "Scans whose photo had no readable barcode.")
+UPSTREAM_ERRORS = Counter("nutriscan_upstream_errors_total",
+                          "Failed calls to Open Food Facts or an inference backend.", label="upstream")
+VERDICT_RETRIES = Counter("nutriscan_verdict_retries_total",
+                          "Repair requests after an LLM reply with no usable verdict, by outcome.", label="result")
+DECODE_QUEUE_DEPTH = Gauge("nutriscan_decode_queue_depth", "Decodes waiting for a free decode pool worker.")
+DECODE_WAIT_SECONDS = Histogram("nutriscan_decode_wait_seconds",
+                                "Time a decode waited in the queue before a pool worker started it.", STAGE_BUCKETS)
+DECODE_POOL_EVENTS = Counter("nutriscan_decode_pool_events_total",
+                             "Decode pool rejections, timeouts, crashes and recycles.", label="event")
+INFERENCE_TOKENS = Counter("nutriscan_inference_tokens_total",
+                           "LLM tokens (prompt and reply) used by admitted analyses, by first or repeat scan.",
+                           label="scan")
+INFERENCE_REJECTIONS = Counter("nutriscan_inference_rejections_total",
+                               "Analyses refused an LLM call by admission control, by reason.", label="reason")
+INFERENCE_FALLBACKS = Counter("nutriscan_inference_fallbacks_total",
+                              "Answers given instead of a refused LLM call, by where they came from.", label="source")
+METRICS = [STAGE_SECONDS, PROMPT_TOKENS, DECODE_FAILURES, UPSTREAM_ERRORS, VERDICT_RETRIES,
+           DECODE_QUEUE_DEPTH, DECODE_WAIT_SECONDS, DECODE_POOL_EVENTS,
+           INFERENCE_TOKENS, INFERENCE_REJECTIONS, INFERENCE_FALLBACKS]
+
+# (stage, seconds) for the current request, while the timing header is on
+_request_timings = contextvars.ContextVar("nutriscan_request_timings", default=None)
+
+
+@contextmanager
+def span(stage):
+    """Time a block into STAGE_SECONDS{stage} and, when collecting, the current request's timings."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+@contextmanager
+def collect_timings():
+    """Collect the spans run by this request (and the threads/tasks it starts with its context)."""
+    timings = []
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def _stats_families():
+    """Counters the services already keep, as (name, help, label, values)."""
+    from . import analysis_cache, barcode_scanner, prefetch, product_lookup, rules, uploads
+    product = product_lookup.cache_stats()
+    analysis = analysis_cache.cache_stats()
+    upload = uploads.upload_stats()
+    rule = rules.rule_stats()
+    speculative = prefetch.prefetch_stats()
+    return [
+        ("nutriscan_product_lookups_total", "Product lookups by where the answer came from.", "result", product),
+        ("nutriscan_analysis_cache_total", "Analysis cache lookups by outcome.", "result",
+         {key: analysis[key] for key in ("hits", "misses", "expired")}),
+        ("nutriscan_decode_cache_total", "Barcode decodes served from the per-image cache.", "result",
+         {"hit": upload["decode_hits"], "miss": upload["decode_misses"]}),
+        ("nutriscan_uploads_total", "Uploads written vs. already on disk.", "result",
+         {"stored": upload["stored"], "deduplicated": upload["deduplicated"]}),
+        ("nutriscan_decode_passes_total", "Barcode decodes by the pass that found the barcode.", "pass",
+         barcode_scanner.decode_stats()),
+        ("nutriscan_rule_verdicts_total", "Analyses by whether the rules decided them.", "result",
+         {key: rule[key] for key in ("fast_path", "inconclusive")}),
+        ("nutriscan_prefetch_total", "Speculative upload-time work by outcome.", "result",
+         {key: speculative[key] for key in ("started", "used", "missed", "handed_off", "expired")}),
+        ("nutriscan_prefetch_saved_seconds_total", "Scan latency saved by speculative work.", None,
+         {"": speculative["saved_seconds"]}),
+    ]
+
+
+def render():
+    """Everything in the Prometheus text exposition format."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for name, help_text, label, values in _stats_families():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        lines.extend(f"{name}{_labels(label, key)} {_number(value)}" for key, value in sorted(values.items()))
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    for metric in METRICS:
+        metric.reset()
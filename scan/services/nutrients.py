@@ -0,0 +1,252 @@
+import math
+from collections import namedtuple
+from typing import Dict, List, Optional, Tuple
+
+# keys: the nutriment key first, then aliases Open Food Facts also uses
+Nutrient = namedtuple("Nutrient", "key label unit keys")
+
+# Display order of the nutrition label: (key, label, unit, aliases).
+# Values are per 100g as Open Food Facts normalizes them (g unless noted).
+_TABLE = (
+    ("energy-kcal", "Energy (kcal)", "kcal", ()),
+    ("energy-kj", "Energy (kJ)", "kJ", ()),
+    ("energy", "Energy", "kJ", ()),
+    ("fat", "Total Fat", "g", ()),
+    ("saturated-fat", "Saturated Fat", "g", ()),
+    ("trans-fat", "Trans Fat", "g", ()),
+    ("monounsaturated-fat", "Monounsaturated Fat", "g", ()),
+    ("polyunsaturated-fat", "Polyunsaturated Fat", "g", ()),
+    ("cholesterol", "Cholesterol", "g", ()),
+    ("carbohydrates", "Total Carbohydrates", "g", ()),
+    ("fiber", "Dietary Fiber", "g", ("dietary-fiber",)),
+    ("soluble-fiber", "Soluble Fiber", "g", ()),
+    ("insoluble-fiber", "Insoluble Fiber", "g", ()),
+    ("sugars", "Total Sugars", "g", ()),
+    ("added-sugars", "Added Sugars", "g", ()),
+    ("sugar-alcohols", "Sugar Alcohols", "g", ()),
+    ("proteins", "Protein", "g", ("protein",)),
+    ("salt", "Salt", "g", ()),
+    ("sodium", "Sodium", "g", ()),
+    ("potassium", "Potassium", "g", ()),
+    ("calcium", "Calcium", "g", ()),
+    ("iron", "Iron", "g", ()),
+    ("vitamin-a", "Vitamin A", "g", ()),
+    ("vitamin-c", "Vitamin C", "g", ()),
+    ("vitamin-d", "Vitamin D", "g", ()),
+    ("vitamin-e", "Vitamin E", "g", ()),
+    ("vitamin-k", "Vitamin K", "g", ()),
+    ("vitamin-b1", "Thiamin (B1)", "g", ("thiamin",)),
+    ("vitamin-b2", "Riboflavin (B2)", "g", ("riboflavin",)),
+    ("vitamin-pp", "Niacin (B3)", "g", ("niacin",)),
+    ("vitamin-b6", "Vitamin B6", "g", ()),
+    ("vitamin-b9", "Folate (B9)", "g", ("folates", "folate")),
+    ("vitamin-b12", "Vitamin B12", "g", ()),
+    ("biotin", "Biotin (B7)", "g", ()),
+    ("pantothenic-acid", "Pantothenic Acid (B5)", "g", ()),
+    ("phosphorus", "Phosphorus", "g", ()),
+    ("iodine", "Iodine", "g", ()),
+    ("magnesium", "Magnesium", "g", ()),
+    ("zinc", "Zinc", "g", ()),
+    ("selenium", "Selenium", "g", ()),
+    ("copper", "Copper", "g", ()),
+    ("manganese", "Manganese", "g", ()),
+    ("chromium", "Chromium", "g", ()),
+    ("molybdenum", "Molybdenum", "g", ()),
+    ("chloride", "Chloride", "g", ()),
+    ("omega-3-fat", "Omega-3 Fatty Acids", "g", ("omega-3",)),
+    ("omega-6-fat", "Omega-6 Fatty Acids", "g", ("omega-6",)),
+    ("alanine", "Alanine", "g", ()),
+    ("arginine", "Arginine", "g", ()),
+    ("aspartic-acid", "Aspartic Acid", "g", ()),
+    ("glutamic-acid", "Glutamic Acid", "g", ()),
+    ("glycine", "Glycine", "g", ()),
+    ("histidine", "Histidine", "g", ()),
+    ("hydroxyproline", "Hydroxyproline", "g", ()),
+    ("isoleucine", "Isoleucine", "g", ()),
+    ("leucine", "Leucine", "g", ()),
+    ("lysine", "Lysine", "g", ()),
+    ("methionine", "Methionine", "g", ()),
+    ("phenylalanine", "Phenylalanine", "g", ()),
+    ("proline", "Proline", "g", ()),
+    ("serine", "Serine", "g", ()),
+    ("threonine", "Threonine", "g", ()),
+    ("tryptophan", "Tryptophan", "g", ()),
+    ("tyrosine", "Tyrosine", "g", ()),
+    ("valine", "Valine", "g", ()),
+    ("caffeine", "Caffeine", "g", ()),
+    ("alcohol", "Alcohol", "% vol", ()),
+    ("water", "Water Content", "g", ()),
+    ("ash", "Ash Content", "g", ()),
+    ("ph", "pH Level", "", ()),
+    ("pral", "PRAL (Renal Acid Load)", "", ()),
+    ("gluten", "Gluten", "g", ()),
+    ("lactose", "Lactose", "g", ()),
+    ("fructose", "Fructose", "g", ()),
+    ("sucrose", "Sucrose", "g", ()),
+    ("starch", "Starch", "g", ()),
+    ("polyols", "Polyols", "g", ()),
+    ("gout-inducing", "Gout-Inducing Purines", "g", ()),
+    ("oxalate", "Oxalate Content", "g", ()),
+    ("phytate", "Phytate Content", "g", ()),
+)
+
+# Built once at import; order is the label order
+NUTRIENTS = tuple(Nutrient(key, label, unit, (key,) + aliases) for key, label, unit, aliases in _TABLE)
+REGISTRY = {key: nutrient for nutrient in NUTRIENTS for key in nutrient.keys}
+
+
+KJ_PER_KCAL = 4.184
+SALT_PER_SODIUM = 2.5
+
+# Gram amounts below these are written in a smaller unit, so tiny values keep their digits
+_SMALL_MASS = ((0.1, "g", 1), (0.0001, "mg", 1000), (0, "mcg", 1000000))
+
+# One energy line and one salt line; the other forms are folded into them by normalize()
+_FOLDED = {"energy-kj", "energy", "sodium"}
+
+
+def _number(value) -> Optional[float]:
+    """A finite float, or None for missing, boolean or non-numeric values."""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+def _value(nutriments, keys, suffixes) -> Optional[float]:
+    # Suffixes in order of preference, then keys: the first number wins, 0 included
+    for suffix in suffixes:
+        for key in keys:
+            value = _number(nutriments.get(key + suffix))
+            if value is not None:
+                return value
+    return None
+
+
+def per_100g(nutriments, name) -> Optional[float]:
+    """
+    The per-100g amount of one nutrient (its key or an alias), or None.
+    OFF's _100g copy is the normalized one; the bare key may be "as sold".
+    """
+    keys = REGISTRY[name].keys if name in REGISTRY else (name,)
+    return _value(nutriments or {}, keys, ("_100g", ""))
+
+
+def compact(nutriments) -> Dict[str, float]:
+    """
+    The nutriments worth storing with a scan: numbers only, without OFF's
+    _unit/_value/_label copies, and the per-100g amount (see per_100g())
+    under the bare key. Per-serving and other suffixed values are kept.
+    """
+    nutriments = nutriments or {}
+    values = {}
+    for key, value in nutriments.items():
+        if key.endswith(("_unit", "_value", "_label")):
+            continue
+        base = key[:-len("_100g")] if key.endswith("_100g") else key
+        if base in values and not key.endswith("_100g"):
+            continue
+        value = _number(value)
+        if value is not None:
+            values[base] = int(value) if value.is_integer() else value
+    return values
+
+
+def _scaled(value, unit) -> Tuple[float, str]:
+    if unit != "g":
+        return value, unit
+    for threshold, small_unit, factor in _SMALL_MASS:
+        if value >= threshold:
+            return value * factor, small_unit
+    return value, unit
+
+
+def normalize(nutriments) -> Dict[str, Tuple[float, str]]:
+    """
+    One per-100g value per nutrient, in label order: {key: (value, unit)}.
+    Energy is a single kcal value (converted from kJ when that is all there
+    is), salt is derived from sodium when missing and sodium itself is
+    dropped. Zeros, unknown keys and non-numeric values are left out, and
+    gram amounts under 0.1 g are given in mg or mcg.
+    """
+    nutriments = nutriments or {}
+    values = {}
+    energy = per_100g(nutriments, "energy-kcal")
+    if energy is None:
+        kilojoules = _value(nutriments, ("energy-kj", "energy"), ("_100g", ""))
+        energy = kilojoules / KJ_PER_KCAL if kilojoules is not None else None
+    salt = per_100g(nutriments, "salt")
+    if salt is None:
+        sodium = per_100g(nutriments, "sodium")
+        salt = sodium * SALT_PER_SODIUM if sodium is not None else None
+
+    for nutrient in NUTRIENTS:
+        if nutrient.key in _FOLDED:
+            continue
+        if nutrient.key == "energy-kcal":
+            value = energy
+        elif nutrient.key == "salt":
+            value = salt
+        else:
+            value = per_100g(nutriments, nutrient.key)
+        # Negative amounts are data errors, except for signed scores such as PRAL
+        if value is None or value == 0 or (value < 0 and nutrient.unit in ("g", "kcal")):
+            continue
+        values[nutrient.key] = _scaled(value, nutrient.unit)
+    return values
+
+
+def _format(value) -> str:
+    # Three significant digits, never in exponent notation
+    if abs(value) >= 100:
+        return str(round(value))
+    return f"{float(f'{value:.3g}'):g}"
+
+
+def prompt_table(nutriments) -> str:
+    """normalize() as compact "Label: value unit" lines for the LLM prompt."""
+    lines = []
+    for key, (value, unit) in normalize(nutriments).items():
+        label = "Energy" if key == "energy-kcal" else REGISTRY[key].label
+        lines.append(f"{label}: {_format(value)} {unit}".rstrip())
+    return "\n".join(lines)
+
+
+def _shown(value):
+    # 42.0 reads as 42 on the label
+    return int(value) if value is not None and value.is_integer() else value
+
+
+def nutrient_rows(nutriments) -> List[Dict]:
+    """
+    Label rows for the nutrients this product actually has, in registry
+    order: {"key", "label", "unit", "per_100g", "per_serving"}. Missing and
+    zero values are left out, as the label always did.
+    """
+    nutriments = nutriments or {}
+    rows = []
+    for nutrient in NUTRIENTS:
+        amount = per_100g(nutriments, nutrient.key)
+        if not amount:
+            continue
+        rows.append({
+            "key": nutrient.key,
+            "label": nutrient.label,
+            "unit": nutrient.unit,
+            "per_100g": _shown(amount),
+            "per_serving": _shown(_value(nutriments, nutrient.keys, ("_serving",))),
+        })
+    return rows
+
+
+def nutrition_label(nutriments) -> Dict:
+    """Everything the nutrition label fragment renders, for one product."""
+    rows = nutrient_rows(nutriments)
+    return {
+        "calories": _shown(per_100g(nutriments, "energy-kcal")),
+        "rows": rows,
+        "has_serving": any(row["per_serving"] is not None for row in rows),
+    }
@@ -1,42 +1,16 @@
 import os
-import fitz  # PyMuPDF
-import hashlib
-from huggingface_hub import InferenceClient
-
-# Setup Hugging Face client
-from dotenv import load_dotenv
-load_dotenv()
-HF_TOKEN = os.getenv("HF_TOKEN")
-  # fallback to your token
-client = InferenceClient(
-    provider="novita",
-    api_key=HF_TOKEN
-)
-
-# Simple tokenizer approximation
-def estimate_token_count(text):
-    return len(text.split())
-
-def truncate_text_to_tokens(text, max_tokens):
-    words = text.split()
-    return " ".join(words[:max_tokens])
-
-# Cache dictionary for already processed PDFs
-_pdf_cache = {}
-
-# Utility: Cache PDF parsing to avoid re-processing
-def extract_pdf_text(file_path):
-    file_hash = hashlib.md5(open(file_path, 'rb').read()).hexdigest()
-    if file_hash in _pdf_cache:
-        return _pdf_cache[file_hash]
-    with fitz.open(file_path) as doc:
-        full_text = "\n".join([page.get_text() for page in doc])
-    _pdf_cache[file_hash] = full_text
-    return full_text
-
-# Utility: Format nutrient data
-def format_nutrition_data(product_info):
-    return "\n".join(f"{k}: {v}" for k, v in product_info.items() if k != "Product")
+from django.conf import settings
+from asgiref.sync import sync_to_async
+
+from . import admission, inference, metrics, nutrients as nutrient_registry, verdict
+from .guidance import relevant_guidance
+from .tokens import count_tokens, truncate_to_tokens
+
+# Bump whenever generate_prompt changes meaning, so cached verdicts are not reused
+PROMPT_VERSION = "3"
+
+# How much of an unparseable reply the repair prompt quotes back
+REPAIR_REPLY_TOKENS = 300
 
 # Prompt generator
 def generate_prompt(age, weight, height, bmi, health_conditions, dietary_preferences, goal, product_info, diet_knowledge):
@@ -47,10 +21,11 @@ def generate_prompt(age, weight, height, bmi, health_conditions, dietary_prefere
     health_conditions = health_conditions or "None"
     dietary_preferences = dietary_preferences or "None"
     goal = goal or "General health"
-    nutrients = "\n".join([f"{k}: {v}" for k, v in product_info.get('nutriments', {}).items()])
+    # One canonical per-100g line per nutrient instead of OFF's raw _100g/_serving/_unit copies
+    nutrients = nutrient_registry.prompt_table(product_info.get('nutriments')) or "Not available"
 
-    # Truncate PDF background knowledge for context safety
-    truncated_diet_knowledge = truncate_text_to_tokens(diet_knowledge, 3000)
+    # diet_knowledge is already the retrieved, relevant part; this is only a safety cap
+    truncated_diet_knowledge = truncate_to_tokens(diet_knowledge, settings.GUIDANCE_TOKEN_BUDGET)
 
     prompt = f"""
 You are a helpful and reliable AI nutrition assistant evaluating the suitability of a food product for a specific user based on evidence-based dietary principles and the user's personal profile.
@@ -89,30 +64,89 @@ Based on the user profile and product information, is this food product advisabl
 """
     return prompt.strip()
 
-# Main analysis function
-def analyze_nutrition(age, weight, height, bmi, health_conditions, dietary_preferences, goal, product_info, pdf_path):
+def _build_messages(age, weight, height, bmi, health_conditions, dietary_preferences, goal, product_info, pdf_path=None):
+    """Validate the inputs and build the chat messages. Raises ValueError on bad input."""
     if not isinstance(product_info, dict) or 'nutriments' not in product_info:
-        return {"error": "Invalid product_info format"}
+        raise ValueError("Invalid product_info format")
 
-    if not os.path.exists(pdf_path):
-        return {"error": "PDF file not found"}
+    guidance_paths = [pdf_path] if pdf_path else settings.GUIDANCE_DOCUMENTS
+    if not all(os.path.exists(path) for path in guidance_paths):
+        raise ValueError("PDF file not found")
 
-    try:
-        diet_knowledge = extract_pdf_text(pdf_path)
+    with metrics.span("prompt_build"):
+        diet_knowledge = relevant_guidance(product_info, health_conditions, goal, paths=guidance_paths)
         prompt = generate_prompt(age, weight, height, bmi, health_conditions, dietary_preferences, goal, product_info, diet_knowledge)
-
-        # Hugging Face Inference API call (chat_completion)
-        response = client.chat_completion(
-            model="meta-llama/Meta-Llama-3-8B-Instruct",
-            messages=[
-                {"role": "system", "content": "You are a helpful AI nutrition assistant."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=400,
-            temperature=0.7
-        )
-
-        return response.choices[0].message["content"].strip()
-
-    except Exception as e:
-        return {"error": str(e)}
+    prompt_tokens = count_tokens(prompt)
+    metrics.PROMPT_TOKENS.observe(prompt_tokens)
+    admission.note_tokens(prompt_tokens)
+    return [
+        {"role": "system", "content": "You are a helpful AI nutrition assistant."},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def request_analysis(age, weight, height, bmi, health_conditions, dietary_preferences, goal, product_info, pdf_path=None):
+    """
+    Ask the configured inference backend whether the product suits the user
+    and return an inference.Reply. Errors are raised, not returned.
+    """
+    messages = _build_messages(age, weight, height, bmi, health_conditions, dietary_preferences,
+                               goal, product_info, pdf_path)
+    with metrics.span("inference"):
+        return inference.get_router().chat(messages, max_tokens=400, temperature=0.7, schema=verdict.SCHEMA)
+
+
+async def arequest_analysis(age, weight, height, bmi, health_conditions, dietary_preferences, goal, product_info, pdf_path=None):
+    """
+    request_analysis() for async callers. The prompt (guidance retrieval
+    included) is built on a worker thread and the backend is called through
+    its async client.
+    """
+    messages = await sync_to_async(_build_messages, thread_sensitive=False)(
+        age, weight, height, bmi, health_conditions, dietary_preferences, goal, product_info, pdf_path)
+    with metrics.span("inference"):
+        return await inference.get_router().achat(messages, max_tokens=400, temperature=0.7,
+                                                  schema=verdict.SCHEMA)
+
+
+def generate_repair_prompt(reply):
+    """A short prompt asking the model to restate its own unparseable reply as the verdict JSON."""
+    return f"""
+Rewrite the answer below as JSON with exactly two fields: "advisability" ("Yes" or "No")
+and "summary" (the explanation, under 100 words). Reply with the JSON object only.
+
+ANSWER:
+{truncate_to_tokens(reply, REPAIR_REPLY_TOKENS)}
+""".strip()
+
+
+def _repair_messages(reply):
+    prompt = generate_repair_prompt(reply)
+    admission.note_tokens(count_tokens(prompt))
+    return [{"role": "user", "content": prompt}]
+
+
+def request_repair(reply):
+    """Retry for a reply with no usable verdict: no guidance or profile, a small budget, greedy decoding."""
+    with metrics.span("inference"):
+        return inference.get_router().chat(_repair_messages(reply), max_tokens=200, temperature=0,
+                                           schema=verdict.SCHEMA)
+
+
+async def arequest_repair(reply):
+    with metrics.span("inference"):
+        return await inference.get_router().achat(_repair_messages(reply), max_tokens=200, temperature=0,
+                                                  schema=verdict.SCHEMA)
+
+
+def analyze_nutrition_stream(age, weight, height, bmi, health_conditions, dietary_preferences, goal, product_info, pdf_path=None):
+    """
+    Ask the LLM whether the product suits the user, as an inference.StreamReply
+    that yields the reply text piece by piece as the model produces it. Only
+    the guidance passages relevant to this product and profile are sent:
+    retrieved from pdf_path when given, otherwise from every document in
+    settings.GUIDANCE_DOCUMENTS. Errors are raised, not returned.
+    """
+    messages = _build_messages(age, weight, height, bmi, health_conditions, dietary_preferences,
+                               goal, product_info, pdf_path)
+    return inference.get_router().stream(messages, max_tokens=400, temperature=0.7, schema=verdict.SCHEMA)
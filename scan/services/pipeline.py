@@ -0,0 +1,349 @@
+import asyncio
+import logging
+import time
+import threading
+from contextlib import nullcontext
+from django.conf import settings
+from asgiref.sync import sync_to_async
+
+from nutri.models import NutriUser
+from scan.models import ProductScan
+from . import aio, guidance, nutrients, product_lookup, nutrition, analysis_cache, inference, rules, uploads, prefetch, metrics, verdict, admission
+from .tokens import count_tokens
+from .uploads import scan_storage
+
+DEFAULT_NUTRIENTS = {
+    'energy': 0, 'energy-kcal': 0, 'energy-kj': 0,
+    'fat': 0, 'saturated-fat': 0,
+    'carbohydrates': 0, 'sugars': 0,
+    'fiber': 0, 'proteins': 0,
+    'salt': 0, 'sodium': 0
+}
+
+logger = logging.getLogger(__name__)
+
+# Shown when neither the reply nor the repair retry held a usable verdict
+PARSE_FAILED = {"advisability": "Error", "summary": "Could not parse summary."}
+
+# Time to the verdict and to the full reply for streamed analyses, in seconds
+_stream_stats = {"count": 0, "advisability_seconds": 0.0, "complete_seconds": 0.0}
+_stream_stats_lock = threading.Lock()
+
+
+def stream_stats():
+    """Average time to first useful byte (the verdict) and to the complete reply."""
+    with _stream_stats_lock:
+        stats = dict(_stream_stats)
+    count = stats["count"]
+    return {
+        "count": count,
+        "avg_advisability_seconds": stats["advisability_seconds"] / count if count else 0.0,
+        "avg_complete_seconds": stats["complete_seconds"] / count if count else 0.0,
+    }
+
+
+class ScanError(Exception):
+    """A scan that retrying cannot fix (no barcode, unknown product). The message is shown to the user."""
+
+
+def _no_stage(name):
+    return nullcontext()
+
+
+def _scan_fields(user, barcode, product, analysis):
+    return dict(
+        user=user,
+        barcode=barcode,
+        product_name=(product.get('product_name') or 'Unknown Product')[:255],
+        nutriscore_grade=str(product.get('nutriscore_grade') or 'N/A')[:5],
+        image_url=product.get('image_url') or '',
+        nutriments=nutrients.compact(product.get('nutriments')),
+        advisability=analysis.get('advisability') or '',
+        analysis_result=analysis.get('summary') or '',
+    )
+
+
+def save_scan(user, barcode, product, analysis):
+    """Persist a finished scan; the session only ever holds its id."""
+    return ProductScan.objects.create(**_scan_fields(user, barcode, product, analysis))
+
+
+async def asave_scan(user, barcode, product, analysis):
+    return await ProductScan.objects.acreate(**_scan_fields(user, barcode, product, analysis))
+
+
+def build_scan_results(barcode, product, analysis):
+    product['nutriments'] = {**DEFAULT_NUTRIENTS, **product.get('nutriments', {})}
+    return {
+        "barcode": barcode,
+        "product": product,
+        "analysis": analysis,
+    }
+
+
+def run_scan(user, image_path, stage=_no_stage, on_partial=None):
+    """
+    Decode, look up and analyze one uploaded image for a user.
+
+    stage(name) must return a context manager; it wraps the "decoding",
+    "lookup" and "analyzing" steps so callers can report progress or cap
+    concurrency per step. With on_partial(text, advisability) set and
+    LLM_STREAMING on, the reply is streamed and on_partial sees it grow.
+    The scan is saved as a ProductScan row whose id is returned as
+    "scan_id" alongside the results.
+    Raises ScanError for user-facing failures; any other exception means
+    the scan may succeed if retried.
+    """
+    with stage('decoding'), metrics.span('decode'):
+        # Work started speculatively when the photo was uploaded (see prefetch.start)
+        prefetched = prefetch.take(image_path)
+        if prefetched and prefetched.decoded:
+            barcode = prefetched.barcode
+        else:
+            barcode = uploads.decode_barcode(image_path)
+    if not barcode:
+        metrics.DECODE_FAILURES.inc()
+        raise ScanError("No barcode detected in the image.")
+
+    with stage('lookup'), metrics.span('lookup'):
+        if prefetched and prefetched.looked_up:
+            product = prefetched.product
+        else:
+            product = product_lookup.fetch_product_data(barcode)
+    if not product:
+        raise ScanError("Product not found in database.")
+
+    product['nutriments'] = product.get('nutriments', {})
+
+    # Clear-cut products are answered by the rules in microseconds
+    analysis = rules.fast_path(product, user) or analysis_cache.get(barcode, product, user)
+    if analysis is None:
+        analysis = _admitted_analysis(user, barcode, product, stage, on_partial)
+
+    with metrics.span('db_write'):
+        scan = save_scan(user, barcode, product, analysis)
+    results = build_scan_results(barcode, product, analysis)
+    results["scan_id"] = scan.id
+    return results
+
+
+async def _warm_guidance():
+    """Load the guidance index off the event loop while product and profile are fetched."""
+    try:
+        await aio.run_cpu(guidance.get_index)
+    except (OSError, ValueError):
+        # Missing documents are reported properly when the prompt is built
+        pass
+
+
+async def _aproduct(barcode, prefetched):
+    if prefetched and prefetched.looked_up:
+        return prefetched.product
+    with metrics.span('lookup'):
+        return await product_lookup.afetch_product_data(barcode)
+
+
+async def _aprofile(user_id):
+    with metrics.span('profile_load'):
+        return await NutriUser.objects.aget(id=user_id)
+
+
+async def arun_scan(user_id, image_path):
+    """
+    run_scan() for async views, with the same results and ScanError cases.
+    Speculative work from upload time is reused; otherwise decoding runs on
+    the decode executor. Then the product lookup, the profile fetch and the
+    guidance index load run concurrently, and the LLM is called through the
+    backends' async clients. Nothing blocks the event loop, so one ASGI
+    worker can hold many scans waiting on upstreams.
+    Raises NutriUser.DoesNotExist for an unknown user_id.
+    """
+    with metrics.span('decode'):
+        prefetched = await prefetch.atake(image_path)
+        if prefetched and prefetched.decoded:
+            barcode = prefetched.barcode
+        else:
+            barcode = await aio.run_cpu(uploads.decode_barcode, image_path)
+    if not barcode:
+        metrics.DECODE_FAILURES.inc()
+        raise ScanError("No barcode detected in the image.")
+
+    product, user, _ = await asyncio.gather(
+        _aproduct(barcode, prefetched),
+        _aprofile(user_id),
+        _warm_guidance(),
+    )
+    if not product:
+        raise ScanError("Product not found in database.")
+
+    product['nutriments'] = product.get('nutriments', {})
+
+    analysis = rules.fast_path(product, user) or await sync_to_async(analysis_cache.get)(barcode, product, user)
+    if analysis is None:
+        analysis = await _aadmitted_analysis(user, barcode, product)
+
+    with metrics.span('db_write'):
+        scan = await asave_scan(user, barcode, product, analysis)
+    results = build_scan_results(barcode, product, analysis)
+    results["scan_id"] = scan.id
+    return results
+
+
+def _admitted_analysis(user, barcode, product, stage=_no_stage, on_partial=None):
+    """
+    analyze_product() if admission control lets the call through (and then
+    cached), otherwise its stand-in answer. Tokens used are charged either way.
+    """
+    ticket = admission.admit(user, barcode)
+    if not ticket.admitted:
+        return admission.fallback(user, barcode, product, ticket.reason)
+    try:
+        with ticket.counting():
+            analysis = analyze_product(user, product, stage, on_partial)
+    finally:
+        ticket.settle()
+    analysis_cache.put(barcode, product, user, analysis)
+    return analysis
+
+
+async def _aadmitted_analysis(user, barcode, product):
+    ticket = await sync_to_async(admission.admit)(user, barcode)
+    if not ticket.admitted:
+        return await sync_to_async(admission.fallback)(user, barcode, product, ticket.reason)
+    try:
+        with ticket.counting():
+            analysis = await aanalyze_product(user, product)
+    finally:
+        await sync_to_async(ticket.settle)()
+    await sync_to_async(analysis_cache.put)(barcode, product, user, analysis)
+    return analysis
+
+
+def _profile_kwargs(user, product):
+    return dict(
+        age=user.age,
+        weight=user.weight,
+        height=user.height,
+        bmi=user.bmi,
+        health_conditions=user.health_conditions,
+        dietary_preferences=user.dietary_preferences,
+        goal=user.goal,
+        product_info=product
+    )
+
+
+def _stream_reply(user, product, on_partial):
+    """Stream the reply into a VerdictParser, hanging up as soon as the verdict object closes."""
+    started = time.monotonic()
+    advisability_seconds = None
+    parser = verdict.VerdictParser()
+    reply = nutrition.analyze_nutrition_stream(**_profile_kwargs(user, product))
+    pieces = iter(reply)
+    with metrics.span('inference'):
+        try:
+            for piece in pieces:
+                complete = parser.feed(piece)
+                advisability = parser.advisability
+                if advisability and advisability_seconds is None:
+                    advisability_seconds = time.monotonic() - started
+                on_partial(parser.text, advisability)
+                if complete:
+                    break
+        finally:
+            if hasattr(pieces, "close"):
+                pieces.close()
+
+    with _stream_stats_lock:
+        _stream_stats["count"] += 1
+        _stream_stats["complete_seconds"] += time.monotonic() - started
+        _stream_stats["advisability_seconds"] += advisability_seconds or (time.monotonic() - started)
+    return parser, getattr(reply, "model", None)
+
+
+def analyze_product(user, product, stage=_no_stage, on_partial=None):
+    """
+    Ask the LLM for a verdict and parse it into {"advisability", "summary",
+    "model"}, model naming whichever backend model actually answered. A
+    reply with no usable verdict gets a short repair request before the
+    scan settles for PARSE_FAILED.
+    """
+    with stage('analyzing'):
+        if on_partial is not None and settings.LLM_STREAMING:
+            parser, model = _stream_reply(user, product, on_partial)
+            response = parser.text
+            analysis = _read_verdict(parser)
+        else:
+            reply = nutrition.request_analysis(**_profile_kwargs(user, product))
+            response, model = reply.text.strip(), reply.model
+            analysis = _read_verdict(response)
+        if analysis is None:
+            analysis, model = _repair(response, model)
+    return _finish_analysis(analysis, model)
+
+
+async def aanalyze_product(user, product):
+    """analyze_product() for the async pipeline (no streaming)."""
+    reply = await nutrition.arequest_analysis(**_profile_kwargs(user, product))
+    response, model = reply.text.strip(), reply.model
+    analysis = _read_verdict(response)
+    if analysis is None:
+        analysis, model = await _arepair(response, model)
+    return _finish_analysis(analysis, model)
+
+
+def _read_verdict(response):
+    """The verdict in a reply (text, or the VerdictParser a stream was fed into), or None."""
+    parser = response if isinstance(response, verdict.VerdictParser) else None
+    text = parser.text if parser else response
+    logger.debug("LLM response: %s", text)
+    admission.note_tokens(count_tokens(text))
+    with metrics.span('parse'):
+        try:
+            return parser.result() if parser else verdict.parse(response)
+        except verdict.VerdictError as e:
+            logger.info("LLM reply has no usable verdict: %s", e)
+            return None
+
+
+def _repair_attempts(response):
+    # An empty reply has nothing to restate; re-asking the full question is not "cheap"
+    return settings.ANALYSIS_PARSE_RETRIES if response.strip() else 0
+
+
+def _checked_repair(reply):
+    analysis = _read_verdict(reply.text.strip())
+    metrics.VERDICT_RETRIES.inc("ok" if analysis else "failed")
+    return analysis
+
+
+def _repair(response, model):
+    """(analysis, model) from up to ANALYSIS_PARSE_RETRIES repair requests; analysis None if all fail."""
+    for _ in range(_repair_attempts(response)):
+        try:
+            reply = nutrition.request_repair(response)
+        except inference.BackendUnavailable as e:
+            logger.warning("Verdict repair request failed: %s", e)
+            break
+        analysis = _checked_repair(reply)
+        if analysis is not None:
+            return analysis, reply.model
+    return None, model
+
+
+async def _arepair(response, model):
+    for _ in range(_repair_attempts(response)):
+        try:
+            reply = await nutrition.arequest_repair(response)
+        except inference.BackendUnavailable as e:
+            logger.warning("Verdict repair request failed: %s", e)
+            break
+        analysis = _checked_repair(reply)
+        if analysis is not None:
+            return analysis, reply.model
+    return None, model
+
+
+def _finish_analysis(analysis, model):
+    analysis = analysis or dict(PARSE_FAILED)
+    analysis["model"] = model or inference.primary_model()
+    return analysis
@@ -0,0 +1,220 @@
+import asyncio
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Dict, Optional
+from django.conf import settings
+from django.db import connections
+
+from . import guidance, product_lookup, uploads
+
+# What speculative work finished for an upload; a stage that did not finish is None/False
+Prefetched = namedtuple("Prefetched", "decoded barcode looked_up product")
+
+_stats = {"started": 0, "used": 0, "missed": 0, "handed_off": 0, "expired": 0, "saved_seconds": 0.0}
+_stats_lock = threading.Lock()
+
+# filename -> _Speculation, until a scan claims it or it expires
+_pending = {}
+_pending_lock = threading.Lock()
+
+_executor = None
+
+
+class _Speculation:
+    def __init__(self, filename):
+        self.filename = filename
+        self.started = time.monotonic()
+        self.cancelled = threading.Event()
+        self.future = None
+        self.timer = None
+        self.decoded = False
+        self.barcode = None
+        self.decode_seconds = 0.0
+        self.looked_up = False
+        self.product = None
+        self.lookup_seconds = 0.0
+
+    def expired(self, now):
+        return now - self.started >= settings.SCAN_PREFETCH_TIMEOUT
+
+    def stopped(self):
+        """Cancelled, or past its deadline: further stages are not worth starting."""
+        return self.cancelled.is_set() or self.expired(time.monotonic())
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def prefetch_stats() -> Dict:
+    """
+    Speculations started, claimed by an inline scan with (used) or without
+    (missed) a finished stage, left to warm the caches for a job worker, and
+    abandoned, and the scan latency the used ones saved.
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["avg_saved_seconds"] = stats["saved_seconds"] / stats["used"] if stats["used"] else 0.0
+    return stats
+
+
+def reset_prefetch_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+def _get_executor():
+    global _executor
+    with _pending_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.SCAN_PREFETCH_WORKERS,
+                                           thread_name_prefix="scan-prefetch")
+        return _executor
+
+
+def _run(spec):
+    """Decode, look the product up and warm the guidance index, stopping early once cancelled."""
+    try:
+        if spec.stopped():
+            return
+        started = time.monotonic()
+        spec.barcode = uploads.decode_barcode(uploads.scan_storage().path(spec.filename))
+        spec.decode_seconds = time.monotonic() - started
+        spec.decoded = True
+        if not spec.barcode or spec.stopped():
+            return
+
+        started = time.monotonic()
+        spec.product = product_lookup.fetch_product_data(spec.barcode)
+        spec.lookup_seconds = time.monotonic() - started
+        spec.looked_up = True
+        if spec.product is None or spec.stopped():
+            return
+
+        try:
+            guidance.get_index()
+        except (OSError, ValueError):
+            pass
+    finally:
+        # Pool threads open their own DB connections; don't leak them
+        connections.close_all()
+
+
+def _expire(spec):
+    """Stop a speculation at its deadline; counted as expired unless a scan claimed it."""
+    with _pending_lock:
+        unclaimed = _pending.get(spec.filename) is spec
+        if unclaimed:
+            del _pending[spec.filename]
+    spec.timer.cancel()
+    spec.cancelled.set()
+    spec.future.cancel()
+    if unclaimed:
+        _count("expired")
+    return unclaimed
+
+
+def expire():
+    """Cancel speculations nobody claimed within SCAN_PREFETCH_TIMEOUT seconds."""
+    now = time.monotonic()
+    with _pending_lock:
+        stale = [spec for spec in _pending.values() if spec.expired(now)]
+    return sum(_expire(spec) for spec in stale)
+
+
+def start(filename):
+    """
+    Begin decoding and looking up an upload in the background, before the
+    loading page asks for the scan. Results are handed over by take(); for
+    scans run by a separate worker process see hand_off().
+    """
+    if not settings.SCAN_PREFETCH_ENABLED:
+        return None
+    expire()
+    executor = _get_executor()
+    with _pending_lock:
+        if filename in _pending:
+            return _pending[filename]
+        spec = _Speculation(filename)
+        spec.future = executor.submit(_run, spec)
+        # The deadline holds even if no later upload or scan comes along to call expire()
+        spec.timer = threading.Timer(settings.SCAN_PREFETCH_TIMEOUT, _expire, args=(spec,))
+        spec.timer.daemon = True
+        _pending[filename] = spec
+    spec.timer.start()
+    _count("started")
+    return spec
+
+
+def _claim(image_path):
+    expire()
+    with _pending_lock:
+        return _pending.pop(os.path.basename(image_path), None)
+
+
+def _handoff(spec, waited):
+    spec.timer.cancel()
+    if not spec.decoded and not spec.looked_up:
+        _count("missed")
+        return Prefetched(False, None, False, None)
+    # Latency saved: the speculative stages the scan can skip, minus the time it waited for them
+    saved = (spec.decode_seconds if spec.decoded else 0.0) + (spec.lookup_seconds if spec.looked_up else 0.0)
+    _count("used")
+    _count("saved_seconds", max(saved - waited, 0.0))
+    product = dict(spec.product) if spec.product is not None else None
+    return Prefetched(spec.decoded, spec.barcode, spec.looked_up, product)
+
+
+def hand_off(image_path):
+    """
+    The scan will run in a job worker, which cannot see this process's
+    results: let the speculation finish so the decode and product caches the
+    worker reads are warm, without counting it as used. It still stops at
+    its deadline.
+    """
+    spec = _claim(image_path)
+    if spec is None:
+        return False
+    _count("handed_off")
+    return True
+
+
+def take(image_path, timeout=None) -> Optional[Prefetched]:
+    """
+    Claim the speculative result for an upload, waiting up to timeout
+    (SCAN_PREFETCH_WAIT) for work still running. Stages that did not finish
+    in time are reported as not done. None when nothing was started.
+    """
+    spec = _claim(image_path)
+    if spec is None:
+        return None
+    timeout = settings.SCAN_PREFETCH_WAIT if timeout is None else timeout
+    started = time.monotonic()
+    try:
+        spec.future.result(timeout=timeout)
+    except FutureTimeout:
+        pass
+    except Exception:
+        return None
+    return _handoff(spec, time.monotonic() - started)
+
+
+async def atake(image_path, timeout=None) -> Optional[Prefetched]:
+    """take() for async callers: waits without blocking the event loop."""
+    spec = _claim(image_path)
+    if spec is None:
+        return None
+    timeout = settings.SCAN_PREFETCH_WAIT if timeout is None else timeout
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(spec.future)), timeout)
+    except asyncio.TimeoutError:
+        pass
+    except Exception:
+        return None
+    return _handoff(spec, time.monotonic() - started)
@@ -1,28 +1,251 @@
-import requests
+import asyncio
+import logging
+import threading
 from typing import Optional, Dict
+from django.conf import settings
+from django.utils import timezone
+
+from scan.models import CachedProduct, CatalogProduct
+from . import metrics
+from .aio import LoopLocal
+
+logger = logging.getLogger(__name__)
 
 OPEN_FOOD_FACTS_API = "https://world.openfoodfacts.org/api/v0/product/{}.json"
 
-def fetch_product_data(barcode: str) -> Optional[Dict]:
+# Cache counters, exposed through cache_stats()
+_stats = {"catalog_hits": 0, "hits": 0, "misses": 0, "stale": 0, "negative_hits": 0}
+_stats_lock = threading.Lock()
+
+# Single-flight: barcode -> _Flight for lookups currently talking to upstream
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+# requests and httpx are imported on first use; most processes never call upstream
+_session = None
+_session_lock = threading.Lock()
+
+
+def http_session():
+    """The process-wide requests.Session: keep-alive connections to Open Food Facts are reused."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=settings.PRODUCT_LOOKUP_MAX_CONNECTIONS)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def _async_client():
+    import httpx
+    return httpx.AsyncClient(
+        timeout=10,
+        limits=httpx.Limits(max_connections=settings.PRODUCT_LOOKUP_MAX_CONNECTIONS,
+                            max_keepalive_connections=settings.PRODUCT_LOOKUP_MAX_CONNECTIONS),
+    )
+
+
+# Async callers share one connection pool and one set of in-flight lookups per event loop
+_async_http = LoopLocal(_async_client)
+_async_inflight = LoopLocal(dict)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def cache_stats() -> Dict:
+    """Snapshot of the product cache counters."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_cache_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+def product_from_off(off_product: Dict) -> Dict:
+    """Shape a raw Open Food Facts product record into the dict the scan flow uses."""
+    # Ensure we always return a dictionary with expected structure
+    return {
+        "product_name": off_product.get("product_name") or "Unknown Product",
+        "nutriscore_grade": (off_product.get("nutriscore_grade") or "N/A").upper(),
+        "nutriscore_score": off_product.get("nutriscore_score") or 0,
+        "nutriments": off_product.get("nutriments") or {},
+        "nutrient_levels": off_product.get("nutrient_levels") or {},
+        "image_url": off_product.get("image_url") or ""
+    }
+
+
+def _request_product(barcode: str) -> Optional[Dict]:
+    """
+    Query Open Food Facts. Returns the product dict, or None when OFF says the
+    barcode is unknown. Network/HTTP errors are raised to the caller so they
+    are never cached as "not found".
+    """
+    response = http_session().get(OPEN_FOOD_FACTS_API.format(barcode), timeout=10)
+    response.raise_for_status()  # Raises exception for 4XX/5XX responses
+    return _parse_response(response.json())
+
+
+async def _arequest_product(barcode: str) -> Optional[Dict]:
+    """_request_product() over the pooled async client; errors are raised the same way."""
+    response = await _async_http.get().get(OPEN_FOOD_FACTS_API.format(barcode))
+    response.raise_for_status()
+    return _parse_response(response.json())
+
+
+def _parse_response(product: Dict) -> Optional[Dict]:
+    if product.get("status") == 0 or not product.get("product"):
+        return None
+
+    return product_from_off(product["product"])
+
+
+def _is_fresh(entry: CachedProduct) -> bool:
+    ttl = settings.PRODUCT_CACHE_TTL if entry.data is not None else settings.PRODUCT_CACHE_NEGATIVE_TTL
+    return (timezone.now() - entry.fetched_at).total_seconds() < ttl
+
+
+def _refresh(barcode: str, stale_entry: Optional[CachedProduct]) -> Optional[Dict]:
+    import requests
     try:
-        response = requests.get(OPEN_FOOD_FACTS_API.format(barcode), timeout=10)
-        response.raise_for_status()  # Raises exception for 4XX/5XX responses
-        
-        product = response.json()
-        
-        if product.get("status") == 0 or not product.get("product"):
-            return None
-            
-        # Ensure we always return a dictionary with expected structure
-        return {
-            "product_name": product.get("product", {}).get("product_name", "Unknown Product"),
-            "nutriscore_grade": product.get("product", {}).get("nutriscore_grade", "N/A").upper(),
-            "nutriscore_score": product.get("product", {}).get("nutriscore_score", 0),
-            "nutriments": product.get("product", {}).get("nutriments", {}),
-            "nutrient_levels": product.get("product", {}).get("nutrient_levels", {}),
-            "image_url": product.get("product", {}).get("image_url", "")
-        }
-        
+        data = _request_product(barcode)
     except (requests.RequestException, ValueError, KeyError) as e:
-        print(f"Error fetching product data: {e}")
-        return None
\ No newline at end of file
+        logger.warning("Error fetching product data for %s: %s", barcode, e)
+        metrics.UPSTREAM_ERRORS.inc("openfoodfacts")
+        # Upstream is down: an expired positive entry beats no answer at all
+        if stale_entry is not None:
+            return stale_entry.data
+        return None
+
+    CachedProduct.objects.update_or_create(
+        barcode=barcode,
+        defaults={"data": data, "fetched_at": timezone.now()},
+    )
+    return data
+
+
+async def _arefresh(barcode: str, stale_entry: Optional[CachedProduct]) -> Optional[Dict]:
+    import httpx
+    try:
+        data = await _arequest_product(barcode)
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        logger.warning("Error fetching product data for %s: %s", barcode, e)
+        metrics.UPSTREAM_ERRORS.inc("openfoodfacts")
+        if stale_entry is not None:
+            return stale_entry.data
+        return None
+
+    await CachedProduct.objects.aupdate_or_create(
+        barcode=barcode,
+        defaults={"data": data, "fetched_at": timezone.now()},
+    )
+    return data
+
+
+def _single_flight(barcode: str, fn):
+    """
+    Run fn() once per barcode; concurrent callers wait for and share its
+    result. A caller that waits longer than PRODUCT_LOOKUP_WAIT_TIMEOUT runs
+    fn() itself rather than report the product as missing.
+    """
+    with _inflight_lock:
+        flight = _inflight.get(barcode)
+        leader = flight is None
+        if leader:
+            flight = _inflight[barcode] = _Flight()
+
+    if not leader:
+        if flight.done.wait(timeout=settings.PRODUCT_LOOKUP_WAIT_TIMEOUT):
+            return flight.result
+        return fn()
+
+    try:
+        flight.result = fn()
+    finally:
+        with _inflight_lock:
+            _inflight.pop(barcode, None)
+        flight.done.set()
+    return flight.result
+
+
+async def _asingle_flight(barcode: str, fn):
+    """_single_flight() for coroutines: fn() is awaited once per barcode per event loop."""
+    inflight = _async_inflight.get()
+    flight = inflight.get(barcode)
+    if flight is not None:
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight), timeout=settings.PRODUCT_LOOKUP_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            return await fn()
+
+    flight = inflight[barcode] = asyncio.get_running_loop().create_future()
+    result = None
+    try:
+        result = await fn()
+    finally:
+        inflight.pop(barcode, None)
+        flight.set_result(result)
+    return result
+
+
+def fetch_product_data(barcode: str) -> Optional[Dict]:
+    """
+    Return product info for a barcode. The local CatalogProduct table is
+    checked first, then the persistent CachedProduct table when fresh, and
+    Open Food Facts only when both miss.
+    "Not found" answers are cached for PRODUCT_CACHE_NEGATIVE_TTL seconds.
+    """
+    catalog_entry = CatalogProduct.objects.filter(barcode=barcode).first()
+    if catalog_entry is not None:
+        _count("catalog_hits")
+        return catalog_entry.as_product()
+
+    entry = CachedProduct.objects.filter(barcode=barcode).first()
+
+    if entry is not None and _is_fresh(entry):
+        if entry.data is None:
+            _count("negative_hits")
+            return None
+        _count("hits")
+        return dict(entry.data)
+
+    _count("stale" if entry is not None else "misses")
+    data = _single_flight(barcode, lambda: _refresh(barcode, entry))
+    return dict(data) if data is not None else None
+
+
+async def afetch_product_data(barcode: str) -> Optional[Dict]:
+    """fetch_product_data() for async views: same tables, same counters, no thread held while waiting."""
+    catalog_entry = await CatalogProduct.objects.filter(barcode=barcode).afirst()
+    if catalog_entry is not None:
+        _count("catalog_hits")
+        return catalog_entry.as_product()
+
+    entry = await CachedProduct.objects.filter(barcode=barcode).afirst()
+
+    if entry is not None and _is_fresh(entry):
+        if entry.data is None:
+            _count("negative_hits")
+            return None
+        _count("hits")
+        return dict(entry.data)
+
+    _count("stale" if entry is not None else "misses")
+    data = await _asingle_flight(barcode, lambda: _arefresh(barcode, entry))
+    return dict(data) if data is not None else None
@@ -0,0 +1,164 @@
+import json
+import os
+import re
+import threading
+from collections import namedtuple
+from typing import Dict, Optional
+from django.conf import settings
+
+from . import nutrients
+
+# A rule compiled from the JSON file: checks is a list of predicates over (product, profile)
+Rule = namedtuple("Rule", "id verdict weight reason checks")
+
+# Profile text is read clause by clause: "diabetes, no hypertension" mentions diabetes only.
+# A negation counts only within the few words before a keyword in its clause; when
+# in doubt a condition is taken as present, which only makes the verdict more cautious.
+CLAUSE_BREAK = re.compile(r"[,;.:/()\n]|\b(?:but|except|and|with|plus|also)\b")
+NEGATION = re.compile(r"\b(?:no|not|non|none|never|nor|without|free of|denies)\b|n't\b")
+NEGATION_WINDOW = 3
+
+_stats = {"fast_path": 0, "inconclusive": 0}
+_stats_lock = threading.Lock()
+
+
+def rule_stats() -> Dict:
+    """How many analyses the rules answered without the LLM, and the ratio of those to all."""
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats["fast_path"] + stats["inconclusive"]
+    stats["fast_path_ratio"] = stats["fast_path"] / total if total else 0.0
+    return stats
+
+
+def reset_rule_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+def _mentions(text, pattern, negatable):
+    for clause in CLAUSE_BREAK.split(text):
+        for match in pattern.finditer(clause):
+            before = " ".join(clause[:match.start()].split()[-NEGATION_WINDOW:])
+            if not (negatable and NEGATION.search(before)):
+                return True
+    return False
+
+
+def _text_any(field, keywords):
+    """
+    Whether a word in the field starts with one of the keywords ("diabet"
+    matches "diabetic"). In the user's own fields, a keyword after a negation
+    in the same clause ("no diabetes", "non-diabetic") does not count.
+    """
+    pattern = re.compile(r"\b(?:%s)" % "|".join(re.escape(keyword.lower()) for keyword in keywords))
+    negatable = field != "name"
+    return lambda product, profile: _mentions(profile[field], pattern, negatable)
+
+
+def _compile_check(kind, arg):
+    """One predicate per condition in a rule's "when" block."""
+    if kind in ("conditions_any", "goal_any", "diet_any", "name_any"):
+        return _text_any(kind[:-4], arg)
+    if kind == "nutriscore_in":
+        grades = {grade.lower() for grade in arg}
+        return lambda product, profile: str(product.get("nutriscore_grade") or "").lower() in grades
+    if kind == "levels":
+        wanted = {nutrient: set(levels) for nutrient, levels in arg.items()}
+        return lambda product, profile: all(
+            (product.get("nutrient_levels") or {}).get(nutrient) in levels for nutrient, levels in wanted.items())
+    if kind == "all_levels":
+        allowed = set(arg)
+        return lambda product, profile: bool(product.get("nutrient_levels")) and all(
+            level in allowed for level in product["nutrient_levels"].values())
+    if kind in ("max", "min"):
+        # A missing nutrient never satisfies a bound
+        def check(product, profile):
+            nutriments = product.get("nutriments") or {}
+            for name, bound in arg.items():
+                value = nutrients.per_100g(nutriments, name)
+                if value is None or (value > bound if kind == "max" else value < bound):
+                    return False
+            return True
+        return check
+    raise ValueError(f"Unknown rule condition {kind!r}")
+
+
+def compile_rules(data):
+    """Validate the parsed rules file and turn each rule's conditions into predicates."""
+    rules = []
+    for entry in data["rules"]:
+        if entry["verdict"] not in ("Yes", "No"):
+            raise ValueError(f"Rule {entry['id']} has verdict {entry['verdict']!r}; expected Yes or No")
+        checks = [_compile_check(kind, arg) for kind, arg in entry["when"].items()]
+        rules.append(Rule(entry["id"], entry["verdict"], entry["weight"], entry["reason"], checks))
+    return {"threshold": data["threshold"], "summaries": data["summaries"], "rules": rules}
+
+
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+
+def load_rules(path=None):
+    """Compiled rules from path (default ANALYSIS_RULES_FILE), reloaded when the file changes."""
+    path = path or settings.ANALYSIS_RULES_FILE
+    signature = (os.path.getmtime(path), os.path.getsize(path))
+    with _compiled_lock:
+        cached = _compiled.get(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+    with open(path, encoding="utf-8") as f:
+        ruleset = compile_rules(json.load(f))
+    with _compiled_lock:
+        _compiled[path] = (signature, ruleset)
+    return ruleset
+
+
+def _profile(user, product):
+    return {
+        "conditions": (user.health_conditions or "").lower(),
+        "goal": (user.goal or "").lower(),
+        "diet": (user.dietary_preferences or "").lower(),
+        "name": (product.get("product_name") or "").lower(),
+    }
+
+
+def evaluate(product, user, ruleset=None, threshold=None) -> Optional[Dict]:
+    """
+    Score the product against the user's profile. Returns {"advisability",
+    "summary", "model", "rules"} when one verdict leads by at least the
+    threshold (the ruleset's unless given), or None when the rules are
+    inconclusive and the LLM should decide.
+    """
+    ruleset = ruleset or load_rules()
+    threshold = ruleset["threshold"] if threshold is None else threshold
+    profile = _profile(user, product)
+    scores = {"Yes": 0, "No": 0}
+    matched = {"Yes": [], "No": []}
+    for rule in ruleset["rules"]:
+        if all(check(product, profile) for check in rule.checks):
+            scores[rule.verdict] += rule.weight
+            matched[rule.verdict].append(rule)
+
+    margin = scores["Yes"] - scores["No"]
+    if not margin or abs(margin) < threshold:
+        return None
+    verdict = "Yes" if margin > 0 else "No"
+    reasons = [rule.reason for rule in matched[verdict]]
+    return {
+        "advisability": verdict,
+        "summary": ruleset["summaries"][verdict].format(reasons="; ".join(reasons)),
+        "model": "rules",
+        "rules": [rule.id for rule in matched[verdict]],
+    }
+
+
+def fast_path(product, user) -> Optional[Dict]:
+    """evaluate() when ANALYSIS_RULES_ENABLED is on, counted towards rule_stats()."""
+    if not settings.ANALYSIS_RULES_ENABLED:
+        return None
+    analysis = evaluate(product, user)
+    with _stats_lock:
+        _stats["fast_path" if analysis else "inconclusive"] += 1
+    return analysis
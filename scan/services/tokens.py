@@ -0,0 +1,69 @@
+import functools
+import logging
+import math
+import re
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# How BPE pre-tokenizers (GPT, Llama, Mistral) split text: letter runs,
+# numbers in groups of up to three digits, punctuation runs and line breaks
+_PIECES = re.compile(r"[^\W\d_]+|\d{1,3}|\n+|[^\w\s]+|_+")
+
+
+@functools.lru_cache(maxsize=4)
+def _tokenizer(path):
+    if not path:
+        return None
+    try:
+        from tokenizers import Tokenizer  # optional: only with PROMPT_TOKENIZER set
+    except ImportError:
+        logger.warning("PROMPT_TOKENIZER is set but the tokenizers package is not installed; estimating instead")
+        return None
+    try:
+        return Tokenizer.from_file(path)
+    except Exception as e:
+        logger.warning("Could not load tokenizer %s: %s", path, e)
+        return None
+
+
+def estimate_tokens(text) -> int:
+    """
+    Token count without a tokenizer: common words are one token, long words
+    one per ~6 letters, digits one per group of three, symbols one per pair.
+    Close to BPE counts for English prompts and never below the word count,
+    so a budget in tokens is never looser than the same budget in words.
+    """
+    total = 0
+    for piece in _PIECES.findall(text):
+        first = piece[0]
+        if first.isalpha():
+            total += math.ceil(len(piece) / 6)
+        elif first.isdigit() or first == "\n":
+            total += 1
+        else:
+            total += math.ceil(len(piece) / 2)
+    return total
+
+
+def count_tokens(text) -> int:
+    """Tokens in text, exact with settings.PROMPT_TOKENIZER (a tokenizer.json) loaded, estimated otherwise."""
+    tokenizer = _tokenizer(settings.PROMPT_TOKENIZER)
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+    return estimate_tokens(text)
+
+
+def truncate_to_tokens(text, max_tokens) -> str:
+    """The longest whole-word prefix of text within max_tokens, layout kept."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    ends = [match.end() for match in re.finditer(r"\S+", text)]
+    low, high = 0, len(ends)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:ends[middle - 1]]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:ends[low - 1]] if low else ""
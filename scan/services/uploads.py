@@ -0,0 +1,240 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, Optional
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from scan.models import UploadedImage, ScanJob
+from . import barcode_scanner
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif"}
+HASHED_NAME = re.compile(r"^([0-9a-f]{64})\.[a-z0-9]+$")
+
+_stats = {"stored": 0, "deduplicated": 0, "decode_hits": 0, "decode_misses": 0}
+_stats_lock = threading.Lock()
+
+
+def scan_storage():
+    return FileSystemStorage(
+        location=os.path.join(settings.MEDIA_ROOT, 'scans'),
+        base_url=f"{settings.MEDIA_URL}scans/"
+    )
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def upload_stats() -> Dict:
+    """Uploads written vs. already on disk, and decodes skipped thanks to the per-hash cache."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _extension(name):
+    ext = os.path.splitext(name or "")[1].lower()
+    return ext if ext in IMAGE_EXTENSIONS else ".img"
+
+
+def hashed_name(uploaded_file):
+    """Content-addressed file name (sha256 + extension) for an upload."""
+    digest = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    uploaded_file.seek(0)
+    return f"{digest.hexdigest()}{_extension(uploaded_file.name)}"
+
+
+def digest_of(filename) -> Optional[str]:
+    """The SHA-256 in a content-addressed file name, or None for any other name."""
+    match = HASHED_NAME.match(os.path.basename(filename))
+    return match.group(1) if match else None
+
+
+def store_upload(uploaded_file) -> str:
+    """
+    Save an uploaded photo under its content hash and return the file name.
+    A photo that is already stored is not written again; each upload holds a
+    reference to the file until release().
+    """
+    fs = scan_storage()
+    name = hashed_name(uploaded_file)
+    sha256 = digest_of(name)
+    # Take the reference before looking for the file, so a concurrent release() keeps it
+    updated = UploadedImage.objects.filter(sha256=sha256).update(
+        filename=name, size=uploaded_file.size, stored=True, references=F("references") + 1,
+        last_used_at=timezone.now())
+    if not updated:
+        _, created = UploadedImage.objects.get_or_create(
+            sha256=sha256, defaults={"filename": name, "size": uploaded_file.size, "references": 1})
+        if not created:
+            UploadedImage.objects.filter(sha256=sha256).update(stored=True, references=F("references") + 1)
+
+    if fs.exists(name):
+        _count("deduplicated")
+    else:
+        saved = fs.save(name, uploaded_file)
+        if saved != name:
+            # Someone stored the same bytes between exists() and save()
+            fs.delete(saved)
+        _count("stored")
+    return name
+
+
+def decode_barcode(image_path) -> Optional[str]:
+    """
+    scan_barcode() with the result remembered per image hash, so an identical
+    photo is never decoded twice. Paths without a hashed name are decoded as usual.
+    """
+    sha256 = digest_of(image_path)
+    if sha256:
+        cached = UploadedImage.objects.filter(sha256=sha256, decoded=True).values_list("barcode", flat=True).first()
+        if cached is not None:
+            _count("decode_hits")
+            return cached or None
+        _count("decode_misses")
+
+    barcode = barcode_scanner.scan_barcode(image_path)
+    if sha256:
+        UploadedImage.objects.filter(sha256=sha256).update(decoded=True, barcode=barcode or "")
+    return barcode
+
+
+def _in_use(filenames):
+    """Which of these files a queued or running scan job still needs."""
+    busy = [ScanJob.QUEUED] + ScanJob.ACTIVE_STATUSES
+    return set(ScanJob.objects.filter(filename__in=filenames, status__in=busy).values_list("filename", flat=True))
+
+
+def release(filename):
+    """
+    The user has seen the result; drop the photo unless another upload of the
+    same bytes is still waiting for its scan or a scan job still needs it.
+    """
+    if not filename:
+        return False
+    sha256 = digest_of(filename)
+    if not sha256:
+        if _in_use([filename]):
+            return False
+        _delete(filename)
+        return True
+
+    with transaction.atomic():
+        # Locked until the file is gone: a store_upload() of the same bytes waits, then writes it again
+        row = UploadedImage.objects.select_for_update().filter(sha256=sha256).first()
+        if row is None:
+            return False
+        row.references = max(row.references - 1, 0)
+        if row.references or _in_use([filename]):
+            row.save(update_fields=["references"])
+            return False
+        row.stored = False
+        row.save(update_fields=["references", "stored"])
+        _delete(filename)
+    return True
+
+
+def _delete(filename):
+    fs = scan_storage()
+    if fs.exists(filename):
+        fs.delete(filename)
+
+
+def sweep(batch_size=None, max_batches=None, dry_run=False) -> Dict:
+    """
+    Reclaim disk space in bounded batches:
+      - stored uploads unused for SCAN_UPLOAD_TTL seconds (unless a job needs them),
+        including ones whose uploader never came back for the result,
+      - files in the scan folder with no UploadedImage row (orphans) older than that,
+      - decode cache rows for removed files unused for UPLOAD_DECODE_CACHE_TTL.
+    Returns counters including the bytes reclaimed.
+    """
+    batch_size = batch_size or settings.SCAN_SWEEP_BATCH_SIZE
+    started = time.monotonic()
+    fs = scan_storage()
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=settings.SCAN_UPLOAD_TTL)
+    metrics = {"expired_files": 0, "orphan_files": 0, "bytes_reclaimed": 0, "rows_purged": 0, "batches": 0}
+
+    def budget_left():
+        return max_batches is None or metrics["batches"] < max_batches
+
+    def remove(name):
+        path = fs.path(name)
+        try:
+            size = os.path.getsize(path)
+            if not dry_run:
+                os.remove(path)
+        except FileNotFoundError:
+            return
+        metrics["bytes_reclaimed"] += size
+
+    # Expired uploads, oldest first, by primary key so each batch moves forward
+    last_pk = 0
+    while budget_left():
+        batch = list(UploadedImage.objects
+                     .filter(stored=True, last_used_at__lt=cutoff, pk__gt=last_pk)
+                     .order_by("pk").values_list("pk", "filename")[:batch_size])
+        if not batch:
+            break
+        metrics["batches"] += 1
+        last_pk = batch[-1][0]
+        busy = _in_use([name for _, name in batch])
+        expired = [(pk, name) for pk, name in batch if name not in busy]
+        for _, name in expired:
+            remove(name)
+        metrics["expired_files"] += len(expired)
+        if not dry_run:
+            UploadedImage.objects.filter(pk__in=[pk for pk, _ in expired]).update(stored=False, references=0)
+
+    # Files nothing tracks: legacy uuid-named uploads and leftovers of failed writes
+    if budget_left() and os.path.isdir(fs.location):
+        with os.scandir(fs.location) as entries:
+            pending = []
+            for entry in entries:
+                if not entry.is_file() or entry.stat().st_mtime >= cutoff.timestamp():
+                    continue
+                pending.append(entry.name)
+                if len(pending) == batch_size:
+                    metrics["orphan_files"] += _sweep_orphans(pending, remove)
+                    metrics["batches"] += 1
+                    pending = []
+                    if not budget_left():
+                        break
+            if pending and budget_left():
+                metrics["orphan_files"] += _sweep_orphans(pending, remove)
+                metrics["batches"] += 1
+
+    # Decode results for photos that are long gone
+    row_cutoff = now - timedelta(seconds=settings.UPLOAD_DECODE_CACHE_TTL)
+    while budget_left():
+        pks = list(UploadedImage.objects.filter(stored=False, last_used_at__lt=row_cutoff)
+                   .values_list("pk", flat=True)[:batch_size])
+        if not pks:
+            break
+        metrics["batches"] += 1
+        if dry_run:
+            metrics["rows_purged"] += len(pks)
+            break
+        metrics["rows_purged"] += UploadedImage.objects.filter(pk__in=pks).delete()[0]
+
+    metrics["seconds"] = round(time.monotonic() - started, 3)
+    return metrics
+
+
+def _sweep_orphans(names, remove):
+    tracked = set(UploadedImage.objects.filter(filename__in=names, stored=True).values_list("filename", flat=True))
+    keep = tracked | _in_use(names)
+    orphans = [name for name in names if name not in keep]
+    for name in orphans:
+        remove(name)
+    return len(orphans)
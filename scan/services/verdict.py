@@ -0,0 +1,152 @@
+import json
+import re
+from typing import Dict, Optional
+
+ADVISABILITY = ("Yes", "No")
+SUMMARY_MAX_CHARS = 800
+
+# Sent to backends that support constrained decoding (JSON schema / grammar)
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "advisability": {"type": "string", "enum": list(ADVISABILITY)},
+        "summary": {"type": "string", "minLength": 1, "maxLength": SUMMARY_MAX_CHARS},
+    },
+    "required": ["advisability", "summary"],
+    "additionalProperties": False,
+}
+
+ADVISABILITY_PATTERN = re.compile(r'"advisability"\s*:\s*"(Yes|No)"', re.IGNORECASE)
+SUMMARY_PATTERN = re.compile(r'"summary"\s*:\s*"((?:[^"\\]|\\.)*)', re.DOTALL)
+TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+
+class VerdictError(ValueError):
+    """The reply holds no usable verdict, even read tolerantly."""
+
+
+def extract_advisability(partial_text) -> Optional[str]:
+    """The verdict from a reply that may still be arriving, or None if it has not appeared yet."""
+    match = ADVISABILITY_PATTERN.search(partial_text)
+    return match.group(1).capitalize() if match else None
+
+
+def validate(data) -> Dict:
+    """{"advisability", "summary"} checked against SCHEMA; an over-long summary is cut at a word."""
+    if not isinstance(data, dict):
+        raise VerdictError("reply is not a JSON object")
+    advisability = data.get("advisability")
+    if not isinstance(advisability, str) or advisability.strip().capitalize() not in ADVISABILITY:
+        raise VerdictError(f"advisability must be one of {ADVISABILITY}, got {advisability!r}")
+    summary = data.get("summary")
+    if not isinstance(summary, str) or not summary.strip():
+        raise VerdictError("summary is missing or empty")
+    summary = summary.strip()
+    if len(summary) > SUMMARY_MAX_CHARS:
+        summary = summary[:SUMMARY_MAX_CHARS].rsplit(" ", 1)[0] + "…"
+    return {"advisability": advisability.strip().capitalize(), "summary": summary}
+
+
+def _load(candidate) -> Dict:
+    for text in (candidate, TRAILING_COMMA.sub(r"\1", candidate)):
+        try:
+            return validate(json.loads(text))
+        except json.JSONDecodeError:
+            continue
+    raise VerdictError("invalid JSON")
+
+
+def _salvage(text) -> Dict:
+    """Last resort for broken or cut-off JSON: the two fields, wherever they are."""
+    advisability = extract_advisability(text)
+    summary = SUMMARY_PATTERN.search(text)
+    if advisability is None or summary is None:
+        raise VerdictError("no advisability/summary fields in reply")
+    try:
+        summary_text = json.loads(f'"{summary.group(1)}"')
+    except json.JSONDecodeError:
+        summary_text = summary.group(1)
+    return validate({"advisability": advisability, "summary": summary_text})
+
+
+class VerdictParser:
+    """
+    Reads a reply piece by piece and finds the verdict object in it: braces
+    inside strings are ignored, and an object that is not a verdict (a stray
+    "{...}" in prose) is skipped. feed() returns True once the verdict object
+    has closed, so a streaming caller can stop generation right there.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.verdict = None
+        self._start = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    @property
+    def complete(self):
+        return self.verdict is not None
+
+    @property
+    def advisability(self) -> Optional[str]:
+        if self.verdict is not None:
+            return self.verdict["advisability"]
+        return extract_advisability(self.text)
+
+    def feed(self, piece) -> bool:
+        if self.complete:
+            return True
+        offset = len(self.text)
+        self.text += piece
+        for index in range(offset, len(self.text)):
+            char = self.text[index]
+            if self._start is None:
+                if char == "{":
+                    self._start, self._depth = index, 1
+                continue
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        self.verdict = _load(self.text[self._start:index + 1])
+                    except VerdictError:
+                        # Not the verdict; keep looking after it
+                        self._start = None
+                        continue
+                    self.text = self.text[:index + 1]
+                    return True
+        return False
+
+    def result(self) -> Dict:
+        """The validated verdict, repairing a reply cut off mid-object. Raises VerdictError."""
+        if self.verdict is not None:
+            return self.verdict
+        if self._start is not None:
+            tail = self.text[self._start:]
+            if self._in_string:
+                tail += '"'
+            try:
+                return _load(tail + "}" * self._depth)
+            except VerdictError:
+                pass
+        return _salvage(self.text)
+
+
+def parse(text) -> Dict:
+    """Validated {"advisability", "summary"} from a complete reply. Raises VerdictError."""
+    parser = VerdictParser()
+    parser.feed(text)
+    return parser.result()
@@ -0,0 +1,67 @@
+import gc
+import logging
+import time
+from typing import Dict
+from django.conf import settings
+from django.template.loader import get_template
+
+from . import barcode_scanner, decode_pool, guidance, inference, product_lookup, rules
+
+logger = logging.getLogger(__name__)
+
+
+def _http_clients():
+    # Pool objects and the client libraries only; connections are opened per worker after the fork
+    import httpx  # noqa: F401 (the async pipeline's client)
+    product_lookup.http_session()
+
+
+def _decoders():
+    if settings.DECODE_POOL_ENABLED:
+        # Decoding happens in the pool's spawned workers, which load the decoders themselves
+        decode_pool.start_after_fork()
+    else:
+        barcode_scanner.preload()
+
+
+def _templates():
+    for name in ("scan/scan.html", "scan/scan_loading.html", "scan/result.html", "scan/nutrition_label.html"):
+        get_template(name)
+
+
+# (name, step) in order; each step is independent of the others
+STEPS = (
+    ("decoders", _decoders),
+    ("guidance", lambda: guidance.get_index()),
+    ("rules", lambda: rules.load_rules() if settings.ANALYSIS_RULES_ENABLED else None),
+    ("inference", inference.get_router),
+    ("http", _http_clients),
+    ("templates", _templates),
+)
+
+
+def preload() -> Dict[str, float]:
+    """
+    Do the loading every worker would otherwise do on its first scans:
+    decoders, the guidance artifact, rules, inference and HTTP clients,
+    templates. Meant for the master process of a pre-forking server
+    (gunicorn --preload, uWSGI without lazy-apps), so workers inherit the
+    pages copy-on-write instead of each building their own. Opens no
+    sockets, threads or database connections, none of which survive fork.
+    Returns seconds per step; a failing step is logged and skipped.
+    """
+    timings = {}
+    for name, step in STEPS:
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logger.warning("Warm-up step %s failed: %s", name, e)
+            continue
+        timings[name] = time.perf_counter() - started
+    # Everything loaded so far lives as long as the process; move it out of the
+    # collector's reach so collections in workers don't write to (and copy) its pages
+    gc.collect()
+    gc.freeze()
+    logger.info("Warm-up done: %s", ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in timings.items()))
+    return timings
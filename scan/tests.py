@@ -1,26 +1,53 @@
-from django.test import TestCase, RequestFactory, Client
+from django.test import TestCase, TransactionTestCase, RequestFactory, Client, override_settings
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command, CommandError
+from django.core.exceptions import ImproperlyConfigured
+from django.urls import reverse
+from django.conf import settings as django_settings
+from django.apps import apps
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from asgiref.sync import sync_to_async
+from django.utils import timezone
 from django.contrib.sessions.middleware import SessionMiddleware
 from django.contrib.messages.storage.fallback import FallbackStorage
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
+from io import StringIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import timedelta
 from nutri.models import NutriUser
-from .models import ProductScan
-from .views import scan_product_ajax, scan_loading_view, process_scan, result
+from .models import ProductScan, CachedProduct, CatalogProduct, ScanJob, AnalysisCacheEntry, UploadedImage, InferenceUsage
+from .services import product_lookup, jobs, barcode_scanner, analysis_cache, nutrition, pipeline, guidance, inference, rules, nutrients, tokens, history, uploads, aio, prefetch, metrics, verdict, warmup, decode_pool, admission
+from .views import scan_product_ajax, process_scan, result
+from .bench import load as bench_load, suite as bench_suite
+from .bench.fixtures import FakeInference, FakeOpenFoodFacts, render_ean13, encode_png
 import json
-import uuid
+import asyncio
+import threading
+import time
+import requests
+import httpx
 import os
+import shutil
+import tempfile
+import socket
+import subprocess
+import sys
 
 class ScanViewTests(TestCase):
     def setUp(self):
+        admission.reset_buckets()
         self.factory = RequestFactory()
         self.client = Client()
-        self.user = NutriUser.objects.create_user(
-            username='testuser',
+        self.user = NutriUser.objects.create(
+            name='testuser',
+            email='testuser@example.com',
             password='testpass',
             age=30,
+            gender='Male',
             weight=70,
             height=175,
-            bmi=22.9,
             health_conditions='None',
             dietary_preferences='Vegetarian',
             goal='Maintain weight'
@@ -39,16 +66,17 @@ class ScanViewTests(TestCase):
         messages = FallbackStorage(request)
         setattr(request, '_messages', messages)
 
-    @patch('nutri.views.FileSystemStorage.save')
-    @patch('nutri.views.ScanForm')
-    def test_scan_product_ajax_success(self, mock_form, mock_save):
+    @patch('scan.views.prefetch.start')
+    @patch('scan.views.uploads.store_upload')
+    @patch('scan.views.ScanForm')
+    def test_scan_product_ajax_success(self, mock_form, mock_save, mock_prefetch):
         mock_form.return_value.is_valid.return_value = True
         mock_form.return_value.cleaned_data = {'image': SimpleUploadedFile('test.jpg', b'content')}
         mock_save.return_value = 'test_image.jpg'
 
         request = self.factory.post('/scan/ajax/')
-        request.session = self.session
         self.add_session_to_request(request)
+        request.session['user_id'] = self.user.id
         
         response = scan_product_ajax(request)
         data = json.loads(response.content)
@@ -59,42 +87,44 @@ class ScanViewTests(TestCase):
 
     # Add more tests for scan_product_ajax (error cases, invalid form, etc.)
 
-    @patch('nutri.views.barcode_scanner.scan_barcode')
-    @patch('nutri.views.product_lookup.fetch_product_data')
-    @patch('nutri.views.nutrition.analyze_nutrition')
+    @override_settings(SCAN_BACKGROUND_JOBS=False)
+    @patch('scan.services.barcode_scanner.scan_barcode')
+    @patch('scan.services.pipeline.product_lookup.fetch_product_data')
+    @patch('scan.services.pipeline.nutrition.request_analysis')
     def test_process_scan_success(self, mock_analyze, mock_fetch, mock_scan):
         mock_scan.return_value = '123456789'
         mock_fetch.return_value = {'product_name': 'Test Product', 'nutriments': {}}
-        mock_analyze.return_value = '{"advisability": "Good", "summary": "Healthy product"}'
-        self.session['uploaded_filename'] = 'test_image.jpg'
-        self.session.save()
+        mock_analyze.return_value = inference.Reply('{"advisability": "Yes", "summary": "Healthy product"}',
+                                                    'test', 'test-model')
 
         request = self.factory.get('/process/scan/test_image.jpg/')
-        request.session = self.session
         self.add_session_to_request(request)
+        request.session['user_id'] = self.user.id
+        request.session['uploaded_filename'] = 'test_image.jpg'
         
         response = process_scan(request, 'test_image.jpg')
         data = json.loads(response.content)
         
         self.assertEqual(data['status'], 'success')
-        self.assertEqual(request.session['latest_scan_results']['product']['product_name'], 'Test Product')
-        self.assertEqual(request.session['latest_scan_results']['analysis']['advisability'], 'Good')
+        scan = ProductScan.objects.get(id=request.session['latest_scan_id'])
+        self.assertEqual(scan.product_name, 'Test Product')
+        self.assertEqual(scan.advisability, 'Yes')
+        self.assertNotIn('latest_scan_results', request.session)
 
     # Add more tests for process_scan (no barcode, no product, etc.)
 
-    @patch('nutri.views.FileSystemStorage.delete')
-    def test_result_view_success(self, mock_delete):
-        self.session['latest_scan_results'] = {
-            'product': {'product_name': 'Test'},
-            'analysis': {'summary': 'Good product.'},
-            'nutrient_map': 'energy:Energy'
-        }
+    @patch('scan.services.uploads.FileSystemStorage.exists', return_value=True)
+    @patch('scan.services.uploads.FileSystemStorage.delete')
+    def test_result_view_success(self, mock_delete, mock_exists):
+        scan = ProductScan.objects.create(user=self.user, barcode='123', product_name='Test',
+                                          analysis_result='Good product.')
+        self.session['latest_scan_id'] = scan.id
         self.session['uploaded_filename'] = 'test_image.jpg'
         self.session.save()
 
         request = self.factory.get('/result/')
-        request.session = self.session
         self.add_messages_to_request(request)
+        request.session = self.session
         
         response = result(request)
         
@@ -102,4 +132,1644 @@ class ScanViewTests(TestCase):
         self.assertContains(response, 'Test')
         mock_delete.assert_called_with('test_image.jpg')
 
-    # Add test for result view without scan results
\ No newline at end of file
+    # Add test for result view without scan results
+
+class ProductScanStorageTests(TestCase):
+    def test_nutriments_are_stored_compactly(self):
+        off = {'sugars': 10.6, 'sugars_100g': 10.6, 'sugars_unit': 'g', 'sugars_value': 10.6,
+               'salt_100g': 0.02, 'sugars_serving': 35, 'nova-group': 4, 'fruits_label': 'x'}
+        self.assertEqual(nutrients.compact(off),
+                         {'sugars': 10.6, 'salt': 0.02, 'sugars_serving': 35, 'nova-group': 4})
+
+    def test_result_only_shows_own_scans(self):
+        owner, other = make_user(), make_user(email='other@example.com')
+        scan = pipeline.save_scan(owner, '123', {'product_name': 'Cola', 'nutriments': {'sugars': 10.6}},
+                                  {'advisability': 'No', 'summary': 'Too sweet.'})
+        session = self.client.session
+        session['user_id'] = other.id
+        session.save()
+
+        self.assertRedirects(self.client.get(reverse('scan_result', args=[scan.id])),
+                             reverse('scan'), fetch_redirect_response=False)
+
+        session['user_id'] = owner.id
+        session.save()
+        self.assertContains(self.client.get(reverse('scan_result', args=[scan.id])), 'Too sweet')
+
+
+class NutrientLabelTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_rows_follow_registry_order_and_skip_missing_values(self):
+        rows = nutrients.nutrient_rows({'sugars': 10.6, 'energy-kcal': 42, 'protein': 0.5,
+                                        'salt': 0, 'sugars_serving': 35, 'nova-group': 4})
+
+        self.assertEqual([row['label'] for row in rows], ['Energy (kcal)', 'Total Sugars', 'Protein'])
+        self.assertEqual(rows[1]['per_serving'], 35)
+        self.assertEqual(rows[0]['unit'], 'kcal')
+
+    def test_a_real_zero_is_not_replaced_by_another_value(self):
+        off = {'fiber': 0, 'dietary-fiber': 3, 'sugars': 0, 'sugars_100g': 4.5,
+               'salt_100g': 0, 'salt': 1.2, 'fat_serving': 0, 'fat': 2}
+
+        self.assertEqual(nutrients.per_100g(off, 'fiber'), 0)
+        self.assertEqual(nutrients.compact(off), {'fiber': 0, 'dietary-fiber': 3, 'sugars': 4.5, 'salt': 0,
+                                                  'fat_serving': 0, 'fat': 2})
+        self.assertEqual(nutrients.normalize(off), {'fat': (2.0, 'g'), 'sugars': (4.5, 'g')})
+        rows = nutrients.nutrient_rows(off)
+        self.assertEqual([(row['key'], row['per_100g'], row['per_serving']) for row in rows],
+                         [('fat', 2, 0), ('sugars', 4.5, None)])
+
+    def test_label_is_cached_per_scan(self):
+        user = make_user()
+        scan = pipeline.save_scan(user, '123', {'product_name': 'Cola', 'nutriments': {'sugars': 10.6}},
+                                  {'advisability': 'No', 'summary': 'Too sweet.'})
+        session = self.client.session
+        session['user_id'] = user.id
+        session.save()
+
+        with patch('scan.views.nutrients.nutrition_label', wraps=nutrients.nutrition_label) as build:
+            first = self.client.get(reverse('scan_result', args=[scan.id]))
+            self.client.get(reverse('scan_result', args=[scan.id]))
+
+        self.assertContains(first, 'Total Sugars')
+        self.assertEqual(build.call_count, 1)
+
+    def test_render_benchmark_runs(self):
+        out = StringIO()
+        call_command('bench_result_render', '--iterations', '2', stdout=out)
+        self.assertIn('registry + fragment cache', out.getvalue())
+
+
+class PromptNutrientTests(TestCase):
+    def test_one_canonical_value_per_nutrient(self):
+        table = nutrients.prompt_table({
+            'energy-kj': 1966, 'energy-kj_100g': 1966, 'energy_unit': 'kJ', 'fat': 20, 'fat_100g': 19,
+            'fat_serving': 5.7, 'sodium_100g': 0.36, 'iron_100g': 0.0024, 'trans-fat_100g': 0,
+            'sugars': 'traces', 'nova-group': 4,
+        })
+
+        self.assertEqual(table.splitlines(), [
+            'Energy: 470 kcal', 'Total Fat: 19 g', 'Salt: 0.9 g', 'Iron: 2.4 mg',
+        ])
+
+    def test_kcal_and_salt_win_over_converted_values(self):
+        values = nutrients.normalize({'energy-kcal': 42, 'energy-kj': 1000, 'salt': 1.2, 'sodium': 0.1})
+
+        self.assertEqual(values, {'energy-kcal': (42.0, 'kcal'), 'salt': (1.2, 'g')})
+
+    def test_prompt_uses_compact_table(self):
+        product = {'product_name': 'Crisps', 'nutriments': {'salt': 1.5, 'salt_100g': 1.5, 'salt_unit': 'g'}}
+        prompt = nutrition.generate_prompt(40, 80, 180, 24.7, None, None, None, product, '')
+
+        self.assertIn('Salt: 1.5 g', prompt)
+        self.assertNotIn('salt_unit', prompt)
+
+    def test_size_report_runs(self):
+        out = StringIO()
+        call_command('prompt_size', stdout=out)
+        self.assertIn('whole prompt', out.getvalue())
+
+
+class TokenCountTests(TestCase):
+    def test_estimate_is_never_below_word_count(self):
+        text = "Limit free sugars to less than 10% of total energy intake, ideally 5%.\nSalt: 0.58 g"
+        self.assertGreaterEqual(tokens.estimate_tokens(text), len(text.split()))
+        self.assertEqual(tokens.estimate_tokens("salt"), 1)
+        self.assertEqual(tokens.estimate_tokens("1966"), 2)
+
+    def test_truncation_keeps_whole_words_and_layout(self):
+        text = "first line here\nsecond line here\nthird line here"
+        cut = tokens.truncate_to_tokens(text, 6)
+
+        self.assertEqual(cut, "first line here\nsecond line")
+        self.assertLessEqual(tokens.count_tokens(cut), 6)
+        self.assertEqual(tokens.truncate_to_tokens(text, 100), text)
+
+    @override_settings(PROMPT_TOKENIZER='/nonexistent/tokenizer.json')
+    def test_missing_tokenizer_falls_back_to_estimate(self):
+        self.assertEqual(tokens.count_tokens("salt and sugar"), 3)
+
+
+class ScanHistoryTests(TestCase):
+    def setUp(self):
+        self.user = make_user()
+        start = timezone.now() - timedelta(days=30)
+        for i in range(25):
+            scan = ProductScan.objects.create(user=self.user, barcode=f'{i % 3}', product_name=f'Product {i}',
+                                              analysis_result='')
+            # Pairs share a timestamp so the id tie-breaker is exercised
+            ProductScan.objects.filter(pk=scan.pk).update(scan_date=start + timedelta(days=i // 2))
+        ProductScan.objects.create(user=make_user(email='other@example.com'), barcode='0',
+                                   product_name='Not mine', analysis_result='')
+        session = self.client.session
+        session['user_id'] = self.user.id
+        session.save()
+
+    def test_api_pages_through_everything_once_newest_first(self):
+        seen, cursor = [], ''
+        while True:
+            data = self.client.get(reverse('scan_history_api'), {'limit': 7, 'cursor': cursor}).json()
+            seen.extend(scan['id'] for scan in data['scans'])
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+
+        expected = list(ProductScan.objects.filter(user=self.user)
+                        .order_by('-scan_date', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_deep_pages_cost_one_query(self):
+        _, cursor = history.search_scans(self.user.id, limit=20)
+        with self.assertNumQueries(1):
+            page, next_cursor = history.search_scans(self.user.id, cursor=cursor, limit=20)
+        self.assertEqual(len(page), 5)
+        self.assertIsNone(next_cursor)
+
+    def test_filters(self):
+        by_barcode, _ = history.search_scans(self.user.id, barcode='1', limit=100)
+        self.assertEqual(len(by_barcode), 8)
+
+        by_name, _ = history.search_scans(self.user.id, query='product 2', limit=100)
+        self.assertEqual({scan.product_name for scan in by_name}, {'Product 2'} | {f'Product {i}' for i in range(20, 25)})
+
+        day = ProductScan.objects.get(product_name='Product 4').scan_date.date()
+        by_date, _ = history.search_scans(self.user.id, date_from=day, date_to=day, limit=100)
+        self.assertEqual({scan.product_name for scan in by_date}, {'Product 4', 'Product 5'})
+
+    def test_bad_cursor_is_rejected(self):
+        data = self.client.get(reverse('scan_history_api'), {'cursor': 'garbage'}).json()
+        self.assertEqual(data['status'], 'error')
+
+    def test_history_page(self):
+        response = self.client.get(reverse('scan_history'), {'q': 'Product'})
+        self.assertContains(response, 'Product 24')
+        self.assertNotContains(response, 'Not mine')
+        self.assertContains(response, 'Older scans')
+
+
+class UploadStoreTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media, SCAN_UPLOAD_TTL=60, UPLOAD_DECODE_CACHE_TTL=24 * 3600)
+        self.override.enable()
+        self.addCleanup(self.override.disable)
+        self.addCleanup(shutil.rmtree, self.media)
+
+    def _upload(self, content=b'photo bytes', name='IMG_0001.JPG'):
+        return uploads.store_upload(SimpleUploadedFile(name, content))
+
+    def _age(self, filename, seconds):
+        old = time.time() - seconds
+        os.utime(uploads.scan_storage().path(filename), (old, old))
+
+    def test_identical_photos_share_one_file(self):
+        first = self._upload(name='a.jpg')
+        second = self._upload(name='b.jpg')
+
+        self.assertEqual(first, second)
+        self.assertRegex(first, r'^[0-9a-f]{64}\.jpg$')
+        self.assertEqual(os.listdir(os.path.join(self.media, 'scans')), [first])
+        self.assertEqual(UploadedImage.objects.count(), 1)
+
+    @patch('scan.services.uploads.barcode_scanner.scan_barcode', return_value='4006381333931')
+    def test_decode_is_reused_per_hash(self, mock_scan):
+        path = uploads.scan_storage().path(self._upload())
+        self.assertEqual(uploads.decode_barcode(path), '4006381333931')
+        uploads.release(os.path.basename(path))
+
+        # The file was released, but the same photo uploaded again is not decoded again
+        path = uploads.scan_storage().path(self._upload())
+        self.assertEqual(uploads.decode_barcode(path), '4006381333931')
+        self.assertEqual(mock_scan.call_count, 1)
+
+    @override_settings(SCAN_BACKGROUND_JOBS=False)
+    def test_scan_for_a_deleted_user_releases_only_its_own_reference(self):
+        self._upload()
+        filename = self._upload()  # the same photo, from a user who has since been deleted
+        session = self.client.session
+        session['user_id'] = 999999
+        session.save()
+
+        response = self.client.get(reverse('process_scan', args=[filename]))
+
+        self.assertEqual(response.json()['message'], 'User not found.')
+        self.assertTrue(uploads.scan_storage().exists(filename))
+        row = UploadedImage.objects.get()
+        self.assertEqual((row.stored, row.references), (True, 1))
+
+    def test_release_keeps_a_file_another_upload_still_needs(self):
+        first = self._upload()
+        second = self._upload()  # another user, same photo, scan not started yet
+        fs = uploads.scan_storage()
+
+        self.assertFalse(uploads.release(first))
+        self.assertTrue(fs.exists(second))
+        self.assertTrue(uploads.release(second))
+        self.assertFalse(fs.exists(second))
+        self.assertFalse(UploadedImage.objects.get(filename=second).stored)
+
+        # Uploaded again after removal: written back with a fresh reference
+        self.assertTrue(fs.exists(self._upload()))
+        self.assertEqual(UploadedImage.objects.get().references, 1)
+
+    def test_sweep_removes_expired_and_orphaned_files(self):
+        expired = self._upload(b'old photo')
+        UploadedImage.objects.update(last_used_at=timezone.now() - timedelta(hours=1))
+        busy = self._upload(b'queued photo')
+        UploadedImage.objects.filter(filename=busy).update(last_used_at=timezone.now() - timedelta(hours=1))
+        ScanJob.objects.create(user=make_user(), filename=busy)
+        fresh = self._upload(b'new photo')
+
+        fs = uploads.scan_storage()
+        fs.save('0a1b2c_legacy.jpg', SimpleUploadedFile('legacy.jpg', b'legacy upload'))
+        self._age('0a1b2c_legacy.jpg', 3600)
+
+        metrics = uploads.sweep()
+
+        self.assertEqual(metrics['expired_files'], 1)
+        self.assertEqual(metrics['orphan_files'], 1)
+        self.assertEqual(metrics['bytes_reclaimed'], len(b'old photo') + len(b'legacy upload'))
+        self.assertEqual(sorted(os.listdir(fs.location)), sorted([busy, fresh]))
+        self.assertFalse(UploadedImage.objects.get(filename=expired).stored)
+
+    def test_sweep_is_bounded_and_purges_old_decode_rows(self):
+        for i in range(3):
+            self._upload(f'photo {i}'.encode())
+        UploadedImage.objects.update(last_used_at=timezone.now() - timedelta(days=2))
+
+        first = uploads.sweep(batch_size=2, max_batches=1)
+        self.assertEqual(first['expired_files'], 2)
+
+        out = StringIO()
+        call_command('sweep_uploads', '--batch-size', '2', stdout=out)
+        self.assertIn('Removed 1 expired', out.getvalue())
+        self.assertFalse(UploadedImage.objects.exists())
+
+
+class ProductLookupCacheTests(TestCase):
+    def setUp(self):
+        product_lookup.reset_cache_stats()
+
+    def _off_response(self, payload):
+        response = MagicMock()
+        response.json.return_value = payload
+        response.raise_for_status.return_value = None
+        return response
+
+    @patch('requests.Session.get')
+    def test_repeat_lookup_is_served_from_cache(self, mock_get):
+        mock_get.return_value = self._off_response({
+            'status': 1,
+            'product': {'product_name': 'Cola', 'nutriscore_grade': 'e', 'nutriments': {'sugars_100g': 10.6}},
+        })
+
+        first = product_lookup.fetch_product_data('5449000000996')
+        second = product_lookup.fetch_product_data('5449000000996')
+
+        self.assertEqual(first['product_name'], 'Cola')
+        self.assertEqual(second, first)
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(product_lookup.cache_stats()['hits'], 1)
+        self.assertEqual(product_lookup.cache_stats()['misses'], 1)
+
+    @patch('requests.Session.get')
+    def test_not_found_is_negatively_cached(self, mock_get):
+        mock_get.return_value = self._off_response({'status': 0})
+
+        self.assertIsNone(product_lookup.fetch_product_data('000'))
+        self.assertIsNone(product_lookup.fetch_product_data('000'))
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(product_lookup.cache_stats()['negative_hits'], 1)
+
+    @override_settings(PRODUCT_CACHE_TTL=0)
+    @patch('requests.Session.get')
+    def test_stale_entry_served_when_upstream_fails(self, mock_get):
+        mock_get.return_value = self._off_response({'status': 1, 'product': {'product_name': 'Cola'}})
+        product_lookup.fetch_product_data('123')
+
+        mock_get.side_effect = requests.ConnectionError('down')
+        product = product_lookup.fetch_product_data('123')
+
+        self.assertEqual(product['product_name'], 'Cola')
+        self.assertEqual(product_lookup.cache_stats()['stale'], 1)
+
+    @patch('requests.Session.get')
+    def test_upstream_errors_are_not_cached(self, mock_get):
+        mock_get.side_effect = requests.Timeout('slow')
+        self.assertIsNone(product_lookup.fetch_product_data('123'))
+        self.assertFalse(CachedProduct.objects.filter(barcode='123').exists())
+
+    def test_concurrent_lookups_share_one_request(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow_request(barcode):
+            calls.append(barcode)
+            started.set()
+            release.wait(5)
+            return {'product_name': 'Cola', 'nutriments': {}}
+
+        results = []
+        with patch('scan.services.product_lookup._request_product', side_effect=slow_request), \
+                patch('scan.services.product_lookup.CachedProduct.objects.update_or_create'):
+            leader = threading.Thread(target=lambda: results.append(product_lookup._single_flight(
+                '42', lambda: product_lookup._refresh('42', None))))
+            leader.start()
+            started.wait(5)
+            follower = threading.Thread(target=lambda: results.append(product_lookup._single_flight(
+                '42', lambda: product_lookup._refresh('42', None))))
+            follower.start()
+            time.sleep(0.2)  # let the follower reach the in-flight wait
+            release.set()
+            leader.join(5)
+            follower.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([r['product_name'] for r in results], ['Cola', 'Cola'])
+
+    @override_settings(PRODUCT_LOOKUP_WAIT_TIMEOUT=0.05)
+    def test_follower_that_times_out_looks_up_itself(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow_leader():
+            started.set()
+            release.wait(5)
+            return {'product_name': 'Cola'}
+
+        leader = threading.Thread(target=product_lookup._single_flight, args=('42', slow_leader))
+        leader.start()
+        started.wait(5)
+        try:
+            result = product_lookup._single_flight('42', lambda: {'product_name': 'Cola (own lookup)'})
+        finally:
+            release.set()
+            leader.join(5)
+
+        self.assertEqual(result, {'product_name': 'Cola (own lookup)'})
+
+
+class CatalogImportTests(TestCase):
+    fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+    def _import(self, name, *args):
+        out = StringIO()
+        call_command('import_off_catalog', os.path.join(self.fixtures_dir, name), *args, stdout=out)
+        return out.getvalue()
+
+    def test_jsonl_import_skips_bad_rows(self):
+        output = self._import('off_sample.jsonl', '--batch-size', '2')
+
+        self.assertEqual(CatalogProduct.objects.count(), 3)
+        self.assertIn('3 created', output)
+        self.assertIn('2 skipped', output)
+        cadbury = CatalogProduct.objects.get(barcode='7622201693282')
+        self.assertEqual(cadbury.nutriscore_grade, 'E')
+        self.assertEqual(cadbury.nutrient_levels['sugars'], 'high')
+
+    def test_reimport_is_incremental(self):
+        self._import('off_sample.jsonl')
+        output = self._import('off_sample.jsonl')
+        self.assertIn('0 created, 0 updated, 3 unchanged', output)
+
+    def test_csv_import_folds_nutrient_columns(self):
+        self._import('off_sample.csv')
+        product = CatalogProduct.objects.get(barcode='8901764012280')
+        self.assertEqual(product.nutriments['sugars_100g'], 0)
+        self.assertEqual(product.nutriments['energy-kcal'], 0.4)
+
+    @patch('requests.Session.get')
+    def test_lookup_reads_catalog_before_remote(self, mock_get):
+        self._import('off_sample.jsonl')
+
+        product = product_lookup.fetch_product_data('8901764012273')
+
+        self.assertEqual(product['product_name'], 'Thums Up')
+        self.assertEqual(set(product), {'product_name', 'nutriscore_grade', 'nutriscore_score',
+                                        'nutriments', 'nutrient_levels', 'image_url'})
+        mock_get.assert_not_called()
+
+
+def make_user(**overrides):
+    fields = dict(
+        name='Test User', email='test@example.com', password='testpass',
+        age=30, gender='Female', health_conditions='None', weight=70, height=175,
+        dietary_preferences='Vegetarian', goal='Maintain weight',
+    )
+    fields.update(overrides)
+    return NutriUser.objects.create(**fields)
+
+
+@patch('scan.services.pipeline.nutrition.request_analysis',
+       return_value=inference.Reply('{"advisability": "Yes", "summary": "Fine in moderation."}', 'test', 'test-model'))
+@patch('scan.services.pipeline.product_lookup.fetch_product_data',
+       return_value={'product_name': 'Test Product', 'nutriments': {'sugars': 5}})
+@patch('scan.services.barcode_scanner.scan_barcode', return_value='123456789')
+@override_settings(LLM_STREAMING=False)
+class ScanJobTests(TestCase):
+    def setUp(self):
+        admission.reset_buckets()
+        self.user = make_user()
+        session = self.client.session
+        session['user_id'] = self.user.id
+        session.save()
+
+    def test_process_scan_queues_job_once(self, *mocks):
+        first = self.client.get(reverse('process_scan', args=['photo.jpg'])).json()
+        second = self.client.get(reverse('process_scan', args=['photo.jpg'])).json()
+
+        self.assertEqual(first['status'], 'queued')
+        self.assertEqual(first['job_id'], second['job_id'])
+        self.assertEqual(first['status_url'], reverse('scan_status', args=[first['job_id']]))
+        self.assertEqual(ScanJob.objects.count(), 1)
+
+    def test_status_reports_stage_then_success(self, *mocks):
+        job = jobs.enqueue_scan(self.user.id, 'photo.jpg')
+        pending = self.client.get(reverse('scan_status', args=[job.id])).json()
+        self.assertEqual(pending, {'status': 'pending', 'stage': 'queued'})
+
+        jobs.run_job(jobs.claim_next_job('test-worker'))
+        done = self.client.get(reverse('scan_status', args=[job.id])).json()
+
+        self.assertEqual(done['status'], 'success')
+        scan = ProductScan.objects.get(id=self.client.session['latest_scan_id'])
+        self.assertEqual(done['result_url'], reverse('scan_result', args=[scan.id]))
+        self.assertEqual(scan.product_name, 'Test Product')
+        self.assertEqual(scan.advisability, 'Yes')
+        self.assertEqual(scan.nutriments, {'sugars': 5})
+
+        page = self.client.get(reverse('result'))
+        self.assertContains(page, 'Test Product')
+        self.assertContains(page, 'Fine in moderation')
+
+    def test_status_hides_other_users_jobs(self, *mocks):
+        other = make_user(email='other@example.com')
+        job = jobs.enqueue_scan(other.id, 'photo.jpg')
+        data = self.client.get(reverse('scan_status', args=[job.id])).json()
+        self.assertEqual(data['status'], 'error')
+
+    def test_scan_error_fails_without_retry(self, mock_scan, *mocks):
+        mock_scan.return_value = None
+        jobs.enqueue_scan(self.user.id, 'photo.jpg')
+
+        job = jobs.run_job(jobs.claim_next_job('test-worker'))
+
+        self.assertEqual(job.status, ScanJob.FAILED)
+        self.assertEqual(job.error, 'No barcode detected in the image.')
+        self.assertEqual(job.attempts, 1)
+
+    @override_settings(SCAN_JOB_MAX_ATTEMPTS=2, SCAN_JOB_RETRY_BACKOFF=5)
+    def test_transient_error_retries_with_backoff(self, mock_scan, mock_fetch, mock_analyze):
+        mock_analyze.side_effect = inference.BackendUnavailable('upstream timeout')
+        jobs.enqueue_scan(self.user.id, 'photo.jpg')
+
+        job = jobs.run_job(jobs.claim_next_job('test-worker'))
+        self.assertEqual(job.status, ScanJob.QUEUED)
+        self.assertEqual(job.error, 'upstream timeout')
+        self.assertGreater(job.next_attempt_at, timezone.now())
+        # Not due yet, so nobody can claim it
+        self.assertIsNone(jobs.claim_next_job('test-worker'))
+
+        ScanJob.objects.filter(pk=job.pk).update(next_attempt_at=timezone.now())
+        job = jobs.run_job(jobs.claim_next_job('test-worker'))
+        self.assertEqual(job.status, ScanJob.FAILED)
+        self.assertEqual(job.attempts, 2)
+
+    def test_stale_jobs_are_requeued(self, *mocks):
+        job = jobs.enqueue_scan(self.user.id, 'photo.jpg')
+        jobs.claim_next_job('dead-worker')
+        ScanJob.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(jobs.requeue_stale_jobs(), 1)
+        self.assertEqual(ScanJob.objects.get(pk=job.pk).status, ScanJob.QUEUED)
+
+
+class BarcodeDecodeTests(TestCase):
+    def test_decodes_png_bytes_in_memory(self):
+        data = encode_png(render_ean13('590123412345', canvas=(600, 300)))
+        barcode, winner = barcode_scanner.decode_image_bytes(data)
+        self.assertEqual(barcode, '5901234123457')
+        self.assertEqual(winner, 'full')  # small image, so no downscaled pass
+
+    def test_large_photo_uses_downscaled_pass(self):
+        data = encode_png(render_ean13('590123412345', module=8, height=600, canvas=(3000, 2000)))
+        barcode, winner = barcode_scanner.decode_image_bytes(data)
+        self.assertEqual(barcode, '5901234123457')
+        self.assertEqual(winner, 'downscaled')
+
+    @patch('pyzbar.pyzbar.decode')
+    def test_falls_back_to_later_passes(self, mock_decode):
+        hit = MagicMock()
+        hit.data = b'123'
+        # Nothing on the full image or any rotation, then the Otsu image decodes
+        mock_decode.side_effect = [[], [], [], [], [hit]]
+        gray = render_ean13('590123412345')
+
+        self.assertEqual(barcode_scanner.decode_image(gray), ('123', 'binarized'))
+
+    def test_unreadable_bytes(self):
+        self.assertEqual(barcode_scanner.decode_image_bytes(b'not an image'), (None, None))
+
+
+class BatchScanTests(TestCase):
+    def setUp(self):
+        self.user = make_user()
+        session = self.client.session
+        session['user_id'] = self.user.id
+        session.save()
+
+    def _shelf_photo(self):
+        import numpy as np
+        page = np.full((400, 1000), 255, dtype=np.uint8)
+        first, second = render_ean13('590123412345'), render_ean13('400638133393')
+        page[100:250, 50:50 + first.shape[1]] = first
+        page[100:250, 600:600 + second.shape[1]] = second
+        return page
+
+    def test_locates_every_barcode_with_box(self):
+        found = {item['barcode']: item for item in barcode_scanner.locate_barcodes(self._shelf_photo())}
+
+        self.assertEqual(set(found), {'5901234123457', '4006381333931'})
+        self.assertTrue(found['5901234123457']['symbology'])
+        self.assertLess(found['5901234123457']['rect']['left'], 300)
+        self.assertGreater(found['4006381333931']['rect']['left'], 550)
+
+    def test_box_is_in_original_coordinates_after_downscale(self):
+        photo = render_ean13('590123412345', module=8, height=600, canvas=(3000, 2000))
+        [item] = barcode_scanner.locate_barcodes(photo)
+        self.assertEqual(item['pass'], 'downscaled')
+        self.assertGreater(item['rect']['left'], 1000)
+        self.assertGreater(item['rect']['width'], 600)
+
+    @patch('scan.services.batch.product_lookup.fetch_product_data',
+           side_effect=lambda barcode: {'product_name': f'Product {barcode}'})
+    def test_batch_endpoint_streams_deduplicated_results(self, mock_fetch):
+        shelf = SimpleUploadedFile('shelf.png', encode_png(self._shelf_photo()), content_type='image/png')
+        again = SimpleUploadedFile('again.png', encode_png(render_ean13('590123412345', canvas=(600, 300))),
+                                   content_type='image/png')
+
+        response = self.client.post(reverse('scan_batch'), {'images': [shelf, again]})
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+        self.assertEqual(lines[0]['status'], 'decoded')
+        self.assertEqual(len(lines[0]['barcodes']), 2)
+        self.assertEqual({b['image'] for b in lines[0]['barcodes']}, {'shelf.png'})
+        products = {line['barcode']: line['product'] for line in lines if line['status'] == 'product'}
+        self.assertEqual(products['4006381333931']['product_name'], 'Product 4006381333931')
+        self.assertEqual(lines[-1], {'status': 'done', 'count': 2})
+        self.assertEqual(mock_fetch.call_count, 2)
+
+    def test_batch_endpoint_requires_login(self):
+        response = Client().post(reverse('scan_batch'), {})
+        self.assertEqual(response.json()['status'], 'error')
+
+
+class DecodePoolTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def _pool(self, **options):
+        options = dict(dict(workers=1, queue_size=0, timeout=30, max_tasks=100, max_rss_mb=4096), **options)
+        pool = decode_pool.DecodePool(**options)
+        self.addCleanup(pool.shutdown)
+        return pool
+
+    def test_decodes_in_a_worker_process(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'photo.png')
+        with open(path, 'wb') as f:
+            f.write(encode_png(render_ean13('590123412345', canvas=(400, 600))))
+
+        result = self._pool().run(barcode_scanner.decode_file, path, ['full'])
+        self.assertEqual(result, ('5901234123457', 'full'))
+        self.assertEqual(metrics.DECODE_WAIT_SECONDS.snapshot()[''][2], 1)
+
+    def test_full_queue_is_rejected_fast(self):
+        pool = self._pool()
+        busy = threading.Thread(target=pool.run, args=(time.sleep, 1))
+        busy.start()
+        self.addCleanup(busy.join)
+        while not pool._pending:
+            time.sleep(0.01)
+
+        started = time.perf_counter()
+        with self.assertRaises(decode_pool.DecodeQueueFull) as raised:
+            pool.run(time.sleep, 0)
+        self.assertLess(time.perf_counter() - started, 0.1)
+        self.assertEqual(raised.exception.status, 429)
+        self.assertEqual(metrics.DECODE_POOL_EVENTS.value('queue_full'), 1)
+
+    def test_deadline(self):
+        with self.assertRaises(decode_pool.DecodeTimedOut):
+            self._pool().run(time.sleep, 2, timeout=0.3)
+        self.assertEqual(metrics.DECODE_POOL_EVENTS.value('timed_out'), 1)
+
+    def test_workers_replaced_when_memory_grows(self):
+        pool = self._pool(max_rss_mb=1)
+        self.assertEqual(pool.run(abs, -1), 1)
+        self.assertEqual(metrics.DECODE_POOL_EVENTS.value('memory'), 1)
+        self.assertEqual(pool.run(abs, -2), 2)
+
+    def test_workers_replaced_after_max_tasks(self):
+        pool = self._pool(max_tasks=2)
+        for value in range(3):
+            pool.run(abs, value)
+        self.assertEqual(metrics.DECODE_POOL_EVENTS.value('tasks'), 1)
+
+    def test_crashed_worker_is_replaced(self):
+        pool = self._pool()
+        with self.assertRaises(decode_pool.DecodeUnavailable):
+            pool.run(os._exit, 1)
+        self.assertEqual(metrics.DECODE_POOL_EVENTS.value('crashed'), 1)
+        self.assertEqual(pool.run(abs, -3), 3)
+
+    def test_started_workers_load_the_decoders_first(self):
+        pool = self._pool(workers=2, initializer=barcode_scanner.preload)
+        pool.start()
+        deadline = time.monotonic() + 30
+        while len(pool._executor._processes) < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(pool._executor._processes), 2)
+        self.assertEqual(pool.run(abs, -4), 4)
+        self.assertEqual(pool._executor_tasks, 1)
+
+    def test_warmup_preloads_decoders_in_the_pool_workers(self):
+        with override_settings(SCAN_WARMUP=True), patch.object(decode_pool, '_pool', None):
+            self.assertIs(decode_pool.get_pool().initializer, barcode_scanner.preload)
+        with override_settings(SCAN_WARMUP=False), patch.object(decode_pool, '_pool', None):
+            self.assertIsNone(decode_pool.get_pool().initializer)
+
+        with override_settings(DECODE_POOL_ENABLED=True), \
+                patch('scan.services.warmup.decode_pool.start_after_fork') as start_after_fork, \
+                patch('scan.services.warmup.barcode_scanner.preload') as preload:
+            warmup._decoders()
+        start_after_fork.assert_called_once()
+        preload.assert_not_called()
+
+    @override_settings(SCAN_BACKGROUND_JOBS=False, DECODE_POOL_RETRY_AFTER=5)
+    @patch('scan.views.pipeline.run_scan', side_effect=decode_pool.DecodeQueueFull('Too many photos'))
+    def test_busy_pool_answers_429_with_retry_after(self, run_scan):
+        user = NutriUser.objects.create(name='busy', email='busy@example.com', password='x', age=30,
+                                        gender='Male', weight=70, height=175)
+        session = self.client.session
+        session['user_id'] = user.id
+        session.save()
+
+        response = self.client.get(reverse('process_scan', args=['photo.jpg']))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '5')
+        self.assertEqual(response.json()['status'], 'busy')
+
+
+class AnalysisCacheTests(TestCase):
+    product = {'product_name': 'Cola', 'nutriscore_grade': 'E', 'nutriments': {'sugars': 10.6}}
+    verdict = {'advisability': 'No', 'summary': 'Very high in sugar.'}
+
+    def setUp(self):
+        admission.reset_buckets()
+        analysis_cache.reset_cache_stats()
+        self.user = make_user(age=34, health_conditions='Diabetes, Hypertension')
+
+    def test_similar_profiles_share_an_entry(self):
+        analysis_cache.put('123', self.product, self.user, self.verdict)
+        similar = make_user(email='b@example.com', age=37, weight=71,
+                            health_conditions='hypertension and diabetes')
+
+        self.assertEqual(analysis_cache.get('123', self.product, similar),
+                         dict(self.verdict, model=inference.primary_model()))
+        self.assertEqual(analysis_cache.cache_stats()['hits'], 1)
+
+    def test_different_bucket_or_product_data_misses(self):
+        analysis_cache.put('123', self.product, self.user, self.verdict)
+        older = make_user(email='c@example.com', age=64, health_conditions='Diabetes, Hypertension')
+        reformulated = dict(self.product, nutriments={'sugars': 4.2})
+
+        self.assertIsNone(analysis_cache.get('123', self.product, older))
+        self.assertIsNone(analysis_cache.get('123', reformulated, self.user))
+        self.assertEqual(analysis_cache.cache_stats()['hit_rate'], 0.0)
+
+    def test_parse_failures_are_not_cached(self):
+        analysis_cache.put('123', self.product, self.user, {'advisability': 'Error', 'summary': ''})
+        self.assertFalse(AnalysisCacheEntry.objects.exists())
+
+    def test_fallback_answers_are_not_cached(self):
+        analysis_cache.put('123', self.product, self.user, dict(self.verdict, model='stub'))
+        self.assertFalse(AnalysisCacheEntry.objects.exists())
+
+    @override_settings(ANALYSIS_CACHE_TTL=0)
+    def test_expired_entries_miss(self):
+        analysis_cache.put('123', self.product, self.user, self.verdict)
+        self.assertIsNone(analysis_cache.get('123', self.product, self.user))
+        self.assertEqual(analysis_cache.cache_stats()['expired'], 1)
+
+    @override_settings(ANALYSIS_CACHE_MAX_ENTRIES=2, ANALYSIS_CACHE_EVICT_EVERY=3)
+    def test_least_recently_used_entries_are_evicted(self):
+        for barcode in ('1', '2'):
+            analysis_cache.put(barcode, self.product, self.user, self.verdict)
+        analysis_cache.get('1', self.product, self.user)
+        analysis_cache.put('3', self.product, self.user, self.verdict)
+
+        self.assertEqual(set(AnalysisCacheEntry.objects.values_list('barcode', flat=True)), {'1', '3'})
+
+    @override_settings(ANALYSIS_CACHE_MAX_ENTRIES=1, ANALYSIS_CACHE_EVICT_EVERY=0)
+    def test_eviction_can_be_left_to_the_command(self):
+        with CaptureQueriesContext(connection) as queries:
+            for barcode in ('1', '2'):
+                analysis_cache.put(barcode, self.product, self.user, self.verdict)
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+        self.assertEqual(AnalysisCacheEntry.objects.count(), 2)
+
+        call_command('clear_analysis_cache', '--evict', stdout=StringIO())
+        self.assertEqual(list(AnalysisCacheEntry.objects.values_list('barcode', flat=True)), ['2'])
+
+    def test_invalidate_by_model_or_prompt_version(self):
+        analysis_cache.put('123', self.product, self.user, self.verdict)
+        AnalysisCacheEntry.objects.create(key='old', barcode='9', model_name='old-model',
+                                          prompt_version='0', advisability='Yes', summary='')
+
+        self.assertEqual(analysis_cache.invalidate(prompt_version='0'), 1)
+        call_command('clear_analysis_cache', '--model', inference.primary_model(), stdout=StringIO())
+        self.assertFalse(AnalysisCacheEntry.objects.exists())
+
+    @patch('scan.services.pipeline.nutrition.request_analysis',
+           return_value=inference.Reply('{"advisability": "No", "summary": "Very high in sugar."}', 'test', None))
+    @patch('scan.services.pipeline.product_lookup.fetch_product_data')
+    @patch('scan.services.barcode_scanner.scan_barcode', return_value='123')
+    def test_pipeline_skips_llm_on_cache_hit(self, mock_scan, mock_fetch, mock_analyze):
+        mock_fetch.side_effect = lambda barcode: dict(self.product)
+        pipeline.run_scan(self.user, 'photo.jpg')
+        results = pipeline.run_scan(self.user, 'photo.jpg')
+
+        self.assertEqual(results['analysis'], dict(self.verdict, model=inference.primary_model()))
+        self.assertEqual(mock_analyze.call_count, 1)
+
+
+@override_settings(GUIDANCE_CHUNK_WORDS=20, GUIDANCE_TOP_K=2, GUIDANCE_TOKEN_BUDGET=200)
+class GuidanceRetrievalTests(TestCase):
+    sample = os.path.join(os.path.dirname(__file__), 'fixtures', 'guidance_sample.txt')
+    extra = os.path.join(os.path.dirname(__file__), 'fixtures', 'guidance_extra.txt')
+
+    def test_sugary_product_for_diabetic_user_gets_sugar_guidance(self):
+        product = {'nutrient_levels': {'sugars': 'high', 'salt': 'low'}}
+        text = guidance.relevant_guidance(product, 'Diabetes', 'Maintain weight', paths=[self.sample])
+
+        self.assertIn('free sugars', text)
+        self.assertNotIn('fruit and vegetables', text)
+
+    def test_retrieval_respects_token_budget(self):
+        chunks = guidance.retrieve('salt sodium sugar fat', token_budget=40, k=10, paths=[self.sample])
+        self.assertTrue(chunks)
+        self.assertLessEqual(sum(len(c.text.split()) for c in chunks), 40)
+
+    def test_searches_across_documents(self):
+        product = {'nutrient_levels': {'salt': 'high'}}
+        chunks = guidance.retrieve(guidance.build_query(product, 'Hypertension'),
+                                   paths=[self.sample, self.extra])
+        self.assertEqual({c.source for c in chunks}, {'guidance_sample.txt', 'guidance_extra.txt'})
+
+    def test_prompt_only_carries_retrieved_guidance(self):
+        product = {'product_name': 'Crisps', 'nutrient_levels': {'salt': 'high'}, 'nutriments': {'salt': 2}}
+        knowledge = guidance.relevant_guidance(product, 'Hypertension', None, paths=[self.sample])
+        prompt = nutrition.generate_prompt(40, 80, 180, 24.7, 'Hypertension', None, None, product, knowledge)
+
+        self.assertIn('5 g per day', prompt)
+        self.assertNotIn('400 g of fruit', prompt)
+
+
+@override_settings(GUIDANCE_CHUNK_WORDS=20)
+class GuidanceArtifactTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.doc = os.path.join(self.tmp, 'guidance.txt')
+        shutil.copy(GuidanceRetrievalTests.sample, self.doc)
+        self.artifact = os.path.join(self.tmp, 'guidance.idx')
+        guidance._indexes.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        guidance._indexes.clear()
+
+    def test_artifact_search_matches_in_memory_index(self):
+        in_memory = guidance.build_index([self.doc])
+        guidance.write_artifact(in_memory, [self.doc], self.artifact)
+        mapped = guidance.ArtifactIndex(self.artifact)
+
+        query = 'salt sodium hypertension'
+        self.assertEqual(
+            [(round(score, 6), chunk) for score, chunk in mapped.search(query, 3)],
+            [(round(score, 6), chunk) for score, chunk in in_memory.search(query, 3)],
+        )
+
+    def test_fresh_artifact_is_used_without_parsing_documents(self):
+        guidance.write_artifact(guidance.build_index([self.doc]), [self.doc], self.artifact)
+
+        with override_settings(GUIDANCE_ARTIFACT=self.artifact), \
+                patch('scan.services.guidance.load_document_text') as mock_load:
+            index = guidance.get_index([self.doc])
+
+        self.assertIsInstance(index, guidance.ArtifactIndex)
+        mock_load.assert_not_called()
+
+    def test_stale_artifact_is_ignored(self):
+        guidance.write_artifact(guidance.build_index([self.doc]), [self.doc], self.artifact)
+        with open(self.doc, 'a') as f:
+            f.write('\nA new sentence about potassium.\n')
+
+        with override_settings(GUIDANCE_ARTIFACT=self.artifact):
+            index = guidance.get_index([self.doc])
+
+        self.assertNotIsInstance(index, guidance.ArtifactIndex)
+        self.assertIn('potassium', index.idf)
+
+    def test_documents_with_the_same_name_keep_their_own_chunks(self):
+        other = os.path.join(self.tmp, 'other', 'guidance.txt')
+        os.makedirs(os.path.dirname(other))
+        with open(other, 'w') as f:
+            f.write('Potassium helps the kidneys balance fluids.\n')
+        in_memory = guidance.build_index([self.doc, other])
+        guidance.write_artifact(in_memory, [self.doc, other], self.artifact)
+
+        mapped = guidance.ArtifactIndex(self.artifact)
+        self.assertEqual(mapped.header['chunks'][-1][0], 1)
+        self.assertEqual(mapped.search('potassium kidneys', 1)[0][1].text, 'Potassium helps the kidneys balance fluids.')
+        self.assertEqual(mapped.chunks, in_memory.chunks)
+
+    def test_parsing_pdfs_without_an_artifact_is_logged(self):
+        pdf = os.path.join(self.tmp, 'guidance.pdf')
+        open(pdf, 'wb').close()
+
+        with override_settings(GUIDANCE_ARTIFACT=self.artifact), \
+                patch('scan.services.guidance.load_document_text', return_value='Eat less salt.'), \
+                self.assertLogs('scan.services.guidance', 'WARNING') as logs:
+            guidance.get_index([pdf])
+
+        self.assertIn('does not exist', logs.output[0])
+
+    def test_build_command_writes_artifact(self):
+        with override_settings(GUIDANCE_DOCUMENTS=[self.doc]):
+            call_command('build_guidance', '--output', self.artifact, stdout=StringIO())
+            self.assertTrue(guidance.ArtifactIndex(self.artifact).matches([self.doc]))
+
+
+def fake_backends(url):
+    """INFERENCE_BACKENDS with the Hugging Face backend pointed at a local server."""
+    backends = dict(django_settings.INFERENCE_BACKENDS)
+    backends['huggingface'] = dict(backends['huggingface'], BASE_URL=url, MODEL='fake-llm', TIMEOUT=2)
+    return backends
+
+
+def unused_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+class FakeStreamingLLM:
+    """Local OpenAI-compatible chat endpoint that streams a canned reply in pieces."""
+
+    def __init__(self, pieces, delay=0.05):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.end_headers()
+                for piece in fake.pieces:
+                    chunk = {'id': 'x', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'fake',
+                             'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': piece},
+                                          'finish_reason': None}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                    self.wfile.flush()
+                    time.sleep(fake.delay)
+                self.wfile.write(b"data: [DONE]\n\n")
+
+            def log_message(self, *args):
+                pass
+
+        self.pieces = pieces
+        self.delay = delay
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@override_settings(GUIDANCE_DOCUMENTS=[GuidanceRetrievalTests.sample], LLM_STREAMING=True,
+                   SCAN_PARTIAL_FLUSH_INTERVAL=0)
+class StreamingAnalysisTests(TestCase):
+    pieces = ['{"advisa', 'bility": "No", ', '"summary": "Very high ', 'in sugar."}']
+    product = {'product_name': 'Cola', 'nutrient_levels': {'sugars': 'high'}, 'nutriments': {'sugars': 10.6}}
+
+    def setUp(self):
+        admission.reset_buckets()
+        self.user = make_user(health_conditions='Diabetes')
+
+    def test_verdict_arrives_before_reply_completes(self):
+        seen = []
+        with FakeStreamingLLM(self.pieces) as llm, override_settings(INFERENCE_BACKENDS=fake_backends(llm.url)):
+            analysis = pipeline.analyze_product(self.user, dict(self.product),
+                                                on_partial=lambda text, verdict: seen.append((text, verdict)))
+
+        self.assertEqual(analysis, {'advisability': 'No', 'summary': 'Very high in sugar.', 'model': 'fake-llm'})
+        first_verdict = next(text for text, verdict in seen if verdict == 'No')
+        self.assertLess(len(first_verdict), len(''.join(self.pieces)))
+        self.assertGreaterEqual(pipeline.stream_stats()['count'], 1)
+
+    def test_extract_advisability_from_partial_text(self):
+        self.assertIsNone(verdict.extract_advisability('{"advisability": "N'))
+        self.assertEqual(verdict.extract_advisability('{"advisability" : "yes", "sum'), 'Yes')
+
+    @patch('scan.services.pipeline.product_lookup.fetch_product_data')
+    @patch('scan.services.barcode_scanner.scan_barcode', return_value='123')
+    async def test_events_endpoint_streams_progress(self, mock_scan, mock_fetch):
+        mock_fetch.side_effect = lambda barcode: dict(self.product)
+        job = await sync_to_async(jobs.enqueue_scan)(self.user.id, 'photo.jpg')
+
+        def run_worker():
+            with patch('scan.services.pipeline.nutrition.analyze_nutrition_stream', return_value=iter(self.pieces)):
+                return jobs.run_job(jobs.claim_next_job('test-worker'))
+
+        finished = await sync_to_async(run_worker)()
+        self.assertEqual(finished.advisability, 'No')
+
+        session = await sync_to_async(lambda: self.client.session)()
+        session['user_id'] = self.user.id
+        await session.asave()
+        self.async_client.cookies[django_settings.SESSION_COOKIE_NAME] = session.session_key
+
+        response = await self.async_client.get(reverse('scan_events', args=[job.id]))
+        body = b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertIn('event: stage\ndata: {"stage": "done"}', body)
+        self.assertIn('event: advisability\ndata: {"advisability": "No"}', body)
+        self.assertIn('event: partial', body)
+        self.assertTrue(body.rstrip().startswith('event: stage') and 'event: done' in body)
+
+
+class VerdictParsingTests(TestCase):
+    product = {'product_name': 'Cola', 'nutrient_levels': {'sugars': 'high'}, 'nutriments': {'sugars': 10.6}}
+
+    def setUp(self):
+        admission.reset_buckets()
+        metrics.reset()
+
+    def test_tolerates_prose_fences_and_stray_braces(self):
+        reply = ('Sure {see below}:\n```json\n{"advisability": "no", "summary": "Too much {added} sugar.",}\n```'
+                 '\nHope this helps {really}')
+
+        self.assertEqual(verdict.parse(reply), {'advisability': 'No', 'summary': 'Too much {added} sugar.'})
+
+    def test_repairs_a_reply_cut_off_mid_summary(self):
+        self.assertEqual(verdict.parse('{"advisability": "Yes", "summary": "Fine in normal por'),
+                         {'advisability': 'Yes', 'summary': 'Fine in normal por'})
+
+    def test_rejects_values_outside_the_schema(self):
+        with self.assertRaises(verdict.VerdictError):
+            verdict.parse('{"advisability": "Maybe", "summary": "Hard to say."}')
+
+    def test_stream_is_closed_once_the_object_closes(self):
+        consumed = []
+
+        def pieces():
+            try:
+                for piece in ['{"advisability": "No", ', '"summary": "Very sweet."}', ' Extra', ' words']:
+                    consumed.append(piece)
+                    yield piece
+            finally:
+                consumed.append('closed')
+
+        with patch('scan.services.pipeline.nutrition.analyze_nutrition_stream', return_value=pieces()):
+            analysis = pipeline.analyze_product(make_user(), dict(self.product), on_partial=lambda *args: None)
+
+        self.assertEqual(analysis['summary'], 'Very sweet.')
+        self.assertEqual(consumed[-1], 'closed')
+        self.assertNotIn(' Extra', consumed)
+
+    @override_settings(ANALYSIS_PARSE_RETRIES=1)
+    def test_repair_runs_only_after_a_parse_failure(self):
+        good = inference.Reply('{"advisability": "No", "summary": "Very sweet."}', 'test', 'repair-model')
+        with patch('scan.services.pipeline.nutrition.request_analysis',
+                   return_value=inference.Reply('It is too sweet, so no.', 'test', 'model')), \
+                patch('scan.services.pipeline.nutrition.request_repair', return_value=good) as repair:
+            analysis = pipeline.analyze_product(make_user(), dict(self.product))
+
+        self.assertEqual(analysis, {'advisability': 'No', 'summary': 'Very sweet.', 'model': 'repair-model'})
+        repair.assert_called_once_with('It is too sweet, so no.')
+        self.assertEqual(metrics.VERDICT_RETRIES.value('ok'), 1)
+
+        with patch('scan.services.pipeline.nutrition.request_analysis', return_value=good), \
+                patch('scan.services.pipeline.nutrition.request_repair') as repair:
+            pipeline.analyze_product(make_user(email='other@example.com'), dict(self.product))
+        repair.assert_not_called()
+
+    def test_backends_request_schema_constrained_output(self):
+        backend = inference.HuggingFaceBackend('m', base_url='http://127.0.0.1:1')
+        request = backend._request([], 400, 0.7, verdict.SCHEMA)
+        self.assertEqual(request['response_format']['json_schema']['schema'], verdict.SCHEMA)
+
+        backend.structured_output = False
+        self.assertNotIn('response_format', backend._request([], 400, 0.7, verdict.SCHEMA))
+
+
+@override_settings(INFERENCE_BACKEND='huggingface', INFERENCE_FALLBACK_BACKEND='stub',
+                   INFERENCE_BREAKER_THRESHOLD=2, INFERENCE_BREAKER_RESET=60, INFERENCE_QUEUE_TIMEOUT=0)
+class InferenceBackendTests(TestCase):
+    messages = [{'role': 'user', 'content': 'PRODUCT INFORMATION:\n- Nutri-Score: e'}]
+
+    def test_stub_is_deterministic(self):
+        stub = inference.StubBackend('stub')
+        reply = stub.chat(self.messages, 400, 0.7)
+
+        self.assertEqual(json.loads(reply)['advisability'], 'No')
+        self.assertEqual(reply, ''.join(stub.stream_chat(self.messages, 400, 0.7)))
+
+    def test_open_circuit_routes_to_fallback_without_calling_primary(self):
+        with override_settings(INFERENCE_BACKENDS=fake_backends(unused_url())):
+            router = inference.get_router()
+            replies = [router.chat(self.messages) for _ in range(3)]
+            stats = inference.backend_stats()
+
+        self.assertEqual({reply.backend for reply in replies}, {'stub'})
+        self.assertEqual(stats['huggingface']['calls'], 2)
+        self.assertEqual(stats['huggingface']['rejected'], 1)
+        self.assertEqual(stats['huggingface']['circuit'], 'open')
+        self.assertEqual(stats['fallbacks'], 3)
+
+    def test_streaming_falls_back_before_first_piece(self):
+        with override_settings(INFERENCE_BACKENDS=fake_backends(unused_url())):
+            stream = inference.get_router().stream(self.messages)
+            text = ''.join(stream)
+
+        self.assertEqual(stream.backend, 'stub')
+        self.assertEqual(json.loads(text)['advisability'], 'No')
+
+    def test_full_backend_is_skipped(self):
+        backends = fake_backends(unused_url())
+        backends['huggingface']['MAX_CONCURRENCY'] = 1
+        with override_settings(INFERENCE_BACKENDS=backends, INFERENCE_FALLBACK_BACKEND=''):
+            router = inference.get_router()
+            router.primary.acquire()
+            with self.assertRaisesMessage(inference.BackendUnavailable, 'too many requests in flight'):
+                router.chat(self.messages)
+            self.assertEqual(router.primary.breaker.state, 'closed')
+
+    def test_breaker_lets_one_trial_through_after_reset_timeout(self):
+        breaker = inference.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+
+        breaker.opened_at -= 61
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+
+
+class RuleEngineTests(TestCase):
+    cola = {'product_name': 'Cola', 'nutriscore_grade': 'e',
+            'nutrient_levels': {'sugars': 'high', 'fat': 'low', 'saturated-fat': 'low', 'salt': 'low'},
+            'nutriments': {'energy-kcal': 42, 'sugars': 10.6}}
+    water = {'product_name': 'Natural Mineral Water', 'nutriscore_grade': 'a', 'nutrient_levels': {},
+             'nutriments': {'energy-kcal': 0, 'sugars': 0, 'salt': 0.01, 'fat': 0}}
+
+    def setUp(self):
+        admission.reset_buckets()
+        rules.reset_rule_stats()
+
+    def test_grade_e_sugary_product_for_diabetic_user_is_no(self):
+        analysis = rules.evaluate(self.cola, make_user(health_conditions='Type 2 diabetes'))
+
+        self.assertEqual(analysis['advisability'], 'No')
+        self.assertEqual(analysis['rules'], ['diabetes-high-sugar', 'nutriscore-e'])
+        self.assertIn('high in sugar', analysis['summary'])
+
+    def test_plain_water_is_yes_for_anyone(self):
+        analysis = rules.evaluate(self.water, make_user(health_conditions='Diabetes, hypertension'))
+        self.assertEqual(analysis['advisability'], 'Yes')
+
+    def test_negated_or_partial_words_do_not_match_conditions(self):
+        user = make_user()
+        for conditions in ('No diabetes', 'non-diabetic', "I don't have diabetes", 'none (diabetes screened)'):
+            with self.subTest(conditions):
+                # "none" only negates its own clause
+                expected = 'No' if conditions.startswith('none') else None
+                user.health_conditions = conditions
+                analysis = rules.evaluate(self.cola, user)
+                self.assertEqual(analysis and analysis['advisability'], expected)
+
+        for conditions in ('no allergies and type 2 diabetes', 'no hypertension and diabetes',
+                           'No known allergies, lives with diabetes', 'not overweight but has been diabetic for years'):
+            with self.subTest(conditions):
+                user.health_conditions = conditions
+                self.assertEqual(rules.evaluate(self.cola, user)['advisability'], 'No')
+
+        user.health_conditions = 'Diabetic, but no heart disease'
+        analysis = rules.evaluate(self.cola, user)
+        self.assertEqual(analysis['rules'], ['diabetes-high-sugar', 'nutriscore-e'])
+        check = rules._text_any('conditions', ['heart'])
+        self.assertFalse(check({}, {'conditions': 'sweetheart allergy'}))
+
+    def test_unclear_products_are_left_to_the_llm(self):
+        # Grade E alone, without a condition it affects, is not decisive
+        self.assertIsNone(rules.evaluate(self.cola, make_user()))
+
+    def test_rules_are_read_from_data(self):
+        ruleset = rules.compile_rules({
+            'threshold': 1, 'summaries': {'Yes': '{reasons}', 'No': '{reasons}'},
+            'rules': [{'id': 'vegan', 'verdict': 'No', 'weight': 1, 'reason': 'custom rule',
+                       'when': {'diet_any': ['vegetarian'], 'name_any': ['cola']}}],
+        })
+        analysis = rules.evaluate(self.cola, make_user(), ruleset)
+        self.assertEqual(analysis['summary'], 'custom rule')
+
+        with self.assertRaises(ValueError):
+            rules.compile_rules({'threshold': 1, 'summaries': {}, 'rules': [
+                {'id': 'x', 'verdict': 'Maybe', 'weight': 1, 'reason': '', 'when': {}}]})
+
+    @patch('scan.services.pipeline.nutrition.request_analysis')
+    @patch('scan.services.pipeline.product_lookup.fetch_product_data')
+    @patch('scan.services.barcode_scanner.scan_barcode', return_value='123')
+    def test_pipeline_skips_llm_when_rules_decide(self, mock_scan, mock_fetch, mock_analyze):
+        mock_fetch.side_effect = lambda barcode: dict(self.water)
+        results = pipeline.run_scan(make_user(), 'photo.jpg')
+
+        self.assertEqual(results['analysis']['model'], 'rules')
+        mock_analyze.assert_not_called()
+        self.assertFalse(AnalysisCacheEntry.objects.exists())
+        self.assertEqual(rules.rule_stats()['fast_path_ratio'], 1.0)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@override_settings(INFERENCE_BACKEND='stub', INFERENCE_FALLBACK_BACKEND='', ANALYSIS_CACHE_ENABLED=False,
+                   ADMISSION_CALL_TOKENS=1000, ADMISSION_USER_BURST=2000, ADMISSION_USER_PER_MINUTE=60,
+                   ADMISSION_GLOBAL_BURST=0, ADMISSION_REPEAT_RESERVE=0.5, ADMISSION_USER_DAILY_TOKENS=0)
+class AdmissionTests(TestCase):
+    crackers = {'product_name': 'Crackers', 'nutriscore_grade': 'c',
+                'nutrient_levels': {'salt': 'moderate'}, 'nutriments': {'salt': 1.2}}
+
+    def setUp(self):
+        admission.reset_buckets()
+        metrics.reset()
+        self.user = make_user()
+
+    def _scan(self, barcode):
+        with patch('scan.services.barcode_scanner.scan_barcode', return_value=barcode), \
+                patch('scan.services.pipeline.product_lookup.fetch_product_data',
+                      side_effect=lambda code: dict(self.crackers)):
+            return pipeline.run_scan(self.user, 'photo.jpg')['analysis']
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = admission.TokenBucket(burst=100, per_minute=600, clock=clock)
+        self.assertTrue(bucket.take(60))
+        self.assertFalse(bucket.take(60))
+        self.assertFalse(bucket.take(20, reserve=0.5))
+        clock.now = 2  # 10 tokens a second
+        self.assertTrue(bucket.take(60))
+        bucket.settle(charged=60, used=100)
+        self.assertAlmostEqual(bucket.level, -40)
+
+    def test_admitted_call_charges_the_tokens_it_used(self):
+        analysis = self._scan('111')
+        self.assertEqual(analysis['model'], 'stub')
+
+        usage = InferenceUsage.objects.get(user=self.user)
+        self.assertEqual(usage.calls, 1)
+        self.assertGreater(usage.tokens, 100)
+        self.assertEqual(metrics.INFERENCE_TOKENS.value('first'), usage.tokens)
+        user_bucket, _ = admission._buckets(self.user.id)
+        self.assertAlmostEqual(user_bucket.level, 2000 - usage.tokens, delta=5)
+
+    def test_first_time_scans_have_priority_over_repeats(self):
+        self._scan('111')
+        # A repeat must leave half the burst; a first-time scan may take the rest
+        repeat = admission.admit(self.user, '111')
+        self.assertEqual(repeat.reason, 'user_rate')
+        self.assertTrue(repeat.repeat)
+        self.assertTrue(admission.admit(self.user, '222').admitted)
+
+    @patch('scan.services.pipeline.nutrition.request_analysis')
+    def test_over_budget_repeat_gets_the_previous_verdict(self, request_analysis):
+        ProductScan.objects.create(user=self.user, barcode='111', product_name='Crackers',
+                                   advisability='No', analysis_result='Too salty for you.')
+        with override_settings(ADMISSION_USER_DAILY_TOKENS=500):
+            analysis = self._scan('111')
+
+        request_analysis.assert_not_called()
+        self.assertEqual(analysis['advisability'], 'No')
+        self.assertEqual(analysis['summary'], f"{admission.NOTICES['daily_budget']} Too salty for you.")
+        self.assertEqual(InferenceUsage.objects.get(user=self.user).rejected, 1)
+        self.assertEqual(metrics.INFERENCE_REJECTIONS.value('daily_budget'), 1)
+        self.assertEqual(metrics.INFERENCE_FALLBACKS.value('previous_scan'), 1)
+
+    @override_settings(ANALYSIS_RULES_ENABLED=False, ADMISSION_USER_BURST=1000)
+    def test_refused_first_scan_falls_back_to_rules_or_nutriscore(self):
+        self.assertTrue(admission.admit(self.user, '999').admitted)
+        analysis = self._scan('333')
+        self.assertIn(analysis['model'], ('rules', 'stub'))
+        self.assertTrue(analysis['summary'].startswith(admission.NOTICES['user_rate']))
+        self.assertFalse(AnalysisCacheEntry.objects.exists())
+
+
+@override_settings(INFERENCE_BACKEND='stub', INFERENCE_FALLBACK_BACKEND='',
+                   GUIDANCE_DOCUMENTS=[GuidanceRetrievalTests.sample], ANALYSIS_CACHE_ENABLED=False)
+class AsyncPipelineTests(TestCase):
+    product = {'product_name': 'Crackers', 'nutriscore_grade': 'c',
+               'nutrient_levels': {'salt': 'moderate'}, 'nutriments': {'salt': 1.2}}
+
+    def setUp(self):
+        admission.reset_buckets()
+        product_lookup.reset_cache_stats()
+        self.user = make_user()
+
+    async def _login(self):
+        session = await sync_to_async(lambda: self.client.session)()
+        session['user_id'] = self.user.id
+        await session.asave()
+        self.async_client.cookies[django_settings.SESSION_COOKIE_NAME] = session.session_key
+        return session
+
+    @patch('scan.services.pipeline.uploads.decode_barcode', return_value='123')
+    async def test_async_view_runs_scan_inline(self, mock_decode):
+        session = await self._login()
+        product = AsyncMock(side_effect=lambda barcode: dict(self.product))
+        with patch('scan.services.pipeline.product_lookup.afetch_product_data', product):
+            data = (await self.async_client.get(reverse('process_scan_async', args=['photo.jpg']))).json()
+
+        scan = await ProductScan.objects.aget()
+        self.assertEqual(data, {'status': 'success', 'result_url': reverse('scan_result', args=[scan.id])})
+        self.assertEqual(scan.advisability, 'Yes')
+        stored = session.__class__(session.session_key)
+        self.assertEqual(await stored.aget('latest_scan_id'), scan.id)
+        # Prompt tokens are counted on the worker thread that builds the prompt
+        usage = await InferenceUsage.objects.aget(user=self.user)
+        self.assertGreater(usage.tokens, 100)
+
+    @override_settings(METRICS_TIMING_HEADER=True)
+    @patch('scan.services.pipeline.uploads.decode_barcode', return_value='123')
+    async def test_async_view_timing_header(self, mock_decode):
+        await self._login()
+        product = AsyncMock(side_effect=lambda barcode: dict(self.product))
+        with patch('scan.services.pipeline.product_lookup.afetch_product_data', product):
+            response = await self.async_client.get(reverse('process_scan_async', args=['photo.jpg']))
+
+        stages = {entry.split(';')[0] for entry in response['Server-Timing'].split(', ')}
+        self.assertTrue({'decode', 'lookup', 'profile_load', 'prompt_build', 'inference', 'parse', 'db_write'} <= stages)
+
+    @patch('scan.services.pipeline.uploads.decode_barcode', return_value=None)
+    async def test_async_view_reports_scan_errors(self, mock_decode):
+        await self._login()
+        data = (await self.async_client.get(reverse('process_scan_async', args=['photo.jpg']))).json()
+        self.assertEqual(data, {'status': 'error', 'message': 'No barcode detected in the image.'})
+
+    @override_settings(SCAN_ASYNC_PIPELINE=True)
+    def test_loading_page_uses_async_view_when_enabled(self):
+        response = self.client.get(reverse('scan_loading', args=['photo.jpg']))
+        self.assertContains(response, reverse('process_scan_async', args=['photo.jpg']))
+
+    async def test_lookups_wait_concurrently(self):
+        async def slow_product(barcode):
+            await asyncio.sleep(0.2)
+            return dict(self.product)
+
+        with patch('scan.services.pipeline.uploads.decode_barcode', side_effect=lambda path: path), \
+                patch('scan.services.pipeline.product_lookup.afetch_product_data', side_effect=slow_product):
+            started = time.monotonic()
+            results = await asyncio.gather(*[pipeline.arun_scan(self.user.id, f'{n}') for n in range(20)])
+            elapsed = time.monotonic() - started
+
+        self.assertEqual(len({r['scan_id'] for r in results}), 20)
+        self.assertLess(elapsed, 20 * 0.2 / 2)
+
+    async def test_async_lookup_uses_pooled_client_and_single_flight(self):
+        requests_seen = []
+
+        async def handler(request):
+            requests_seen.append(request.url.path)
+            await asyncio.sleep(0.05)
+            return httpx.Response(200, json={'status': 1, 'product': {'product_name': 'Cola', 'nutriscore_grade': 'e'}})
+
+        client = aio.LoopLocal(lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        with patch('scan.services.product_lookup._async_http', client):
+            products = await asyncio.gather(*[product_lookup.afetch_product_data('5449000000996') for _ in range(5)])
+            again = await product_lookup.afetch_product_data('5449000000996')
+
+        self.assertEqual(requests_seen, ['/api/v0/product/5449000000996.json'])
+        self.assertEqual({p['product_name'] for p in products + [again]}, {'Cola'})
+        self.assertEqual(product_lookup.cache_stats()['hits'], 1)
+
+    async def test_async_chat_falls_back_like_sync_chat(self):
+        with override_settings(INFERENCE_BACKEND='huggingface', INFERENCE_FALLBACK_BACKEND='stub',
+                               INFERENCE_BACKENDS=fake_backends(unused_url())):
+            reply = await inference.get_router().achat(InferenceBackendTests.messages)
+        self.assertEqual(reply.backend, 'stub')
+        self.assertEqual(json.loads(reply.text)['advisability'], 'No')
+
+
+@patch('scan.services.prefetch.guidance.get_index')
+class PrefetchTests(TestCase):
+    water = RuleEngineTests.water
+
+    def setUp(self):
+        admission.reset_buckets()
+        prefetch.reset_prefetch_stats()
+
+    def test_scan_reuses_speculative_decode_and_lookup(self, mock_index):
+        def slow_decode(path):
+            time.sleep(0.05)
+            return '123'
+
+        with patch('scan.services.uploads.decode_barcode', side_effect=slow_decode) as mock_decode, \
+                patch('scan.services.product_lookup.fetch_product_data',
+                      side_effect=lambda barcode: dict(self.water)) as mock_fetch:
+            prefetch.start('photo.jpg')
+            time.sleep(0.01)  # the scan arrives while the decode is still running
+            results = pipeline.run_scan(make_user(), '/media/scans/photo.jpg')
+
+        self.assertEqual(results['barcode'], '123')
+        self.assertEqual(mock_decode.call_count, 1)
+        self.assertEqual(mock_fetch.call_count, 1)
+        stats = prefetch.prefetch_stats()
+        self.assertEqual(stats['used'], 1)
+        self.assertIsNone(prefetch.take('photo.jpg'))
+
+    @override_settings(SCAN_PREFETCH_TIMEOUT=0.05)
+    def test_unclaimed_work_expires_without_a_later_upload(self, mock_index):
+        started, release = threading.Event(), threading.Event()
+
+        def blocked_decode(path):
+            started.set()
+            release.wait(5)
+            return '123'
+
+        with patch('scan.services.uploads.decode_barcode', side_effect=blocked_decode), \
+                patch('scan.services.product_lookup.fetch_product_data') as mock_fetch:
+            spec = prefetch.start('photo.jpg')
+            started.wait(5)
+            self.assertTrue(spec.cancelled.wait(5))
+            release.set()
+            spec.future.result(5)
+
+        mock_fetch.assert_not_called()
+        self.assertEqual(prefetch.prefetch_stats()['expired'], 1)
+        self.assertIsNone(prefetch.take('photo.jpg'))
+
+    @override_settings(SCAN_PREFETCH_TIMEOUT=0.05)
+    def test_handed_off_work_stops_at_the_deadline(self, mock_index):
+        started, release = threading.Event(), threading.Event()
+
+        def blocked_decode(path):
+            started.set()
+            release.wait(5)
+            return '123'
+
+        with patch('scan.services.uploads.decode_barcode', side_effect=blocked_decode), \
+                patch('scan.services.product_lookup.fetch_product_data') as mock_fetch:
+            spec = prefetch.start('photo.jpg')
+            started.wait(5)
+            self.assertTrue(prefetch.hand_off('photo.jpg'))
+            time.sleep(0.1)
+            release.set()
+            spec.future.result(5)
+
+        mock_fetch.assert_not_called()
+        stats = prefetch.prefetch_stats()
+        self.assertEqual((stats['handed_off'], stats['expired']), (1, 0))
+
+    def test_take_before_any_stage_finished_is_missed(self, mock_index):
+        started, release = threading.Event(), threading.Event()
+
+        def blocked_decode(path):
+            started.set()
+            release.wait(5)
+            return None
+
+        with patch('scan.services.uploads.decode_barcode', side_effect=blocked_decode):
+            spec = prefetch.start('photo.jpg')
+            started.wait(5)
+            self.assertEqual(prefetch.take('photo.jpg', timeout=0), prefetch.Prefetched(False, None, False, None))
+            release.set()
+            spec.future.result(5)
+
+        stats = prefetch.prefetch_stats()
+        self.assertEqual((stats['used'], stats['missed'], stats['avg_saved_seconds']), (0, 1, 0.0))
+
+    def test_hand_off_warms_caches_without_counting_as_used(self, mock_index):
+        with patch('scan.services.uploads.decode_barcode', return_value='123') as mock_decode, \
+                patch('scan.services.product_lookup.fetch_product_data') as mock_fetch:
+            spec = prefetch.start('photo.jpg')
+            self.assertTrue(prefetch.hand_off('photo.jpg'))
+            spec.future.result(5)
+
+        mock_decode.assert_called_once()
+        mock_fetch.assert_called_once_with('123')
+        stats = prefetch.prefetch_stats()
+        self.assertEqual((stats['used'], stats['handed_off'], stats['saved_seconds']), (0, 1, 0))
+        self.assertFalse(prefetch.hand_off('photo.jpg'))
+
+    def test_take_expires_other_unclaimed_work(self, mock_index):
+        with patch('scan.services.uploads.decode_barcode', return_value=None):
+            prefetch.start('old.jpg').future.result(5)
+            with override_settings(SCAN_PREFETCH_TIMEOUT=0):
+                self.assertIsNone(prefetch.take('other.jpg'))
+        self.assertEqual(prefetch.prefetch_stats()['expired'], 1)
+        self.assertIsNone(prefetch.take('old.jpg'))
+
+    @override_settings(SCAN_PREFETCH_ENABLED=False)
+    def test_disabled(self, mock_index):
+        self.assertIsNone(prefetch.start('photo.jpg'))
+        self.assertIsNone(prefetch.take('photo.jpg'))
+
+
+class BenchmarkSuiteTests(TestCase):
+    def test_fake_off_serves_products_and_misses(self):
+        with FakeOpenFoodFacts(missing={'000'}) as off, patch.object(product_lookup, 'OPEN_FOOD_FACTS_API', off.api_url):
+            self.assertEqual(product_lookup.fetch_product_data('123')['product_name'], 'Bench product 123')
+            self.assertIsNone(product_lookup.fetch_product_data('000'))
+        self.assertEqual(off.requests, 2)
+
+    def test_selected_stages_run_and_roll_back(self):
+        existing = make_user(email='bench@example.com')
+        results = bench_suite.run_suite(['decode_ean13_640x480', 'lookup_remote', 'full_flow'], iterations=2)
+
+        self.assertEqual(set(results['stages']), {'decode_ean13_640x480', 'lookup_remote', 'full_flow'})
+        self.assertEqual(results['stages']['full_flow']['iterations'], 2)
+        self.assertFalse(ProductScan.objects.exists())
+        self.assertEqual(list(NutriUser.objects.all()), [existing])
+
+    def test_compare_flags_only_real_regressions(self):
+        baseline = {'stages': {'slow': {'median_ms': 10.0}, 'tiny': {'median_ms': 0.01}, 'steady': {'median_ms': 5.0}}}
+        current = {'stages': {'slow': {'median_ms': 14.0}, 'tiny': {'median_ms': 0.05},
+                              'steady': {'median_ms': 5.5}, 'added': {'median_ms': 1.0}}}
+
+        statuses = {name: status for name, _, _, status in bench_suite.compare(current, baseline, 0.25)}
+        self.assertEqual(statuses, {'slow': 'regressed', 'tiny': 'ok', 'steady': 'ok', 'added': 'new'})
+
+    def test_compare_mode_fails_on_regression(self):
+        baseline = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(baseline))
+        with open(baseline, 'w') as f:
+            json.dump({'stages': {'decode_ean13_640x480': {'median_ms': 0.001}}}, f)
+
+        with self.assertRaisesMessage(CommandError, 'decode_ean13_640x480'):
+            call_command('bench_scan', '--stage', 'decode_ean13_640x480', '--iterations', '1',
+                         '--compare', '--baseline', baseline, stdout=StringIO())
+
+    def test_saving_some_stages_keeps_the_others(self):
+        baseline = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(baseline))
+        with open(baseline, 'w') as f:
+            json.dump({'stages': {'decode_ean13_640x480': {'median_ms': 0.001}, 'lookup_remote': {'median_ms': 7.0}}}, f)
+
+        call_command('bench_scan', '--stage', 'decode_ean13_640x480', '--iterations', '1',
+                     '--save', '--baseline', baseline, stdout=StringIO())
+
+        with open(baseline) as f:
+            stages = json.load(f)['stages']
+        self.assertEqual(stages['lookup_remote'], {'median_ms': 7.0})
+        self.assertGreater(stages['decode_ean13_640x480']['median_ms'], 0.001)
+
+
+class LoadTestTests(TransactionTestCase):
+    def test_percentiles(self):
+        stats = bench_load.percentiles([float(ms) for ms in range(1, 101)])
+        self.assertEqual((stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['max_ms']), (50, 95, 99, 100))
+        self.assertEqual(bench_load.percentiles([]), {'count': 0})
+
+    def test_fake_llm_fails_at_its_error_rate(self):
+        with FakeInference(error_rate=1.0) as llm:
+            response = requests.post(f"{llm.url}/v1/chat/completions", json={'messages': []}, timeout=5)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(llm.errors, 1)
+
+    def test_load_run_reports_stages_and_cleans_up(self):
+        saved = os.path.join(tempfile.mkdtemp(), 'load.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(saved))
+        out = StringIO()
+        call_command('load_test', '--scans', '4', '--concurrency', '1', '--products', '2',
+                     '--llm-latency-ms', '5', '--off-latency-ms', '0', '--save', saved, stdout=out)
+
+        with open(saved) as f:
+            results = json.load(f)
+        self.assertEqual(results['scans']['ok'], 4, out.getvalue())
+        self.assertEqual(results['stages']['total']['count'], 4)
+        self.assertIn('inference', results['server_stages'])
+        self.assertEqual(results['upstream']['llm_requests'], 4)
+        self.assertFalse(ProductScan.objects.exists())
+        self.assertFalse(NutriUser.objects.exists())
+        self.assertFalse(CachedProduct.objects.exists())
+
+
+@override_settings(SCAN_BACKGROUND_JOBS=False, SCAN_PREFETCH_ENABLED=False)
+@patch('scan.services.pipeline.product_lookup.fetch_product_data',
+       side_effect=lambda barcode: dict(RuleEngineTests.water))
+@patch('scan.services.barcode_scanner.scan_barcode', return_value='123')
+class MetricsTests(TestCase):
+    def setUp(self):
+        admission.reset_buckets()
+        metrics.reset()
+        self.user = make_user()
+        session = self.client.session
+        session['user_id'] = self.user.id
+        session.save()
+
+    def test_histogram_buckets_are_cumulative(self, *mocks):
+        histogram = metrics.Histogram('test_seconds', 'Test.', (0.01, 0.1), label='stage')
+        for value in (0.005, 0.05, 5):
+            histogram.observe(value, 'decode')
+        lines = histogram.render()
+
+        self.assertIn('test_seconds_bucket{stage="decode",le="0.01"} 1', lines)
+        self.assertIn('test_seconds_bucket{stage="decode",le="0.1"} 2', lines)
+        self.assertIn('test_seconds_bucket{stage="decode",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count{stage="decode"} 3', lines)
+
+    def test_scan_stages_are_exported(self, *mocks):
+        self.client.get(reverse('process_scan', args=['photo.jpg']))
+        with patch('scan.services.pipeline.uploads.decode_barcode', return_value=None):
+            self.client.get(reverse('process_scan', args=['blank.jpg']))
+
+        body = self.client.get(reverse('metrics')).content.decode()
+        for stage in ('profile_load', 'decode', 'lookup', 'db_write'):
+            self.assertIn(f'nutriscan_stage_seconds_count{{stage="{stage}"}}', body)
+        self.assertIn('nutriscan_stage_seconds_count{stage="decode"} 2', body)
+        self.assertIn('nutriscan_decode_failures_total 1', body)
+        self.assertIn('# TYPE nutriscan_product_lookups_total counter', body)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_endpoint_can_be_disabled(self, *mocks):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+    @override_settings(METRICS_TIMING_HEADER=True)
+    def test_timing_header_lists_request_stages(self, *mocks):
+        response = self.client.get(reverse('process_scan', args=['photo.jpg']))
+        stages = [entry.split(';')[0] for entry in response['Server-Timing'].split(', ')]
+        self.assertEqual(stages, ['profile_load', 'decode', 'lookup', 'db_write', 'total'])
+
+    @override_settings(METRICS_TIMING_HEADER=False)
+    def test_no_timing_header_by_default_in_production(self, *mocks):
+        response = self.client.get(reverse('process_scan', args=['photo.jpg']))
+        self.assertNotIn('Server-Timing', response)
+
+    def test_span_overhead_is_negligible(self, *mocks):
+        started = time.perf_counter()
+        for _ in range(10000):
+            with metrics.span('noop'):
+                pass
+        self.assertLess((time.perf_counter() - started) / 10000, 50e-6)
+
+
+class StartupTests(TestCase):
+    def test_heavy_dependencies_load_on_first_use(self):
+        code = ("import sys, django; django.setup(); import scan.views, scan.urls; "
+                "print(','.join(m for m in ('cv2', 'numpy', 'pyzbar', 'requests', 'httpx') if m in sys.modules))")
+        completed = subprocess.run([sys.executable, '-c', code], cwd=django_settings.BASE_DIR,
+                                   env=dict(os.environ, SCAN_WARMUP='False'), capture_output=True, text=True,
+                                   timeout=60)
+        self.assertEqual(completed.returncode, 0, completed.stderr)
+        self.assertEqual(completed.stdout.strip(), '')
+
+    @patch('scan.services.warmup.gc.freeze')
+    def test_warmup_times_each_step_and_skips_failures(self, freeze):
+        steps = (('ok', lambda: None), ('broken', MagicMock(side_effect=OSError('missing artifact'))))
+        with patch.object(warmup, 'STEPS', steps), self.assertLogs('scan.services.warmup', 'WARNING'):
+            timings = warmup.preload()
+        self.assertEqual(list(timings), ['ok'])
+        freeze.assert_called_once()
+
+    def test_unknown_decode_pass_is_rejected_at_startup(self):
+        config = apps.get_app_config('scan')
+        with override_settings(BARCODE_DECODE_PASSES=['downscaled', 'binarised']), \
+                self.assertRaisesMessage(ImproperlyConfigured, 'binarised'):
+            config.ready()
+
+    @patch('scan.services.warmup.preload')
+    def test_warmup_runs_from_ready_only_when_enabled(self, preload):
+        config = apps.get_app_config('scan')
+        with override_settings(SCAN_WARMUP=False):
+            config.ready()
+        preload.assert_not_called()
+        with override_settings(SCAN_WARMUP=True):
+            config.ready()
+        preload.assert_called_once()
@@ -5,9 +5,17 @@ from django.conf.urls.static import static
 
 urlpatterns = [
     path('scan/', views.scan_product_ajax, name='scan'),
+    path('scan-batch/', views.scan_batch, name='scan_batch'),
     path('scan-loading/<str:filename>/', views.scan_loading_view, name='scan_loading'),
     path('process-scan/<str:filename>/', views.process_scan, name='process_scan'),
+    path('process-scan-async/<str:filename>/', views.process_scan_async, name='process_scan_async'),
+    path('scan-status/<int:job_id>/', views.scan_status, name='scan_status'),
+    path('scan-events/<int:job_id>/', views.scan_events, name='scan_events'),
     path('result/', views.result, name='result'),
+    path('result/<int:scan_id>/', views.result, name='scan_result'),
+    path('history/', views.scan_history, name='scan_history'),
+    path('api/history/', views.scan_history_api, name='scan_history_api'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
 
 # Media configuration (serving during development)
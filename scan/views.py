@@ -1,17 +1,25 @@
-import re
-from django.http import JsonResponse
-from django.core.files.storage import FileSystemStorage
+from django.http import JsonResponse, StreamingHttpResponse, HttpResponse, Http404
 from django.shortcuts import render, redirect
 from django.contrib import messages
-import os
-import uuid
+from django.conf import settings
+from django.urls import reverse
 import json
+import time
+import asyncio
 
 from nutri.models import NutriUser
-from nutriscan import settings
-from .services import barcode_scanner, product_lookup, nutrition
-from .models import ProductScan
-from .forms import ScanForm
+from .services import pipeline, jobs, batch, nutrients, history, uploads, prefetch, metrics, decode_pool
+from .models import ProductScan, ScanJob
+from .forms import ScanForm, BatchScanForm, HistoryFilterForm
+
+
+def _busy(error):
+    """429/503 for a decode the pool could not take; the loading page retries after retry_after seconds."""
+    retry_after = settings.DECODE_POOL_RETRY_AFTER
+    response = JsonResponse({"status": "busy", "message": str(error), "retry_after": retry_after},
+                            status=error.status)
+    response['Retry-After'] = str(retry_after)
+    return response
 
 
 def scan_product_ajax(request):
@@ -36,14 +44,12 @@ def scan_product_ajax(request):
                 if not image:
                     return JsonResponse({"status": "error", "message": "No image uploaded."})
 
-                fs = FileSystemStorage(
-                    location=os.path.join(settings.MEDIA_ROOT, 'scans'),
-                    base_url=f"{settings.MEDIA_URL}scans/"
-                )
-
-                original_filename = image.name
-                unique_filename = f"{uuid.uuid4().hex}_{original_filename}"
-                filename = fs.save(unique_filename, image)
+                # Stored under its content hash: the same photo twice is one file
+                fs = uploads.scan_storage()
+                with metrics.span('upload_save'):
+                    filename = uploads.store_upload(image)
+                # Decode and look up while the browser loads the progress page
+                prefetch.start(filename)
 
                 request.session['uploaded_filename'] = filename
 
@@ -68,170 +74,313 @@ def scan_product_ajax(request):
         return render(request, 'scan/scan.html', {'form': form})
 
 
+def scan_batch(request):
+    """
+    Batch scan: several images in one multipart request (field "images"),
+    each of which may hold several barcodes. Streams newline-delimited JSON:
+    first every decoded barcode with its symbology and bounding box, then one
+    line per product lookup in the order the lookups finish.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"status": "error", "message": "POST images to this endpoint."}, status=405)
+
+    if 'user_id' not in request.session:
+        return JsonResponse({
+            "status": "error",
+            "message": "Please log in first.",
+            "redirect_url": "/nutri/login/"
+        })
+
+    form = BatchScanForm(request.POST, request.FILES)
+    if not form.is_valid():
+        return JsonResponse({
+            "status": "error",
+            "message": "Invalid form data.",
+            "errors": form.errors.as_json()
+        })
+
+    images = form.cleaned_data['images']
+    if len(images) > settings.SCAN_BATCH_MAX_IMAGES:
+        return JsonResponse({
+            "status": "error",
+            "message": f"Upload at most {settings.SCAN_BATCH_MAX_IMAGES} images at once."
+        })
+
+    try:
+        barcodes = batch.decode_uploads(images)
+    except decode_pool.DecodeUnavailable as e:
+        return _busy(e)
+
+    def stream():
+        yield json.dumps({"status": "decoded", "barcodes": barcodes}) + "\n"
+        for barcode, product, error in batch.iter_lookups([b["barcode"] for b in barcodes]):
+            line = {"status": "product", "barcode": barcode, "product": product}
+            if error:
+                line.update(status="error", message=error)
+            yield json.dumps(line) + "\n"
+        yield json.dumps({"status": "done", "count": len(barcodes)}) + "\n"
+
+    return StreamingHttpResponse(stream(), content_type='application/x-ndjson')
+
+
 def scan_loading_view(request, filename):
     """
     Renders a loading page after the image is uploaded.
     It displays the uploaded image to the user while the processing happens.
     """
-    fs = FileSystemStorage(
-        location=os.path.join(settings.MEDIA_ROOT, 'scans'),
-        base_url=f"{settings.MEDIA_URL}scans/"
-    )
+    fs = uploads.scan_storage()
+    process_view = 'process_scan_async' if settings.SCAN_ASYNC_PIPELINE else 'process_scan'
     return render(request, 'scan/scan_loading.html', {
         'filename': filename,
-        'image_url': fs.url(filename)
+        'image_url': fs.url(filename),
+        'process_url': reverse(process_view, args=[filename]),
     })
 
 
 def process_scan(request, filename):
     """
-    Processes uploaded image, scans barcode, analyzes product, and stores results in session.
+    Queues the uploaded image for the background scan worker and returns the
+    URL the loading page polls for progress. With SCAN_BACKGROUND_JOBS off the
+    scan runs inline and its ProductScan id is stored in session straight away.
     """
     if 'user_id' not in request.session:
         return JsonResponse({"status": "error", "message": "User not logged in."})
 
-    fs = FileSystemStorage(
-        location=os.path.join(settings.MEDIA_ROOT, 'scans'),
-        base_url=f"{settings.MEDIA_URL}scans/"
-    )
-    image_path = fs.path(filename)
+    if settings.SCAN_BACKGROUND_JOBS:
+        # The worker process finds the speculative results in the decode and product caches
+        prefetch.hand_off(filename)
+        job = jobs.enqueue_scan(request.session['user_id'], filename)
+        return JsonResponse({
+            "status": "queued",
+            "job_id": job.id,
+            "status_url": reverse('scan_status', args=[job.id]),
+            "events_url": reverse('scan_events', args=[job.id]),
+        })
+
+    fs = pipeline.scan_storage()
 
     try:
-        barcode = barcode_scanner.scan_barcode(image_path)
-        if not barcode:
-            return JsonResponse({"status": "error", "message": "No barcode detected in the image."})
+        with metrics.span('profile_load'):
+            user = NutriUser.objects.get(id=request.session['user_id'])
+    except NutriUser.DoesNotExist:
+        # Other uploads of the same photo may still need the file
+        uploads.release(filename)
+        return JsonResponse({"status": "error", "message": "User not found."})
 
-        product = product_lookup.fetch_product_data(barcode)
-        if not product:
-            return JsonResponse({"status": "error", "message": "Product not found in database."})
+    try:
+        request.session['latest_scan_id'] = pipeline.run_scan(user, fs.path(filename))['scan_id']
+        return JsonResponse({"status": "success"})
 
-        product['nutriments'] = product.get('nutriments', {})
+    except decode_pool.DecodeUnavailable as e:
+        return _busy(e)
+    except Exception as e:
+        return JsonResponse({"status": "error", "message": str(e)})
 
-        try:
-            user = NutriUser.objects.get(id=request.session['user_id'])
-        except NutriUser.DoesNotExist:
-            if fs.exists(filename):
-                fs.delete(filename)
-            return JsonResponse({"status": "error", "message": "User not found."})
-
-        pdf_path = 'healthy-diet-fact-sheet-394.pdf'
-        
-        response = nutrition.analyze_nutrition(
-            age=user.age,
-            weight=user.weight,
-            height=user.height,
-            bmi=user.bmi,
-            health_conditions=user.health_conditions,
-            dietary_preferences=user.dietary_preferences,
-            goal=user.goal,
-            product_info=product,
-            pdf_path=pdf_path
-        )
-        print("Response type:", type(response))
-        print("Response value:", response)
-
-
-# Extract JSON-like part from response
-        match = re.search(r'\{.*\}', response, re.DOTALL)
-        if match:
-            try:
-                extracted_data = json.loads(match.group())
-                advisability = extracted_data.get('advisability', 'Unknown')
-                summary = extracted_data.get('summary', 'No summary provided.')
-            except json.JSONDecodeError:
-                advisability = 'Error'
-                summary = 'Could not parse summary.'
-        else:
-             advisability = 'Not found'
-             summary = 'Could not extract JSON block.'
-        
-
-        default_nutrients = {
-            'energy': 0, 'energy-kcal': 0, 'energy-kj': 0,
-            'fat': 0, 'saturated-fat': 0,
-            'carbohydrates': 0, 'sugars': 0,
-            'fiber': 0, 'proteins': 0,
-            'salt': 0, 'sodium': 0
-        }
-        product['nutriments'] = {**default_nutrients, **product.get('nutriments', {})}
-
-        nutrient_map = (
-            "energy:Energy (kcal)|energy-kcal:Energy (kcal)|energy-kj:Energy (kJ)|"
-            "fat:Total Fat|saturated-fat:Saturated Fat|trans-fat:Trans Fat|"
-            "monounsaturated-fat:Monounsaturated Fat|polyunsaturated-fat:Polyunsaturated Fat|"
-            "cholesterol:Cholesterol|carbohydrates:Total Carbohydrates|"
-            "dietary-fiber:Dietary Fiber|soluble-fiber:Soluble Fiber|"
-            "insoluble-fiber:Insoluble Fiber|sugars:Total Sugars|"
-            "added-sugars:Added Sugars|sugar-alcohols:Sugar Alcohols|"
-            "protein:Protein|salt:Salt|sodium:Sodium|potassium:Potassium|"
-            "calcium:Calcium|iron:Iron|vitamin-a:Vitamin A|vitamin-c:Vitamin C|"
-            "vitamin-d:Vitamin D|vitamin-e:Vitamin E|vitamin-k:Vitamin K|"
-            "thiamin:Thiamin (B1)|riboflavin:Riboflavin (B2)|niacin:Niacin (B3)|"
-            "vitamin-b6:Vitamin B6|folate:Folate (B9)|vitamin-b12:Vitamin B12|"
-            "biotin:Biotin (B7)|pantothenic-acid:Pantothenic Acid (B5)|"
-            "phosphorus:Phosphorus|iodine:Iodine|magnesium:Magnesium|"
-            "zinc:Zinc|selenium:Selenium|copper:Copper|manganese:Manganese|"
-            "chromium:Chromium|molybdenum:Molybdenum|chloride:Chloride|"
-            "omega-3:Omega-3 Fatty Acids|omega-6:Omega-6 Fatty Acids|"
-            "alanine:Alanine|arginine:Arginine|aspartic-acid:Aspartic Acid|"
-            "glutamic-acid:Glutamic Acid|glycine:Glycine|histidine:Histidine|"
-            "hydroxyproline:Hydroxyproline|isoleucine:Isoleucine|leucine:Leucine|"
-            "lysine:Lysine|methionine:Methionine|phenylalanine:Phenylalanine|"
-            "proline:Proline|serine:Serine|threonine:Threonine|"
-            "tryptophan:Tryptophan|tyrosine:Tyrosine|valine:Valine|"
-            "caffeine:Caffeine|alcohol:Alcohol|water:Water Content|"
-            "ash:Ash Content|ph:pH Level|pral:PRAL (Renal Acid Load)|"
-            "gluten:Gluten|lactose:Lactose|fructose:Fructose|"
-            "sucrose:Sucrose|starch:Starch|polyols:Polyols|"
-            "gout-inducing:Gout-Inducing Purines|oxalate:Oxalate Content|"
-            "phytate:Phytate Content"
-        )
-
-        request.session['latest_scan_results'] = {
-    "product": product,
-    "analysis": {
-        "advisability": advisability,
-        "summary": summary,
-    },
-    "nutrient_map": nutrient_map
-}
 
-        return JsonResponse({"status": "success"})
+async def process_scan_async(request, filename):
+    """
+    Runs the scan inside the request on the async pipeline instead of the job
+    queue. Served through the ASGI app, a waiting scan costs a coroutine rather
+    than a thread, so one worker holds hundreds of them in flight. The loading
+    page calls this view when SCAN_ASYNC_PIPELINE is on.
+    """
+    user_id = await request.session.aget('user_id')
+    if user_id is None:
+        return JsonResponse({"status": "error", "message": "User not logged in."})
 
+    fs = uploads.scan_storage()
+    try:
+        results = await pipeline.arun_scan(user_id, fs.path(filename))
+    except NutriUser.DoesNotExist:
+        return JsonResponse({"status": "error", "message": "User not found."})
+    except decode_pool.DecodeUnavailable as e:
+        return _busy(e)
     except Exception as e:
         return JsonResponse({"status": "error", "message": str(e)})
 
+    await request.session.aset('latest_scan_id', results['scan_id'])
+    return JsonResponse({"status": "success", "result_url": reverse('scan_result', args=[results['scan_id']])})
+
 
-def result(request):
+def scan_status(request, job_id):
     """
-    Displays scan result and cleans up uploaded image from storage.
+    Lightweight progress check for a queued scan. Once the job is done the id
+    of its ProductScan is put in the session for the result page.
     """
-    scan_results = request.session.get('latest_scan_results')
-    if not scan_results:
+    if 'user_id' not in request.session:
+        return JsonResponse({"status": "error", "message": "User not logged in."})
+
+    job = (ScanJob.objects
+           .filter(id=job_id, user_id=request.session['user_id'])
+           .only('status', 'error', 'scan_id')
+           .first())
+    if job is None:
+        return JsonResponse({"status": "error", "message": "Scan not found."})
+
+    if job.status == ScanJob.DONE:
+        request.session['latest_scan_id'] = job.scan_id
+        return JsonResponse({"status": "success", "result_url": reverse('scan_result', args=[job.scan_id])})
+    if job.status == ScanJob.FAILED:
+        return JsonResponse({"status": "error", "message": job.error or "Processing failed."})
+
+    return JsonResponse({"status": "pending", "stage": job.status})
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _job_events(job_id, user_id):
+    stage, advisability, sent = None, None, 0
+    deadline = time.monotonic() + settings.SCAN_EVENTS_TIMEOUT
+    while time.monotonic() < deadline:
+        job = await (ScanJob.objects
+                     .filter(id=job_id, user_id=user_id)
+                     .only('status', 'error', 'partial_output', 'advisability')
+                     .afirst())
+        if job is None:
+            yield _sse('error', {"message": "Scan not found."})
+            return
+
+        if job.status != stage:
+            stage = job.status
+            yield _sse('stage', {"stage": stage})
+        if job.advisability and job.advisability != advisability:
+            advisability = job.advisability
+            yield _sse('advisability', {"advisability": advisability})
+        if len(job.partial_output) < sent:
+            # The job was retried and the reply starts over
+            sent = 0
+            yield _sse('partial', {"text": "", "reset": True})
+        if len(job.partial_output) > sent:
+            yield _sse('partial', {"text": job.partial_output[sent:]})
+            sent = len(job.partial_output)
+
+        if job.status == ScanJob.DONE:
+            yield _sse('done', {"status_url": reverse('scan_status', args=[job_id])})
+            return
+        if job.status == ScanJob.FAILED:
+            yield _sse('error', {"message": job.error or "Processing failed."})
+            return
+
+        await asyncio.sleep(settings.SCAN_EVENTS_POLL_INTERVAL)
+
+    yield _sse('timeout', {})
+
+
+async def scan_events(request, job_id):
+    """
+    Server-Sent Events for a queued scan: "stage" on each state change,
+    "advisability" as soon as the verdict shows up in the streamed LLM reply,
+    "partial" with newly streamed text, then "done" or "error". Serve it
+    through the ASGI app so open streams don't each pin a worker thread.
+    """
+    user_id = await request.session.aget('user_id')
+    if user_id is None:
+        return JsonResponse({"status": "error", "message": "User not logged in."})
+
+    response = StreamingHttpResponse(_job_events(job_id, user_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def result(request, scan_id=None):
+    """
+    Displays a saved scan (the latest one by default) and cleans up the
+    uploaded image from storage.
+    """
+    scan_id = scan_id or request.session.get('latest_scan_id')
+    scan = None
+    if scan_id and 'user_id' in request.session:
+        scan = ProductScan.objects.filter(id=scan_id, user_id=request.session['user_id']).first()
+    if scan is None:
         messages.info(request, "No recent scan results found.")
         return redirect('scan')
     # Process summary into points
-    if scan_results.get('analysis', {}).get('summary'):
-        summary_points = [
-            point.strip() 
-            for point in scan_results['analysis']['summary'].split('.') 
-            if point.strip()
-        ]
-    else:
-        summary_points = []
+    summary_points = [
+        point.strip()
+        for point in scan.analysis_result.split('.')
+        if point.strip()
+    ]
 
     uploaded_filename = request.session.pop('uploaded_filename', None)
     if uploaded_filename:
-        fs = FileSystemStorage(
-            location=os.path.join(settings.MEDIA_ROOT, 'scans'),
-            base_url=f"{settings.MEDIA_URL}scans/"
-        )
-        if fs.exists(uploaded_filename):
-            fs.delete(uploaded_filename)
+        uploads.release(uploaded_filename)
 
     return render(request, 'scan/result.html', {
-        'product': scan_results.get('product'),
-        'analysis': scan_results.get('analysis'),
-        'nutrient_map': scan_results.get('nutrient_map'),
+        'scan': scan,
+        'product': scan.as_product(),
+        'analysis': scan.as_analysis(),
         'summary_points': summary_points,
+        # Called by the template only when the cached label fragment is missing
+        'nutrition_label': lambda: nutrients.nutrition_label(scan.nutriments),
+        'label_cache_ttl': settings.RESULT_LABEL_CACHE_TTL,
     })
+
+
+def _history_page(request, form):
+    data = form.cleaned_data
+    return history.search_scans(
+        request.session['user_id'],
+        barcode=data.get('barcode'),
+        query=data.get('q'),
+        date_from=data.get('date_from'),
+        date_to=data.get('date_to'),
+        cursor=data.get('cursor'),
+        limit=data.get('limit') or settings.SCAN_HISTORY_PAGE_SIZE,
+    )
+
+
+def scan_history(request):
+    """
+    The user's past scans, newest first, with search by product name,
+    barcode and date range. "Older scans" follows a keyset cursor.
+    """
+    if 'user_id' not in request.session:
+        return redirect('login')
+
+    form = HistoryFilterForm(request.GET)
+    scans, next_cursor = [], None
+    if form.is_valid():
+        scans, next_cursor = _history_page(request, form)
+
+    next_url = None
+    if next_cursor:
+        params = request.GET.copy()
+        params['cursor'] = next_cursor
+        next_url = f"{reverse('scan_history')}?{params.urlencode()}"
+
+    return render(request, 'scan/history.html', {
+        'form': form,
+        'scans': scans,
+        'next_url': next_url,
+    })
+
+
+def scan_history_api(request):
+    """JSON version of scan_history: {"scans": [...], "next_cursor": ...}."""
+    if 'user_id' not in request.session:
+        return JsonResponse({"status": "error", "message": "User not logged in."})
+
+    form = HistoryFilterForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({
+            "status": "error",
+            "message": "Invalid filters.",
+            "errors": form.errors.as_json()
+        })
+
+    scans, next_cursor = _history_page(request, form)
+    return JsonResponse({
+        "status": "success",
+        "scans": [history.scan_summary(scan) for scan in scans],
+        "next_cursor": next_cursor,
+    })
+
+
+def metrics_view(request):
+    """Scan stage latencies and service counters in the Prometheus text format."""
+    if not settings.METRICS_ENABLED:
+        raise Http404("Metrics are disabled.")
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")